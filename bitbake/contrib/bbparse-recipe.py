@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: MIT
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+
+import bb.cookerdata
+import bb.data_smart
+import bb.tinfoil
+
+
+def parse(databuilder, fn, appends):
+    databuilder.parseRecipe(fn, appends, None)
+
+
+def parse_stats(databuilder, fn, appends):
+    count = 0
+    expandWithRefs = bb.data_smart.DataSmart.expandWithRefs
+
+    def counting_expandWithRefs(self, s, varname):
+        nonlocal count
+        count += 1
+        return expandWithRefs(self, s, varname)
+
+    bb.data_smart.DataSmart.expandWithRefs = counting_expandWithRefs
+    overridestats = databuilder.mcdata[""].enableOverrideStats()
+    try:
+        parse(databuilder, fn, appends)
+    finally:
+        bb.data_smart.DataSmart.expandWithRefs = expandWithRefs
+        databuilder.mcdata[""].disableOverrideStats()
+    return count, overridestats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake single recipe parse benchmark",
+        epilog="""
+        Parses the recipes repeatedly in this process and reports the number
+        of variable expansions, the number of override resolutions and the
+        time spent on them, and the CPU time of each parse. The first parse
+        of each recipe warms up the codeparser cache and isn't included.
+        """,
+    )
+    parser.add_argument("recipes", nargs="+", help="Recipes to parse, e.g. glibc or linux-yocto")
+    parser.add_argument(
+        "-n", "--runs", type=int, default=20, help="Number of parses of each recipe (default: %(default)s)"
+    )
+
+    args = parser.parse_args()
+
+    if not "BUILDDIR" in os.environ:
+        print(
+            "'BUILDDIR' not found in the environment. Did you initialize the build environment?"
+        )
+        return 1
+
+    os.chdir(os.environ["BUILDDIR"])
+
+    recipes = []
+    with bb.tinfoil.Tinfoil() as tinfoil:
+        tinfoil.prepare(quiet=2)
+        for recipe in args.recipes:
+            fn = tinfoil.get_recipe_file(recipe)
+            recipes.append((recipe, fn, tinfoil.get_file_appends(fn)))
+
+    cookerconfig = bb.cookerdata.CookerConfiguration()
+    cookerconfig.env = os.environ.copy()
+    databuilder = bb.cookerdata.CookerDataBuilder(cookerconfig, worker=True)
+    databuilder.parseBaseConfiguration(worker=True)
+
+    print("%-24s %12s %10s %14s %10s %10s" % ("recipe", "expansions", "overrides",
+        "overrides (s)", "min (s)", "median (s)"))
+    for recipe, fn, appends in recipes:
+        parse(databuilder, fn, appends)
+
+        times = []
+        for _ in range(args.runs):
+            start_time = time.process_time()
+            parse(databuilder, fn, appends)
+            times.append(time.process_time() - start_time)
+
+        t = sorted(times)
+        expansions, overridestats = parse_stats(databuilder, fn, appends)
+        print("%-24s %12d %10d %14.4f %10.3f %10.3f" % (recipe, expansions,
+            overridestats["resolved"], overridestats["time"], t[0], t[len(t) // 2]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: MIT
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake parser throughput benchmark",
+        epilog="""
+        Parses all recipes from scratch once for each number of parser
+        threads and reports the number of recipes parsed per second. The
+        recipe cache is removed before each run, the codeparser cache in
+        PERSISTENT_DIR is kept unless --cold is given.
+        """,
+    )
+    parser.add_argument(
+        "threads",
+        nargs="*",
+        type=int,
+        default=[1, 2, 4, 8, 16, 32, 64],
+        help="Values of BB_NUMBER_PARSE_THREADS to measure (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="Number of runs for each value"
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="Also remove the codeparser cache before each run"
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        action="append",
+        help="Values of BB_PARSE_RESULT_BATCH_SIZE to measure (default: the configured value)",
+    )
+
+    args = parser.parse_args()
+
+    if not "BUILDDIR" in os.environ:
+        print(
+            "'BUILDDIR' not found in the environment. Did you initialize the build environment?"
+        )
+        return 1
+
+    os.chdir(os.environ["BUILDDIR"])
+
+    env = os.environ.copy()
+    env["BB_ENV_PASSTHROUGH_ADDITIONS"] = " ".join(
+        [env.get("BB_ENV_PASSTHROUGH_ADDITIONS", ""), "BB_NUMBER_PARSE_THREADS", "BB_PARSE_RESULT_BATCH_SIZE"]
+    )
+
+    parsed_re = re.compile(r"Parsing of (\d+) \.bb files complete \((\d+) cached, (\d+) parsed\)")
+
+    print("%8s %6s %8s %10s %12s" % ("threads", "batch", "recipes", "seconds", "recipes/s"))
+    for threads in args.threads:
+        for batch_size in args.batch_size or [None]:
+            for _ in range(args.repeat):
+                shutil.rmtree("tmp/cache", ignore_errors=True)
+                if args.cold:
+                    shutil.rmtree("cache", ignore_errors=True)
+
+                env["BB_NUMBER_PARSE_THREADS"] = str(threads)
+                if batch_size is not None:
+                    env["BB_PARSE_RESULT_BATCH_SIZE"] = str(batch_size)
+                start_time = time.monotonic()
+                r = subprocess.run(
+                    ["bitbake", "-p"],
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                )
+                elapsed = time.monotonic() - start_time
+
+                m = parsed_re.search(r.stdout)
+                if r.returncode != 0 or not m:
+                    print(r.stdout)
+                    print("Run with %d threads exited with %d" % (threads, r.returncode))
+                    return 1
+
+                recipes = int(m.group(3))
+                print(
+                    "%8d %6s %8d %10.2f %12.1f"
+                    % (threads, batch_size or "-", recipes, elapsed, recipes / elapsed)
+                )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+
+import argparse
+import heapq
+import json
+import os
+import re
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+
+import bb.parse
+import bb.runqueue
+
+
+def read_graph(dotfile):
+    """
+    Read the task graph from a task-depends.dot file written by 'bitbake -g'.
+    Returns a dict of tid to the set of tids it depends on and a dict of
+    recipe filename to (pn, version).
+    """
+    node_re = re.compile(r'^"([^"]+)" \[label="(\S+) (\S+)\\n([^\\]*)\\n([^"]+)"\]$')
+    edge_re = re.compile(r'^"([^"]+)" -> "([^"]+)"$')
+
+    tids = {}
+    recipes = {}
+    edges = []
+    with open(dotfile) as f:
+        for line in f:
+            line = line.strip()
+            m = node_re.match(line)
+            if m:
+                task, pn, taskname, version, fn = m.groups()
+                tids[task] = "%s:%s" % (fn, taskname)
+                recipes[fn] = (pn, version)
+                continue
+            m = edge_re.match(line)
+            if m:
+                edges.append(m.groups())
+
+    depends = dict((tid, set()) for tid in tids.values())
+    for task, dep in edges:
+        if task in tids and dep in tids:
+            depends[tids[task]].add(tids[dep])
+    return depends, recipes
+
+
+def read_buildstats(buildstats, recipes):
+    """
+    Read task durations from the buildstats directories of previous builds,
+    averaging the durations of tasks which ran in more than one build.
+    """
+    pfs = {}
+    for fn, (pn, version) in recipes.items():
+        pfs["%s-%s" % (pn, version.split(":", 1)[-1])] = pn
+
+    durations = {}
+    for path in buildstats:
+        for root, dirs, files in os.walk(path):
+            pn = pfs.get(os.path.basename(root))
+            if pn is None:
+                continue
+            for taskname in files:
+                if not taskname.startswith("do_"):
+                    continue
+                with open(os.path.join(root, taskname)) as f:
+                    for line in f:
+                        if line.startswith("Elapsed time:"):
+                            durations.setdefault("%s:%s" % (pn, taskname), []).append(float(line.split()[2]))
+                            break
+
+    return dict((key, sum(values) / len(values)) for key, values in durations.items())
+
+
+class SimulatedRunQueue(object):
+    """
+    Just enough of RunQueueData and RunQueueExecute for the schedulers to run
+    against, with all tasks needing to be executed.
+    """
+    def __init__(self, depends, recipes, historyfile, threads):
+        self.runtaskentries = {}
+        for tid in depends:
+            self.runtaskentries[tid] = bb.runqueue.RunTaskEntry()
+            self.runtaskentries[tid].depends = depends[tid]
+        for tid in depends:
+            for dep in depends[tid]:
+                self.runtaskentries[dep].revdeps.add(tid)
+
+        endpoints = [tid for tid in self.runtaskentries if not self.runtaskentries[tid].revdeps]
+        bb.runqueue.RunQueueData.calculate_task_weights(self, endpoints)
+
+        self.dataCaches = {"": types.SimpleNamespace(pkg_fn=dict((fn, recipes[fn][0]) for fn in recipes))}
+
+        variables = {"BB_TASK_DURATIONS": historyfile}
+        self.cfgData = types.SimpleNamespace(getVar=variables.get, getVarFlag=lambda var, flag: None)
+
+        self.number_tasks = threads
+        self.max_cpu_pressure = None
+        self.max_io_pressure = None
+        self.max_memory_pressure = None
+        self.max_loadfactor = None
+        self.stats = types.SimpleNamespace(active=0)
+        self.build_stamps = {}
+        self.holdoff_tasks = set()
+        self.tasks_covered = set()
+        self.tasks_notcovered = set(self.runtaskentries)
+        self.runq_buildable = set(tid for tid in self.runtaskentries if not self.runtaskentries[tid].depends)
+        self.runq_running = set()
+        self.runq_complete = set()
+
+    def can_start_task(self):
+        return self.stats.active < self.number_tasks
+
+    def simulate(self, scheduler, durations):
+        """
+        Run the build with the given scheduler class, returning the makespan
+        """
+        sched = scheduler(self, self)
+        now = 0.0
+        running = []
+        while True:
+            task = sched.next()
+            if task is not None:
+                self.runq_running.add(task)
+                self.stats.active += 1
+                heapq.heappush(running, (now + durations[task], task))
+                continue
+
+            if not running:
+                break
+
+            now, task = heapq.heappop(running)
+            self.stats.active -= 1
+            self.runq_complete.add(task)
+            for revdep in self.runtaskentries[task].revdeps:
+                if self.runtaskentries[revdep].depends.issubset(self.runq_complete):
+                    self.runq_buildable.add(revdep)
+                    sched.newbuildable(revdep)
+
+        if len(self.runq_complete) != len(self.runtaskentries):
+            raise RuntimeError("Scheduler '%s' only ran %d of %d tasks" % (scheduler.name, len(self.runq_complete), len(self.runtaskentries)))
+        return now
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake runqueue scheduler simulator",
+        epilog="""
+        Replays the task graph from a task-depends.dot file written by
+        'bitbake -g' with the task durations from a BB_TASK_DURATIONS history
+        file or from buildstats directories, and reports the makespan of the
+        build with each scheduler. Tasks without a recorded duration use the
+        same estimate as the critical path scheduler.
+        """,
+    )
+    parser.add_argument("dotfile", help="task-depends.dot file to replay")
+    parser.add_argument("--history", help="Task durations history file (BB_TASK_DURATIONS)")
+    parser.add_argument(
+        "--buildstats", action="append", default=[], help="buildstats directory to read task durations from (may be repeated)"
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, action="append", help="Value of BB_NUMBER_THREADS to simulate (may be repeated, default: 8)"
+    )
+    parser.add_argument(
+        "-s",
+        "--scheduler",
+        action="append",
+        help="Schedulers to compare (default: all)",
+    )
+    parser.add_argument("--write-history", help="Save the durations used to a history file for BB_TASK_DURATIONS")
+
+    args = parser.parse_args()
+
+    depends, recipes = read_graph(args.dotfile)
+    if not depends:
+        print("No tasks found in %s" % args.dotfile)
+        return 1
+
+    history = {}
+    if args.history:
+        with open(args.history) as f:
+            history.update(json.load(f))
+    if args.buildstats:
+        history.update(read_buildstats(args.buildstats, recipes))
+    if not history:
+        print("No task durations found, use --history or --buildstats")
+        return 1
+
+    if args.write_history:
+        with open(args.write_history, "w") as f:
+            json.dump(history, f, sort_keys=True, indent=0)
+
+    schedulers = dict((obj.name, obj) for obj in vars(bb.runqueue).values()
+                      if type(obj) is type and issubclass(obj, bb.runqueue.RunQueueScheduler))
+    names = args.scheduler or sorted(schedulers)
+    for name in names:
+        if name not in schedulers:
+            print("Invalid scheduler '%s'. Available schedulers: %s" % (name, ", ".join(sorted(schedulers))))
+            return 1
+
+    # The schedulers only need stamp files to tell apart tasks that can't run together
+    bb.parse.siggen = types.SimpleNamespace(stampfile_mcfn=lambda taskname, taskfn, extrainfo=True: "%s:%s" % (taskfn, taskname))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as historyfile:
+        json.dump(history, historyfile)
+        historyfile.flush()
+
+        rq = SimulatedRunQueue(depends, recipes, historyfile.name, 1)
+        estimate = bb.runqueue.RunQueueSchedulerCriticalPath(rq, rq)
+        durations = estimate.estimate_durations(depends)
+        critical_path = max(estimate.rank.values())
+        total = sum(durations.values())
+        known = sum(1 for key in estimate.keys.values() if key in history)
+
+        print("%d tasks, %d with recorded durations, %.1fs total, %.1fs critical path" % (len(depends), known, total, critical_path))
+        print("%8s %12s %12s %12s %12s" % ("threads", "scheduler", "makespan", "lower bound", "utilisation"))
+        for threads in args.threads or [8]:
+            bound = max(critical_path, total / threads)
+            for name in names:
+                rq = SimulatedRunQueue(depends, recipes, historyfile.name, threads)
+                makespan = rq.simulate(schedulers[name], durations)
+                print("%8d %12s %12.1f %12.1f %11.1f%%" % (threads, name, makespan, bound, 100 * total / (makespan * threads)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
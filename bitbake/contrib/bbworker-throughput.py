@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: MIT
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake worker task throughput benchmark",
+        epilog="""
+        Builds the targets once for each value of BB_WORKER_ZYGOTES and
+        reports the number of tasks executed per second. Everything in TMPDIR
+        except the recipe cache is removed before each run so that the tasks
+        are restored from the shared state cache, which needs to be populated
+        by a previous build of the targets. Parsing isn't included in the
+        times reported.
+        """,
+    )
+    parser.add_argument("targets", nargs="+", help="Targets to build")
+    parser.add_argument(
+        "-z",
+        "--zygotes",
+        type=int,
+        action="append",
+        help="Value of BB_WORKER_ZYGOTES to measure (may be repeated, default: 0 and 16)",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="Number of runs for each value"
+    )
+    parser.add_argument(
+        "--tmpdir", default="tmp", help="TMPDIR of the build, relative to BUILDDIR (default: %(default)s)"
+    )
+
+    args = parser.parse_args()
+
+    if not "BUILDDIR" in os.environ:
+        print(
+            "'BUILDDIR' not found in the environment. Did you initialize the build environment?"
+        )
+        return 1
+
+    os.chdir(os.environ["BUILDDIR"])
+
+    env = os.environ.copy()
+    env["BB_ENV_PASSTHROUGH_ADDITIONS"] = " ".join(
+        [env.get("BB_ENV_PASSTHROUGH_ADDITIONS", ""), "BB_WORKER_ZYGOTES"]
+    )
+
+    started_re = re.compile(r"^NOTE: Executing (SetScene )?Tasks")
+    task_re = re.compile(r"^NOTE: Running (setscene )?task \d+ of \d+")
+
+    print("%8s %8s %10s %12s" % ("zygotes", "tasks", "seconds", "tasks/s"))
+    for zygotes in args.zygotes or [0, 16]:
+        for _ in range(args.repeat):
+            if os.path.isdir(args.tmpdir):
+                for entry in os.listdir(args.tmpdir):
+                    if entry != "cache":
+                        path = os.path.join(args.tmpdir, entry)
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.unlink(path)
+
+            env["BB_WORKER_ZYGOTES"] = str(zygotes)
+            output = []
+            tasks = 0
+            start_time = None
+            with subprocess.Popen(
+                ["bitbake"] + args.targets,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            ) as p:
+                for line in p.stdout:
+                    output.append(line)
+                    if start_time is None and started_re.match(line):
+                        start_time = time.monotonic()
+                    elif task_re.match(line):
+                        tasks += 1
+            elapsed = time.monotonic() - (start_time or time.monotonic())
+
+            if p.returncode != 0 or not start_time:
+                print("".join(output))
+                print("Run with %d zygotes exited with %d" % (zygotes, p.returncode))
+                return 1
+
+            print("%8d %8d %10.2f %12.1f" % (zygotes, tasks, elapsed, tasks / elapsed))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,9 +24,7 @@ import argparse
 
 # For importing bb.cache
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
-from bb.cache import CoreRecipeInfo
-
-import pickle
+from bb.cache import CoreRecipeInfo, IndexedCacheFile
 
 class DumpCache(object):
     def __init__(self):
@@ -45,14 +43,10 @@ class DumpCache(object):
         self.args = parser.parse_args()
 
     def main(self):
-        with open(self.args.cachefile[0], "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
-            while True:
-                try:
-                    key = pickled.load()
-                    val = pickled.load()
-                except Exception:
-                    break
+        cachefile = IndexedCacheFile(self.args.cachefile[0])
+        try:
+            for key in cachefile.index:
+                val = cachefile.load(key)
                 if isinstance(val, CoreRecipeInfo):
                     pn = val.pn
 
@@ -71,6 +65,8 @@ class DumpCache(object):
                         print("%s: %s" % (key, val.__dict__))
                 elif not self.args.recipe:
                     print("%s %s" % (key, val))
+        finally:
+            cachefile.close()
 
 if __name__ == "__main__":
     try:
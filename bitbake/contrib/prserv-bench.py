@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+
+import prserv.client
+import prserv.serv
+
+
+def synthetic_rows(count):
+    """
+    Rows looking like the ones of a real PR database: four checksums for each
+    version of a recipe, on two package architectures
+    """
+    for i in range(count):
+        yield (
+            "AUTOINC-recipe%d-1.0-r0" % (i // 4),
+            ("core2-64", "cortexa57")[(i // 2) % 2],
+            hashlib.sha256(str(i).encode("utf-8")).hexdigest(),
+            i % 2,
+        )
+
+
+def start_server(dbfile, sockname):
+    server = prserv.serv.PRServer(dbfile)
+    server.start_unix_server(sockname)
+    server.serve_as_process()
+    return server
+
+
+def connect(sockname):
+    client = prserv.client.PRClient()
+    client.connect_unix(sockname)
+    return client
+
+
+def report(name, rows, elapsed):
+    print("%-32s %10d %10.2f %12.0f" % (name, rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="PR service bulk import/export benchmark",
+        epilog="""
+        Imports a synthetic table into a new PR service database one row at a
+        time and in batches, exports it in a single reply and in batches,
+        then removes half of the rows and compacts the database while another
+        client keeps requesting PR values. Row by row imports are timed on a
+        sample of the rows.
+        """,
+    )
+    parser.add_argument("-n", "--rows", type=int, default=1000000, help="Number of rows (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=10000, help="Number of rows imported one at a time (default: %(default)s)")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000, help="Rows per import request (default: %(default)s)")
+    parser.add_argument("--keep", metavar="DIR", help="Create the database in DIR and keep it")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="prserv-bench") as tmpdir:
+        dbdir = args.keep or tmpdir
+        sockname = os.path.join(tmpdir, "sock")
+        rows = list(synthetic_rows(args.rows))
+
+        print("%-32s %10s %10s %12s" % ("operation", "rows", "seconds", "rows/s"))
+
+        dbfile = os.path.join(dbdir, "prserv-sample.sqlite3")
+        server = start_server(dbfile, sockname)
+        with connect(sockname) as client:
+            start_time = time.monotonic()
+            for row in rows[:args.sample]:
+                client.importone(*row)
+            report("import-one", args.sample, time.monotonic() - start_time)
+        server.process.terminate()
+        server.process.join()
+
+        dbfile = os.path.join(dbdir, "prserv.sqlite3")
+        server = start_server(dbfile, sockname)
+        with connect(sockname) as client:
+            start_time = time.monotonic()
+            for i in range(0, len(rows), args.batch_size):
+                conflicts = client.importmany(rows[i:i + args.batch_size])
+                if conflicts:
+                    print("Import of %d rows failed" % len(conflicts))
+                    return 1
+            report("import-many", len(rows), time.monotonic() - start_time)
+
+            start_time = time.monotonic()
+            _, datainfo = client.export(None, None, None, False)
+            report("export", len(datainfo), time.monotonic() - start_time)
+
+            start_time = time.monotonic()
+            count = sum(1 for _ in client.export_iter(None, None, None))
+            report("export-batch", count, time.monotonic() - start_time)
+        server.process.terminate()
+        server.process.join()
+
+        # Remove half of the rows behind the server's back to leave free
+        # pages in the database
+        with sqlite3.connect(dbfile) as conn:
+            conn.execute("DELETE FROM PRMAIN_nohist WHERE rowid <= ?;", (len(rows) // 2,))
+        conn.close()
+
+        server = start_server(dbfile, sockname)
+        with connect(sockname) as client:
+            latencies = []
+            done = threading.Event()
+
+            def get_pr():
+                with connect(sockname) as getpr_client:
+                    i = 0
+                    while not done.is_set():
+                        start_time = time.monotonic()
+                        getpr_client.getPR("bench-%d" % (i % 100), "core2-64", str(i))
+                        latencies.append(time.monotonic() - start_time)
+                        i += 1
+
+            size = os.path.getsize(dbfile)
+            thread = threading.Thread(target=get_pr)
+            thread.start()
+            try:
+                result = client.compact()
+            finally:
+                done.set()
+                thread.join()
+
+            print()
+            print("compact: freed %d pages (%.1f MiB -> %.1f MiB) in %.2fs" % (
+                result["freed_pages"], size / 1048576, os.path.getsize(dbfile) / 1048576, result["seconds"]))
+            latencies.sort()
+            if latencies:
+                print("get-pr during compact: %d requests, p50 %.2fms, max %.2fms" % (
+                    len(latencies), latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+        server.process.terminate()
+        server.process.join()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
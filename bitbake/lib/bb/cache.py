@@ -17,18 +17,23 @@
 #
 
 import os
+import copyreg
+import io
 import logging
+import mmap
 import pickle
+import struct
 from collections import defaultdict
-from collections.abc import Mapping
+from collections.abc import Mapping, MutableMapping
 import bb.utils
 from bb import PrefixLoggerAdapter
 import re
 import shutil
+import time
 
 logger = logging.getLogger("BitBake.Cache")
 
-__cache_version__ = "155"
+__cache_version__ = "159"
 
 def getCacheFile(path, filename, mc, data_hash):
     mcspec = ''
@@ -132,6 +137,14 @@ class CoreRecipeInfo(RecipeInfoCommon):
         self.fakerootnoenv    = self.getvar('FAKEROOTNOENV', metadata)
         self.extradepsfunc    = self.getvar('calculate_extra_depends', metadata)
 
+    def cache_meta(self):
+        """
+        The fields needed to check whether the entry is still valid, stored
+        in the index of the cache file so checking doesn't decode the entry
+        """
+        return (self.timestamp, self.file_depends, getattr(self, "file_checksums", None),
+                self.appends, self.variants)
+
     @classmethod
     def init_cacheData(cls, cachedata):
         # CacheData in Core RecipeInfo Class
@@ -239,6 +252,34 @@ class CoreRecipeInfo(RecipeInfoCommon):
         cachedata.extradepsfunc[fn] = self.extradepsfunc
 
 
+class PendingCacheData(dict):
+    """
+    CacheData field whose values are only added once they are looked up,
+    from the loaders of the cache entries in pending
+    """
+    def __init__(self, cachedata, pending):
+        super().__init__()
+        self.cachedata = cachedata
+        self.pending = pending
+
+    def __missing__(self, fn):
+        try:
+            loader = self.pending.pop(fn)
+        except KeyError:
+            raise KeyError(fn) from None
+        loader().add_cacheData(self.cachedata, fn)
+        return self[fn]
+
+    def __contains__(self, fn):
+        return super().__contains__(fn) or fn in self.pending
+
+    def get(self, fn, default=None):
+        try:
+            return self[fn]
+        except KeyError:
+            return default
+
+
 class SiggenRecipeInfo(RecipeInfoCommon):
     __slots__ = ()
 
@@ -254,15 +295,24 @@ class SiggenRecipeInfo(RecipeInfoCommon):
 
     @classmethod
     def init_cacheData(cls, cachedata):
-        cachedata.siggen_taskdeps = {}
-        cachedata.siggen_gendeps = {}
-        cachedata.siggen_varvals = {}
+        # Entries loaded from the cache are only decoded when the task
+        # signatures of the recipe are needed
+        pending = {}
+        cachedata.siggen_taskdeps = PendingCacheData(cachedata, pending)
+        cachedata.siggen_gendeps = PendingCacheData(cachedata, pending)
+        cachedata.siggen_varvals = PendingCacheData(cachedata, pending)
 
     def add_cacheData(self, cachedata, fn):
         cachedata.siggen_gendeps[fn] = self.siggen_gendeps
         cachedata.siggen_varvals[fn] = self.siggen_varvals
         cachedata.siggen_taskdeps[fn] = self.siggen_taskdeps
 
+    @classmethod
+    def add_lazy_cacheData(cls, cachedata, fn, loader):
+        for field in (cachedata.siggen_gendeps, cachedata.siggen_varvals, cachedata.siggen_taskdeps):
+            dict.pop(field, fn, None)
+        cachedata.siggen_varvals.pending[fn] = loader
+
     # The siggen variable data is large and impacts:
     #  - bitbake's overall memory usage
     #  - the amount of data sent over IPC between parsing processes and the server
@@ -337,6 +387,25 @@ class SiggenRecipeInfo(RecipeInfoCommon):
         for key in ["siggen_gendeps", "siggen_taskdeps", "siggen_varvals"]:
             setattr(self, key, self._restore(state[key], pid))
 
+    def reduce_table(self, table):
+        """
+        Reduce the object for writing to an indexed cache file, with the
+        values stored in table
+        """
+        state = {}
+        for key in ["siggen_gendeps", "siggen_taskdeps", "siggen_varvals"]:
+            deps = self.__dict__[key]
+            if deps:
+                deps = {dep: table.ref(fs) for dep, fs in deps.items()}
+            state[key] = deps
+        return (restore_siggen_info, (state,))
+
+def restore_siggen_info(state):
+    info = SiggenRecipeInfo.__new__(SiggenRecipeInfo)
+    for key, deps in state.items():
+        setattr(info, key, deps)
+    return info
+
 
 def virtualfn2realfn(virtualfn):
     """
@@ -378,6 +447,316 @@ def variant2virtual(realfn, variant):
         return "mc:" + elems[1] + ":" + realfn
     return "virtual:" + variant + ":" + realfn
 
+#
+# On disk, each cache class is stored in its own indexed file:
+#
+#   header:  magic, offset and length of the index
+#   records: one independently pickled RecipeInfoCommon per key
+#   table:   pickled {number: value} of the values shared by the records
+#   index:   pickled [cache version, bitbake version, {key: (offset, length, meta)},
+#                     extra, (table offset, table length, table size, table base)]
+#
+# meta holds the fields of CoreRecipeInfo needed to check whether an entry is
+# still valid, so checking the cache only reads the index. extra is optional
+# metadata about the whole file, such as the reverse dependency index stored
+# alongside CoreRecipeInfo. The table holds the SiggenRecipeInfo values, which
+# are largely the same across recipes, so they are stored once per file and the
+# records refer to them through pickle persistent ids.
+#
+# The file is memory mapped when loaded. CoreRecipeInfo records are unpickled
+# when the recipe is loaded from the cache and the records of the other cache
+# classes when their data is first used, e.g. SiggenRecipeInfo when the task
+# signatures of the recipe are computed.
+#
+CACHE_MAGIC = b"BBCACHE1"
+CACHE_HEADER = struct.Struct("<8sQQ")
+
+class TableRef(object):
+    __slots__ = ("mapnum",)
+
+    def __init__(self, mapnum):
+        self.mapnum = mapnum
+
+class TablePickler(pickle.Pickler):
+    """
+    Pickler saving the SiggenRecipeInfo values to a CacheValueTable
+    """
+    def __init__(self, f, table):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table[SiggenRecipeInfo] = lambda info: info.reduce_table(table)
+
+    def persistent_id(self, obj):
+        if type(obj) is TableRef:
+            return obj.mapnum
+        return None
+
+class TableUnpickler(pickle.Unpickler):
+    def __init__(self, data, cachefile):
+        super().__init__(io.BytesIO(data))
+        self.cachefile = cachefile
+
+    def persistent_load(self, pid):
+        return self.cachefile.table[pid]
+
+class IndexedCacheFile(object):
+    """
+    Read only view of an indexed cache file, decoding records on demand
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}
+        self.extra = {}
+        self.map = None
+
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < CACHE_HEADER.size:
+                raise ValueError("%s is truncated" % filename)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, offset, length = CACHE_HEADER.unpack_from(self.map, 0)
+        if magic != CACHE_MAGIC or offset + length > self.size:
+            self.close()
+            raise ValueError("%s is not an indexed cache file" % filename)
+
+        self.cache_version, self.bitbake_version, self.index, self.extra, table = pickle.loads(self.map[offset:offset + length])
+        self.table_offset, self.table_length, self.table_size, self.table_base = table
+        self._table = None
+
+    @property
+    def table(self):
+        """
+        The values shared by the records, loaded with the first record
+        needing them
+        """
+        if self._table is None:
+            self._table = {}
+            if self.table_length:
+                values = pickle.loads(self.map[self.table_offset:self.table_offset + self.table_length])
+                for mapnum, fs in values.items():
+                    self._table[mapnum] = SiggenRecipeInfo.store.setdefault(fs, fs)
+        return self._table
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def raw(self, key):
+        offset, length, _ = self.index[key]
+        return self.map[offset:offset + length]
+
+    def meta(self, key):
+        return self.index[key][2]
+
+    def load(self, key):
+        value = TableUnpickler(self.raw(key), self).load()
+        if not isinstance(value, RecipeInfoCommon):
+            raise ValueError("%s from %s is not a RecipeInfoCommon class?" % (key, self.filename))
+        return value
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    @staticmethod
+    def write(filename, records, extra=None, table=None):
+        """
+        Write an indexed cache file from an iterable of (key, pickled data,
+        meta) tuples, the CacheValueTable the records were saved with and
+        optional extra metadata. The file is replaced atomically so any
+        existing mapping of the previous version remains valid.
+        """
+        index = {}
+        tableinfo = (0, 0, 0, 0)
+        tmpname = "%s.%s.tmp" % (filename, os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(bytes(CACHE_HEADER.size))
+            offset = CACHE_HEADER.size
+            for key, data, meta in records:
+                f.write(data)
+                index[key] = (offset, len(data), meta)
+                offset += len(data)
+            if table is not None and table.values:
+                data = pickle.dumps(table.values, pickle.HIGHEST_PROTOCOL)
+                f.write(data)
+                tableinfo = (offset, len(data), len(table.values), table.base)
+                offset += len(data)
+            data = pickle.dumps([__cache_version__, bb.__version__, index, extra or {}, tableinfo], pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+            f.seek(0)
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, offset, len(data)))
+        os.replace(tmpname, filename)
+
+class CacheValueTable(object):
+    """
+    Values shared by the records written to an indexed cache file
+    """
+    def __init__(self):
+        self.values = {}
+        self.numbers = {}
+        # Number of values when the table was last started again. Values
+        # only used by replaced records stay in the table, so it is started
+        # again once it has doubled in size.
+        self.base = 0
+
+    def start(self, values, base):
+        self.values = dict(values)
+        self.numbers = {fs: mapnum for mapnum, fs in self.values.items()}
+        self.base = base
+
+    def ref(self, fs):
+        if fs is None:
+            return None
+        mapnum = self.numbers.get(fs)
+        if mapnum is None:
+            mapnum = len(self.values) + 1
+            self.values[mapnum] = fs
+            self.numbers[fs] = mapnum
+        return TableRef(mapnum)
+
+    def dumps(self, info):
+        f = io.BytesIO()
+        TablePickler(f, self).dump(info)
+        return f.getvalue()
+
+class LazyRecipeInfo(object):
+    """
+    Record of an indexed cache file decoded when its data is first used
+    """
+    def __init__(self, cachefile, key, cache_class):
+        self.cachefile = cachefile
+        self.key = key
+        self.cache_class = cache_class
+        self.info = None
+
+    def load(self):
+        if self.info is None:
+            self.info = self.cachefile.load(self.key)
+        return self.info
+
+    def add_cacheData(self, cachedata, fn):
+        if hasattr(self.cache_class, "add_lazy_cacheData"):
+            self.cache_class.add_lazy_cacheData(cachedata, fn, self.load)
+        else:
+            self.load().add_cacheData(cachedata, fn)
+
+class LazyRecipeInfoCache(MutableMapping):
+    """
+    Mapping of filename to a list of RecipeInfoCommon objects (one per
+    cache class) backed by indexed cache files. The first object of an
+    entry is decoded when the entry is looked up and the others when their
+    data is used. Unmodified entries are written back without being decoded
+    at all.
+    """
+    def __init__(self, cachefiles=None, cache_classes=None):
+        self.cachefiles = cachefiles or []
+        self.cache_classes = cache_classes or [None] * len(self.cachefiles)
+        self.entries = {}
+        self.ondisk = set()
+        for cachefile in self.cachefiles:
+            self.ondisk.update(cachefile.index)
+
+    def __getitem__(self, key):
+        try:
+            return self.entries[key]
+        except KeyError:
+            if key not in self.ondisk:
+                raise
+        value = []
+        for cachefile, cache_class in zip(self.cachefiles, self.cache_classes):
+            if key not in cachefile:
+                continue
+            if value:
+                value.append(LazyRecipeInfo(cachefile, key, cache_class))
+            else:
+                value.append(cachefile.load(key))
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.entries.get(key) is not value:
+            self.ondisk.discard(key)
+        self.entries[key] = value
+
+    def __delitem__(self, key):
+        if key not in self.entries and key not in self.ondisk:
+            raise KeyError(key)
+        self.entries.pop(key, None)
+        self.ondisk.discard(key)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.ondisk
+
+    def __iter__(self):
+        yield from self.entries
+        for key in self.ondisk:
+            if key not in self.entries:
+                yield key
+
+    def __len__(self):
+        return len(self.ondisk.union(self.entries))
+
+    def count(self, key):
+        """
+        Return the number of cache classes holding an entry for key
+        """
+        if key in self.ondisk:
+            return sum(key in cachefile for cachefile in self.cachefiles)
+        return len(self.entries[key])
+
+    def meta(self, key):
+        """
+        Return the fields of the first object of an entry needed to check
+        whether it is still valid, without decoding it
+        """
+        if key in self.ondisk:
+            for cachefile in self.cachefiles:
+                if key in cachefile:
+                    return cachefile.meta(key)
+        return self.entries[key][0].cache_meta()
+
+    def records(self, classidx, cache_class, table):
+        """
+        Generate (key, pickled data, meta) tuples for the given cache class,
+        reusing the existing encoding of entries which haven't changed.
+        The values shared by the records are added to table, a
+        CacheValueTable to write along with them.
+        """
+        cache_class_name = cache_class.__name__
+        if classidx < len(self.cachefiles):
+            cachefile = self.cachefiles[classidx]
+        else:
+            cachefile = None
+
+        # The unchanged records refer to the values of the existing table,
+        # so it is kept unless it has grown too much
+        reuse = cachefile is not None and cachefile.table_size <= 2 * cachefile.table_base
+        if reuse:
+            table.start(cachefile.table, cachefile.table_base)
+
+        for key in self:
+            if key in self.ondisk:
+                if cachefile is not None and key in cachefile:
+                    if reuse:
+                        yield key, cachefile.raw(key), cachefile.meta(key)
+                    else:
+                        yield key, table.dumps(cachefile.load(key)), cachefile.meta(key)
+                continue
+            for info in self.entries[key]:
+                if isinstance(info, LazyRecipeInfo):
+                    info = info.load()
+                if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
+                    meta = info.cache_meta() if hasattr(info, "cache_meta") else None
+                    yield key, table.dumps(info), meta
+
+        if not reuse:
+            table.base = len(table.values)
+
+    def close(self):
+        for cachefile in self.cachefiles:
+            cachefile.close()
+
 #
 # Cooker calls cacheValid on its recipe list, then either calls loadCached
 # from it's main thread or parse from separate processes to generate an up to
@@ -400,7 +779,12 @@ class Cache(object):
         self.cachedir = self.data.getVar("CACHE")
         self.clean = set()
         self.checked = set()
-        self.depends_cache = {}
+        self.depends_cache = LazyRecipeInfoCache()
+        # Reverse dependency index, file -> {mtime: set(recipe filenames)}
+        self.revdeps = {}
+        self.revdeps_indexed = set()
+        self.revdeps_pending = {}
+        self.depends_changed = None
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
@@ -464,52 +848,37 @@ class Cache(object):
 
     def load_cachefile(self, progress):
         previous_progress = 0
+        cachefiles = []
+
+        def invalid(msg):
+            self.logger.info(msg)
+            for cachefile in cachefiles:
+                cachefile.close()
+            return 0
 
         for cache_class in self.caches_array:
             cachefile = self.getCacheFile(cache_class.cachefile)
             self.logger.debug('Loading cache file: %s' % cachefile)
-            with open(cachefile, "rb") as cachefile:
-                pickled = pickle.Unpickler(cachefile)
-                # Check cache version information
-                try:
-                    cache_ver = pickled.load()
-                    bitbake_ver = pickled.load()
-                except Exception:
-                    self.logger.info('Invalid cache, rebuilding...')
-                    return 0
-
-                if cache_ver != __cache_version__:
-                    self.logger.info('Cache version mismatch, rebuilding...')
-                    return 0
-                elif bitbake_ver != bb.__version__:
-                    self.logger.info('Bitbake version mismatch, rebuilding...')
-                    return 0
-
-                # Load the rest of the cache file
-                current_progress = 0
-                while cachefile:
-                    try:
-                        key = pickled.load()
-                        value = pickled.load()
-                    except Exception:
-                        break
-                    if not isinstance(key, str):
-                        bb.warn("%s from extras cache is not a string?" % key)
-                        break
-                    if not isinstance(value, RecipeInfoCommon):
-                        bb.warn("%s from extras cache is not a RecipeInfoCommon class?" % value)
-                        break
-
-                    if key in self.depends_cache:
-                        self.depends_cache[key].append(value)
-                    else:
-                        self.depends_cache[key] = [value]
-                    # only fire events on even percentage boundaries
-                    current_progress = cachefile.tell() + previous_progress
-                    progress(cachefile.tell() + previous_progress)
-
-                previous_progress += current_progress
-
+            try:
+                cachefile = IndexedCacheFile(cachefile)
+            except Exception:
+                return invalid('Invalid cache, rebuilding...')
+            cachefiles.append(cachefile)
+
+            # Check cache version information
+            if cachefile.cache_version != __cache_version__:
+                return invalid('Cache version mismatch, rebuilding...')
+            elif cachefile.bitbake_version != bb.__version__:
+                return invalid('Bitbake version mismatch, rebuilding...')
+
+            # Only the index is read here, the records are decoded on demand
+            previous_progress += cachefile.size
+            progress(previous_progress)
+
+        if "revdeps" in cachefiles[0].extra:
+            self.revdeps = cachefiles[0].extra["revdeps"]
+            self.revdeps_indexed = cachefiles[0].extra["indexed"]
+        self.depends_cache = LazyRecipeInfoCache(cachefiles, self.caches_array)
         return len(self.depends_cache)
 
     def parse(self, filename, appends, layername):
@@ -575,23 +944,35 @@ class Cache(object):
             self.logger.debug2("%s is not cached", fn)
             return False
 
-        mtime = bb.parse.cached_mtime_noerror(fn)
+        # Only the fields stored in the index are checked, without decoding
+        # the entry
+        timestamp, depends, file_checksums, cached_appends, variants = self.depends_cache.meta(fn)
+
+        if fn in self.revdeps_indexed:
+            # The recipe and its dependencies were covered by check_depends()
+            if self.depends_changed is None:
+                self.check_depends()
+            if fn in self.depends_changed:
+                self.logger.debug2("%s's dependency %s changed", fn, self.depends_changed[fn])
+                self.remove(fn)
+                return False
+            depends = None
+        else:
+            mtime = bb.parse.cached_mtime_noerror(fn)
 
-        # Check file still exists
-        if mtime == 0:
-            self.logger.debug2("%s no longer exists", fn)
-            self.remove(fn)
-            return False
+            # Check file still exists
+            if mtime == 0:
+                self.logger.debug2("%s no longer exists", fn)
+                self.remove(fn)
+                return False
 
-        info_array = self.depends_cache[fn]
-        # Check the file's timestamp
-        if mtime != info_array[0].timestamp:
-            self.logger.debug2("%s changed", fn)
-            self.remove(fn)
-            return False
+            # Check the file's timestamp
+            if mtime != timestamp:
+                self.logger.debug2("%s changed", fn)
+                self.remove(fn)
+                return False
 
         # Check dependencies are still valid
-        depends = info_array[0].file_depends
         if depends:
             for f, old_mtime in depends:
                 fmtime = bb.parse.cached_mtime_noerror(f)
@@ -608,8 +989,8 @@ class Cache(object):
                     self.remove(fn)
                     return False
 
-        if hasattr(info_array[0], 'file_checksums'):
-            for _, fl in info_array[0].file_checksums.items():
+        if file_checksums is not None:
+            for _, fl in file_checksums.items():
                 fl = fl.strip()
                 if not fl:
                     continue
@@ -625,26 +1006,26 @@ class Cache(object):
                         self.remove(fn)
                         return False
 
-        if tuple(appends) != tuple(info_array[0].appends):
+        if tuple(appends) != tuple(cached_appends):
             self.logger.debug2("appends for %s changed", fn)
-            self.logger.debug2("%s to %s" % (str(appends), str(info_array[0].appends)))
+            self.logger.debug2("%s to %s" % (str(appends), str(cached_appends)))
             self.remove(fn)
             return False
 
         invalid = False
-        for cls in info_array[0].variants:
+        for cls in variants:
             virtualfn = variant2virtual(fn, cls)
             self.clean.add(virtualfn)
             if virtualfn not in self.depends_cache:
                 self.logger.debug2("%s is not cached", virtualfn)
                 invalid = True
-            elif len(self.depends_cache[virtualfn]) != len(self.caches_array):
+            elif self.depends_cache.count(virtualfn) != len(self.caches_array):
                 self.logger.debug2("Extra caches missing for %s?" % virtualfn)
                 invalid = True
 
         # If any one of the variants is not present, mark as invalid for all
         if invalid:
-            for cls in info_array[0].variants:
+            for cls in variants:
                 virtualfn = variant2virtual(fn, cls)
                 if virtualfn in self.clean:
                     self.logger.debug2("Removing %s from cache", virtualfn)
@@ -657,6 +1038,52 @@ class Cache(object):
         self.clean.add(fn)
         return True
 
+    def check_depends(self):
+        """
+        Check whether any of the files recorded in the reverse dependency
+        index changed. Each file is only checked once no matter how many
+        recipes depend upon it and the recipes affected are recorded in
+        depends_changed along with the file responsible.
+        """
+        self.depends_changed = {}
+        changed = 0
+        for f, mtimes in self.revdeps.items():
+            fmtime = bb.parse.cached_mtime_noerror(f)
+            for old_mtime, fns in mtimes.items():
+                if fmtime == old_mtime:
+                    continue
+                changed += 1
+                for fn in fns:
+                    self.depends_changed.setdefault(fn, f)
+        if changed:
+            self.logger.debug("%d dependencies changed, affecting %d recipes", changed, len(self.depends_changed))
+
+    def update_revdeps(self):
+        """
+        Update the reverse dependency index to match the entries which will
+        be written out by sync()
+        """
+        keep = set(fn for fn in self.revdeps_indexed
+                   if fn in self.depends_cache and fn not in self.revdeps_pending)
+        revdeps = {}
+        for f, mtimes in self.revdeps.items():
+            for mtime, fns in mtimes.items():
+                if not fns <= keep:
+                    fns = fns & keep
+                if fns:
+                    revdeps.setdefault(f, {})[mtime] = fns
+
+        for fn, depends in self.revdeps_pending.items():
+            if fn in keep or fn not in self.depends_cache:
+                continue
+            for f, mtime in depends:
+                revdeps.setdefault(f, {}).setdefault(mtime, set()).add(fn)
+            keep.add(fn)
+
+        self.revdeps = revdeps
+        self.revdeps_indexed = keep
+        self.revdeps_pending = {}
+
     def remove(self, fn):
         """
         Remove a fn from the cache
@@ -678,24 +1105,32 @@ class Cache(object):
             self.logger.debug2("Cache is clean, not saving.")
             return
 
-        for cache_class in self.caches_array:
-            cache_class_name = cache_class.__name__
+        self.update_revdeps()
+
+        for classidx, cache_class in enumerate(self.caches_array):
             cachefile = self.getCacheFile(cache_class.cachefile)
+            extra = None
+            if cache_class is CoreRecipeInfo:
+                extra = {"revdeps": self.revdeps, "indexed": self.revdeps_indexed}
             self.logger.debug2("Writing %s", cachefile)
-            with open(cachefile, "wb") as f:
-                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
-                p.dump(__cache_version__)
-                p.dump(bb.__version__)
-
-                for key, info_array in self.depends_cache.items():
-                    for info in info_array:
-                        if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
-                            p.dump(key)
-                            p.dump(info)
-
-        del self.depends_cache
+            table = CacheValueTable()
+            IndexedCacheFile.write(cachefile, self.depends_cache.records(classidx, cache_class, table), extra, table)
+
+        # The entries are kept for the next parse and the cache files
+        # aren't closed as the entries not decoded yet are still read from
+        # them, the files written replace them atomically
+        self.cacheclean = True
         SiggenRecipeInfo.reset()
 
+    def start_check(self):
+        """
+        Check the entries again for a new parse, after files they may depend
+        upon changed
+        """
+        self.clean = set()
+        self.checked = set()
+        self.depends_changed = None
+
     @staticmethod
     def mtime(cachefile):
         return bb.parse.cached_mtime_noerror(cachefile)
@@ -720,6 +1155,10 @@ class Cache(object):
         if (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache:
             if parsed:
                 self.cacheclean = False
+                if filename == virtualfn2realfn(filename)[0]:
+                    depends = [(filename, info_array[0].timestamp)]
+                    depends.extend(info_array[0].file_depends or [])
+                    self.revdeps_pending[filename] = depends
             self.depends_cache[filename] = info_array
 
 class MulticonfigCache(Mapping):
@@ -748,6 +1187,8 @@ class MulticonfigCache(Mapping):
         previous_progress = 0
         previous_percent = 0
         self.__caches = {}
+        self.databuilder = databuilder
+        self.data_hash = data_hash
 
         for mc, mcdata in databuilder.mcdata.items():
             self.__caches[mc] = Cache(databuilder, mc, data_hash, caches_array)
@@ -829,8 +1270,18 @@ class MultiProcessCache(object):
     BitBake multi-process cache implementation
 
     Used by the codeparser & file checksum caches
+
+    Each process appends the entries it adds to the cache as a new segment
+    file next to the main cache file, without taking any lock, and readers
+    load the main file and all the segments. The segments are merged into
+    the main file once they're numerous or large enough compared to it.
     """
 
+    # Merge the segments into the main cache file once there are this many
+    # of them or they add up to this fraction of its size
+    COMPACT_SEGMENTS = 16
+    COMPACT_RATIO = 0.25
+
     def __init__(self):
         self.cachefile = None
         self.cachedata = self.create_cachedata()
@@ -845,27 +1296,51 @@ class MultiProcessCache(object):
                                       cache_file_name or self.__class__.cache_file_name)
         logger.debug("Using cache in '%s'", self.cachefile)
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        data = self.load_file(self.cachefile)
+        if data is None:
+            data = self.create_cachedata()
+        for segment in self.segments():
+            extradata = self.load_file(segment)
+            if extradata is not None:
+                self.merge_data(extradata, data)
 
+        self.cachedata = data
+
+    def create_cachedata(self):
+        data = [{}]
+        return data
+
+    def load_file(self, f):
         try:
-            with open(self.cachefile, "rb") as f:
-                p = pickle.Unpickler(f)
+            with open(f, "rb") as fd:
+                p = pickle.Unpickler(fd)
                 data, version = p.load()
         except:
-            bb.utils.unlockfile(glf)
-            return
-
-        bb.utils.unlockfile(glf)
+            return None
 
         if version != self.__class__.CACHE_VERSION:
-            return
+            return None
 
-        self.cachedata = data
-
-    def create_cachedata(self):
-        data = [{}]
         return data
 
+    def write_file(self, f, data):
+        # Write to a temporary file renamed into place so readers never see
+        # a partial file
+        dirname, basename = os.path.split(f)
+        tmpname = os.path.join(dirname, ".%s.%d.%d" % (basename, os.getpid(), time.time_ns()))
+        try:
+            with open(tmpname, "xb") as fd:
+                p = pickle.Pickler(fd, -1)
+                p.dump([data, self.__class__.CACHE_VERSION])
+            os.rename(tmpname, f)
+        except:
+            bb.utils.remove(tmpname)
+            raise
+
+    def segments(self):
+        dirname, basename = os.path.split(self.cachefile)
+        return sorted(os.path.join(dirname, f) for f in os.listdir(dirname) if f.startswith(basename + "-"))
+
     def save_extras(self):
         if not self.cachefile:
             return
@@ -874,25 +1349,12 @@ class MultiProcessCache(object):
         if not have_data:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
-
-        i = os.getpid()
-        lf = None
-        while not lf:
-            lf = bb.utils.lockfile(self.cachefile + ".lock." + str(i), retry=False)
-            if not lf or os.path.exists(self.cachefile + "-" + str(i)):
-                if lf:
-                    bb.utils.unlockfile(lf)
-                    lf = None
-                i = i + 1
-                continue
+        self.write_file("%s-%d-%d" % (self.cachefile, os.getpid(), time.time_ns()), self.cachedata_extras)
 
-            with open(self.cachefile + "-" + str(i), "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([self.cachedata_extras, self.__class__.CACHE_VERSION])
-
-        bb.utils.unlockfile(lf)
-        bb.utils.unlockfile(glf)
+        # The entries are saved, don't write them into the next segment
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        for extras in self.cachedata_extras:
+            extras.clear()
 
     def merge_data(self, source, dest):
         for j in range(0,len(dest)):
@@ -900,40 +1362,52 @@ class MultiProcessCache(object):
                 if h not in dest[j]:
                     dest[j][h] = source[j][h]
 
+    def needs_compaction(self, segments):
+        if len(segments) >= self.COMPACT_SEGMENTS:
+            return True
+        try:
+            size = os.path.getsize(self.cachefile)
+        except OSError:
+            return bool(segments)
+        segsize = 0
+        for f in segments:
+            try:
+                segsize += os.path.getsize(f)
+            except OSError:
+                pass
+        return segsize > size * self.COMPACT_RATIO
+
     def save_merge(self):
         if not self.cachefile:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock")
-
-        data = self.cachedata
-
-        have_data = False
-
-        for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
-            f = os.path.join(os.path.dirname(self.cachefile), f)
-            try:
-                with open(f, "rb") as fd:
-                    p = pickle.Unpickler(fd)
-                    extradata, version = p.load()
-            except (IOError, EOFError):
-                os.unlink(f)
-                continue
-
-            if version != self.__class__.CACHE_VERSION:
-                os.unlink(f)
-                continue
-
-            have_data = True
-            self.merge_data(extradata, data)
-            os.unlink(f)
+        segments = self.segments()
+        if not self.needs_compaction(segments):
+            return
 
-        if have_data:
-            with open(self.cachefile, "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([data, self.__class__.CACHE_VERSION])
+        # Another process is already merging the segments
+        glf = bb.utils.lockfile(self.cachefile + ".lock", retry=False)
+        if not glf:
+            return
 
-        bb.utils.unlockfile(glf)
+        try:
+            data = self.load_file(self.cachefile)
+            if data is None:
+                data = self.create_cachedata()
+
+            # Invalid segments are removed along with the merged ones and
+            # segments added after this point are left for the next merge
+            segments = self.segments()
+            for f in segments:
+                extradata = self.load_file(f)
+                if extradata is not None:
+                    self.merge_data(extradata, data)
+
+            self.write_file(self.cachefile, data)
+            for f in segments:
+                bb.utils.remove(f)
+        finally:
+            bb.utils.unlockfile(glf)
 
 
 class SimpleCache(object):
@@ -30,6 +30,7 @@ import logging
 import inspect
 import bb.pysh as pysh
 import bb.utils, bb.data
+import bb.methodpool
 import hashlib
 from itertools import chain
 from bb.pysh import pyshyacc, pyshlex
@@ -204,12 +205,15 @@ codeparsercache = CodeParserCache()
 
 def parser_cache_init(cachedir):
     codeparsercache.init_cache(cachedir)
+    bb.methodpool.compile_cache_init(cachedir)
 
 def parser_cache_save():
     codeparsercache.save_extras()
+    bb.methodpool.compile_cache_save()
 
 def parser_cache_savemerge():
     codeparsercache.save_merge()
+    bb.methodpool.compile_cache_savemerge()
 
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
@@ -263,6 +263,11 @@ class CommandsSync:
     getUIHandlerNum.needconfig = False
     getUIHandlerNum.readonly = True
 
+    def getUIHandlerStats(self, command, params):
+        return bb.event.get_uihandler_stats()
+    getUIHandlerStats.needconfig = False
+    getUIHandlerStats.readonly = True
+
     def setEventMask(self, command, params):
         handlerNum = params[0]
         llevel = params[1]
@@ -24,7 +24,12 @@ class ZstdFile(bb.compress._pipecompress.PipeFile):
         return ["pzstd", "-p", "%d" % self.num_threads]
 
     def get_compress(self):
-        return self._get_zstd() + ["-c", "-%d" % self.compresslevel]
+        zstd = self._get_zstd()
+        if zstd == ["zstd"] and self.num_threads != 1:
+            # zstd compresses with several threads too, only pzstd
+            # decompresses with several threads
+            zstd.append("-T%d" % self.num_threads)
+        return zstd + ["-c", "-%d" % self.compresslevel]
 
     def get_decompress(self):
         return self._get_zstd() + ["-d", "-c"]
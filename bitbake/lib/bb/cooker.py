@@ -17,7 +17,7 @@ import threading
 from io import StringIO, UnsupportedOperation
 from contextlib import closing
 from collections import defaultdict, namedtuple
-import bb, bb.exceptions, bb.command
+import bb, bb.exceptions, bb.command, bb.eventlog
 from bb import utils, data, parse, event, cache, providers, taskdata, runqueue, build
 import queue
 import signal
@@ -105,21 +105,56 @@ class EventWriter:
         self.cooker = cooker
         self.eventfile = eventfile
         self.event_queue = []
+        self.eventlog = None
+        if bb.eventlog.is_eventlog(eventfile):
+            self.eventlog = bb.eventlog.EventLogWriter(eventfile)
 
     def write_variables(self):
+        variables = self.cooker.getAllKeysWithFlags(["doc", "func"])
+        if self.eventlog:
+            self.eventlog.write(bb.eventlog.VARIABLES, pickle.dumps(variables))
+            return
         with open(self.eventfile, "a") as f:
-            f.write("%s\n" % json.dumps({ "allvariables" : self.cooker.getAllKeysWithFlags(["doc", "func"])}))
+            f.write("%s\n" % json.dumps({ "allvariables" : variables}))
+
+    def flush(self):
+        if self.eventlog:
+            self.eventlog.flush()
 
     def send(self, event):
+        self.sendevent(event, pickle.dumps(event))
+
+    def sendevent(self, event, pickled):
+        if self.eventlog:
+            try:
+                self.write_eventlog(event, pickled)
+            except Exception as err:
+                import traceback
+                print(err, traceback.format_exc())
+            return
+
         with open(self.eventfile, "a") as f:
             try:
-                str_event = codecs.encode(pickle.dumps(event), 'base64').decode('utf-8')
+                str_event = codecs.encode(pickled, 'base64').decode('utf-8')
                 f.write("%s\n" % json.dumps({"class": event.__module__ + "." + event.__class__.__name__,
                                              "vars": str_event}))
             except Exception as err:
                 import traceback
                 print(err, traceback.format_exc())
 
+    def write_eventlog(self, event, pickled):
+        name = event.__module__ + "." + event.__class__.__name__
+        # Index the task the event is about, some runqueue events like
+        # sceneQueueComplete aren't about a task
+        task = None
+        if isinstance(event, runqueue.runQueueEvent):
+            task = getattr(event, "taskid", None)
+        elif isinstance(event, build.TaskBase):
+            task = runqueue.build_tid(event._mc, event._fn, event._task)
+        self.eventlog.write(name, pickled, task)
+        if isinstance(event, (bb.command.CommandCompleted, bb.command.CommandExit, CookerExit)):
+            self.eventlog.flush()
+
 
 #============================================================================#
 # BBCooker
@@ -183,6 +218,8 @@ class BBCooker:
         self.state = state.initial
 
         self.parser = None
+        # The recipe caches of the last parse, see CookerParser
+        self.parsecaches = None
 
         signal.signal(signal.SIGTERM, self.sigterm_exception)
         # Let SIGHUP exit as SIGTERM
@@ -396,6 +433,7 @@ class BBCooker:
     def setupEventLog(self, eventlog):
         if self.eventlog and self.eventlog[0] != eventlog:
             bb.event.unregister_UIHhandler(self.eventlog[1])
+            self.eventlog[2].flush()
             self.eventlog = None
         if not self.eventlog or self.eventlog[0] != eventlog:
             # we log all events to a file if so directed
@@ -1626,6 +1664,10 @@ class BBCooker:
             for dirent in searchdirs:
                 self.add_filewatch([(dirent, bb.parse.cached_mtime_noerror(dirent))])
 
+            if self.parser and self.parser.syncthread:
+                # The caches of the last parse may be reused once saved
+                self.parser.syncthread.join()
+
             self.parser = CookerParser(self, mcfilelist, total_masked)
             self._parsecache_set(True)
 
@@ -1993,14 +2035,26 @@ class ParsingFailure(Exception):
         Exception.__init__(self, realexception, recipe)
 
 class Parser(multiprocessing.Process):
-    def __init__(self, jobs, results, quit, profile):
+    # Results are sent back to the server in batches to reduce the per message
+    # overhead on the shared result queue. A batch is sent when it is full,
+    # when it has been pending for longer than the interval or when an
+    # exception needs to be reported. BB_PARSE_RESULT_BATCH_SIZE and
+    # BB_PARSE_RESULT_BATCH_INTERVAL override the defaults.
+    RESULT_BATCH_SIZE = 32
+    RESULT_BATCH_INTERVAL = 0.1
+
+    def __init__(self, jobs, results, quit, profile, batch_size=RESULT_BATCH_SIZE, batch_interval=RESULT_BATCH_INTERVAL):
         self.jobs = jobs
         self.results = results
         self.quit = quit
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
         multiprocessing.Process.__init__(self)
         self.context = bb.utils.get_context().copy()
         self.handlers = bb.event.get_class_handlers().copy()
         self.profile = profile
+        # Override resolution statistics for each recipe parsed when profiling
+        self.overridestats = []
         self.queue_signals = False
         self.signal_received = []
         self.signal_threadlock = threading.Lock()
@@ -2034,6 +2088,10 @@ class Parser(multiprocessing.Process):
         finally:
             logfile = "profile-parse-%s.log" % multiprocessing.current_process().name
             prof.dump_stats(logfile)
+            logfile = "profile-parse-overrides-%s.log" % multiprocessing.current_process().name
+            with open(logfile, "w") as f:
+                for filename, stats in self.overridestats:
+                    f.write("%.6f %d %d %s\n" % (stats["time"], stats["lookups"], stats["resolved"], filename))
 
     def realrun(self):
         # Signal handling here is hard. We must not terminate any process or thread holding the write
@@ -2052,6 +2110,8 @@ class Parser(multiprocessing.Process):
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
 
         pending = []
+        flush = False
+        lastsent = time.monotonic()
         havejobs = True
         try:
             while havejobs or pending:
@@ -2068,13 +2128,18 @@ class Parser(multiprocessing.Process):
                     # Clear the siggen cache after parsing to control memory usage, its huge
                     bb.parse.siggen.postparsing_clean_cache()
                     pending.append(result)
+                    if isinstance(result[2], BaseException):
+                        flush = True
 
-                if pending:
+                if pending and (flush or not havejobs or len(pending) >= self.batch_size or
+                                time.monotonic() - lastsent > self.batch_interval):
                     try:
-                        result = pending.pop()
-                        self.results.put(result, timeout=0.05)
+                        self.results.put(pending, timeout=0.05)
+                        pending = []
+                        flush = False
+                        lastsent = time.monotonic()
                     except queue.Full:
-                        pending.append(result)
+                        pass
         finally:
             self.results.close()
             self.results.join_thread()
@@ -2093,6 +2158,10 @@ class Parser(multiprocessing.Process):
             bb.event.set_class_handlers(self.handlers.copy())
             bb.event.LogHandler.filter = parse_filter
 
+            if self.profile:
+                stats = cache.databuilder.mcdata[mc].enableOverrideStats()
+                self.overridestats.append((filename, stats))
+
             return True, mc, cache.parse(filename, appends, layername)
         except Exception as exc:
             tb = sys.exc_info()[2]
@@ -2127,7 +2196,18 @@ class CookerParser(object):
         self.current = 0
         self.process_names = []
 
-        self.bb_caches = bb.cache.MulticonfigCache(self.cfgbuilder, self.cfghash, cooker.caches_array)
+        caches = cooker.parsecaches
+        if caches and caches.databuilder is self.cfgbuilder and caches.data_hash == self.cfghash:
+            # Only files the recipes depend upon changed since the last parse.
+            # The recipes are checked against the entries kept in memory, so
+            # only the recipes depending on the changed files, found through
+            # the reverse dependency index, are reparsed.
+            self.bb_caches = caches
+            for mc in self.cooker.multiconfigs:
+                self.bb_caches[mc].start_check()
+        else:
+            self.bb_caches = bb.cache.MulticonfigCache(self.cfgbuilder, self.cfghash, cooker.caches_array)
+            cooker.parsecaches = self.bb_caches
         self.fromcache = set()
         self.willparse = set()
         for mc in self.cooker.multiconfigs:
@@ -2145,11 +2225,16 @@ class CookerParser(object):
 
         self.num_processes = min(int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS") or
                                  multiprocessing.cpu_count()), self.toparse)
+        self.result_batch_size = max(int(self.cfgdata.getVar("BB_PARSE_RESULT_BATCH_SIZE") or
+                                         Parser.RESULT_BATCH_SIZE), 1)
+        self.result_batch_interval = float(self.cfgdata.getVar("BB_PARSE_RESULT_BATCH_INTERVAL") or
+                                           Parser.RESULT_BATCH_INTERVAL)
 
         bb.cache.SiggenRecipeInfo.reset()
         self.start()
         self.haveshutdown = False
         self.syncthread = None
+        self.mergethread = None
 
     def start(self):
         self.results = self.load_cached()
@@ -2165,7 +2250,8 @@ class CookerParser(object):
             self.jobs = chunkify(list(self.willparse), self.num_processes)
 
             for i in range(0, self.num_processes):
-                parser = Parser(self.jobs[i], self.result_queue, self.parser_quit, self.cooker.configuration.profile)
+                parser = Parser(self.jobs[i], self.result_queue, self.parser_quit, self.cooker.configuration.profile,
+                                self.result_batch_size, self.result_batch_interval)
                 parser.start()
                 self.process_names.append(parser.name)
                 self.processes.append(parser)
@@ -2208,8 +2294,12 @@ class CookerParser(object):
 
         self.parser_quit.set()
 
+        # Profiled parsers need time to write out their statistics
+        timeout = 0.5
+        if self.cooker.configuration.profile:
+            timeout = 60
         for process in self.processes:
-            process.join(0.5)
+            process.join(timeout)
 
         for process in self.processes:
             if process.exitcode is None:
@@ -2229,9 +2319,16 @@ class CookerParser(object):
                 process.close()
 
         bb.codeparser.parser_cache_save()
-        bb.codeparser.parser_cache_savemerge()
         bb.cache.SiggenRecipeInfo.reset()
-        bb.fetch.fetcher_parse_done()
+
+        # Merging the segments of the persistent caches rewrites them, which
+        # can take a while on big caches
+        def merge_caches():
+            bb.codeparser.parser_cache_savemerge()
+            bb.fetch.fetcher_parse_done()
+
+        self.mergethread = threading.Thread(target=merge_caches, name="CacheMergeThread")
+        self.mergethread.start()
         if self.cooker.configuration.profile:
             profiles = []
             for i in self.process_names:
@@ -2243,9 +2340,26 @@ class CookerParser(object):
             bb.utils.process_profilelog(profiles, pout = pout)
             print("Processed parsing statistics saved to %s" % (pout))
 
+            overridestats = []
+            for i in self.process_names:
+                logfile = "profile-parse-overrides-%s.log" % i
+                if os.path.exists(logfile):
+                    with open(logfile) as f:
+                        overridestats.extend(line.split(None, 3) for line in f)
+            overridestats.sort(key=lambda s: float(s[0]), reverse=True)
+
+            pout = "profile-parse-overrides.log.processed"
+            with open(pout, "w") as f:
+                f.write("%10s %10s %10s  %s\n" % ("time (s)", "lookups", "resolved", "recipe"))
+                for stats in overridestats:
+                    f.write("%10s %10s %10s  %s" % tuple(stats))
+            print("Override resolution statistics saved to %s" % (pout))
+
     def final_cleanup(self):
         if self.syncthread:
             self.syncthread.join()
+        if self.mergethread:
+            self.mergethread.join()
 
     def load_cached(self):
         for mc, cache, filename, appends, layername in self.fromcache:
@@ -2264,13 +2378,14 @@ class CookerParser(object):
                 break
 
             try:
-                result = self.result_queue.get(timeout=0.25)
+                results = self.result_queue.get(timeout=0.25)
             except queue.Empty:
                 empty = True
                 yield None, None, None
             else:
                 empty = False
-                yield result
+                # Results arrive from the parser processes in batches
+                yield from results
 
         if not (self.parsed >= self.toparse):
             raise bb.parse.ParseError("Not all recipes parsed, parser thread killed/died? Exiting.", None)
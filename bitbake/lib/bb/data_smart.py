@@ -20,10 +20,11 @@ import builtins
 import copy
 import re
 import sys
+import time
 from collections.abc import MutableMapping
 import logging
 import hashlib
-import bb, bb.codeparser
+import bb, bb.codeparser, bb.methodpool
 from bb   import utils
 from bb.COW  import COWDictBase
 
@@ -132,7 +133,10 @@ class VariableParse:
                 varname = 'Var <%s>' % self.varname
             else:
                 varname = '<expansion>'
-            codeobj = compile(code.strip(), varname, "eval")
+            codeobj = bb.methodpool.compile_cache(code, varname, "eval")
+            if codeobj is None:
+                codeobj = compile(code.strip(), varname, "eval")
+                bb.methodpool.compile_cache_add(code, codeobj, varname, "eval")
 
             parser = bb.codeparser.PythonParser(self.varname, logger)
             parser.parse_python(code)
@@ -443,6 +447,14 @@ class DataSmart(MutableMapping):
         self.overrides = None
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
+        # The variable providing each variable's value and whether each
+        # override is active, filled in as they're looked up and only
+        # reset when OVERRIDES changes
+        self.overridematches = {}
+        self.overridesactive = {}
+        # Override resolution counts and time when enabled, shared with
+        # the copies of the datastore
+        self.overridestats = None
 
     def enableTracking(self):
         self._tracking = True
@@ -450,6 +462,17 @@ class DataSmart(MutableMapping):
     def disableTracking(self):
         self._tracking = False
 
+    def enableOverrideStats(self):
+        """
+        Collect the number of override resolutions and the time spent on
+        them, returning the statistics
+        """
+        self.overridestats = {"lookups": 0, "resolved": 0, "time": 0.0}
+        return self.overridestats
+
+    def disableOverrideStats(self):
+        self.overridestats = None
+
     def expandWithRefs(self, s, varname):
 
         if not isinstance(s, str): # sanity check
@@ -496,21 +519,72 @@ class DataSmart(MutableMapping):
         for count in range(5):
             self.inoverride = True
             # Can end up here recursively so setup dummy values
-            self.overrides = []
-            self.overridesset = set()
-            self.overrides = (self.getVar("OVERRIDES") or "").split(":") or []
+            self._set_overrides([])
+            self._set_overrides((self.getVar("OVERRIDES") or "").split(":") or [])
             overrride_stack.append(self.overrides)
-            self.overridesset = set(self.overrides)
             self.inoverride = False
             self.expand_cache = {}
             newoverrides = (self.getVar("OVERRIDES") or "").split(":") or []
             if newoverrides == self.overrides:
                 break
-            self.overrides = newoverrides
-            self.overridesset = set(self.overrides)
+            self._set_overrides(newoverrides)
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work. The list of failing override expansions: %s" % "\n".join(str(s) for s in overrride_stack))
 
+    def _set_overrides(self, overrides):
+        self.overrides = overrides
+        self.overridesset = set(overrides)
+        self.overridematches = {}
+        self.overridesactive = {}
+
+    def _override_active(self, override):
+        active = self.overridesactive.get(override)
+        if active is None:
+            active = self.overridesset.issuperset(override.split(":"))
+            self.overridesactive[override] = active
+        return active
+
+    def _override_match(self, var, overridedata):
+        """
+        Return the override variable providing the value of var with the
+        active overrides, or False if there isn't one
+        """
+        stats = self.overridestats
+        if stats is not None:
+            stats["lookups"] += 1
+        match = self.overridematches.get(var)
+        if match is not None:
+            return match
+        if stats is not None:
+            start = time.perf_counter()
+
+        match = False
+        active = {}
+        for (r, o) in overridedata:
+            # FIXME What about double overrides both with "_" in the name?
+            if self._override_active(o):
+                active[o] = r
+
+        mod = True
+        while mod:
+            mod = False
+            for o in self.overrides:
+                for a in active.copy():
+                    if a.endswith(":" + o):
+                        t = active[a]
+                        del active[a]
+                        active[a.replace(":" + o, "")] = t
+                        mod = True
+                    elif a == o:
+                        match = active[a]
+                        del active[a]
+
+        self.overridematches[var] = match
+        if stats is not None:
+            stats["resolved"] += 1
+            stats["time"] += time.perf_counter() - start
+        return match
+
     def initVar(self, var):
         self.expand_cache = {}
         if not var in self.dict:
@@ -607,14 +681,12 @@ class DataSmart(MutableMapping):
                 active = []
                 self.need_overrides()
                 for (r, o) in self.overridedata[var]:
-                    if o in self.overridesset:
+                    if self._override_active(o):
                         active.append(r)
-                    elif ":" in o:
-                        if set(o.split(":")).issubset(self.overridesset):
-                            active.append(r)
                 for a in active:
                     self.delVar(a)
                 del self.overridedata[var]
+                self.overridematches.pop(var, None)
 
         # more cookies for the cookie monster
         if ':' in var:
@@ -652,6 +724,7 @@ class DataSmart(MutableMapping):
                 # Force CoW by recreating the list first
                 self.overridedata[shortvar] = list(self.overridedata[shortvar])
                 self.overridedata[shortvar].append([var, override])
+                self.overridematches.pop(shortvar, None)
             override = None
             if ":" in shortvar:
                 override = var[shortvar.rfind(':')+1:]
@@ -691,6 +764,7 @@ class DataSmart(MutableMapping):
 
         if key in self.overridedata:
             self.overridedata[newkey] = []
+            self.overridematches.pop(newkey, None)
             for (v, o) in self.overridedata[key]:
                 self.overridedata[newkey].append([v.replace(key, newkey), o])
                 self.renameVar(v, v.replace(key, newkey))
@@ -723,6 +797,7 @@ class DataSmart(MutableMapping):
         self.dict[var] = {}
         if var in self.overridedata:
             del self.overridedata[var]
+            self.overridematches.pop(var, None)
         if ':' in var:
             override = var[var.rfind(':')+1:]
             shortvar = var[:var.rfind(':')]
@@ -732,6 +807,7 @@ class DataSmart(MutableMapping):
                         # Force CoW by recreating the list first
                         self.overridedata[shortvar] = list(self.overridedata[shortvar])
                         self.overridedata[shortvar].remove([var, override])
+                        self.overridematches.pop(shortvar, None)
                 except ValueError as e:
                     pass
                 override = None
@@ -793,30 +869,8 @@ class DataSmart(MutableMapping):
         if flag == "_content" and not parsing:
             overridedata = self.overridedata.get(var, None)
         if flag == "_content" and not parsing and overridedata is not None:
-            match = False
-            active = {}
             self.need_overrides()
-            for (r, o) in overridedata:
-                # FIXME What about double overrides both with "_" in the name?
-                if o in self.overridesset:
-                    active[o] = r
-                elif ":" in o:
-                    if set(o.split(":")).issubset(self.overridesset):
-                        active[o] = r
-
-            mod = True
-            while mod:
-                mod = False
-                for o in self.overrides:
-                    for a in active.copy():
-                        if a.endswith(":" + o):
-                            t = active[a]
-                            del active[a]
-                            active[a.replace(":" + o, "")] = t
-                            mod = True
-                        elif a == o:
-                            match = active[a]
-                            del active[a]
+            match = self._override_match(var, overridedata)
             if match:
                 value, subparser = self.getVarFlag(match, "_content", False, retparser=True)
                 if hasattr(subparser, "removes"):
@@ -834,12 +888,7 @@ class DataSmart(MutableMapping):
         if flag == "_content" and local_var is not None and ":append" in local_var and not parsing:
             self.need_overrides()
             for (r, o) in local_var[":append"]:
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     if value is None:
                         value = ""
                     value = value + r
@@ -847,13 +896,7 @@ class DataSmart(MutableMapping):
         if flag == "_content" and local_var is not None and ":prepend" in local_var and not parsing:
             self.need_overrides()
             for (r, o) in local_var[":prepend"]:
-
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     if value is None:
                         value = ""
                     value = r + value
@@ -867,12 +910,7 @@ class DataSmart(MutableMapping):
         if value and flag == "_content" and local_var is not None and ":remove" in local_var and not parsing:
             self.need_overrides()
             for (r, o) in local_var[":remove"]:
-                match = True
-                if o:
-                    for o2 in o.split(":"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     removes.add(r)
 
         if value and flag == "_content" and not parsing:
@@ -999,6 +1037,7 @@ class DataSmart(MutableMapping):
         data._var_renames = self._var_renames
 
         data.overrides = None
+        data.overridestats = self.overridestats
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
         # Instead, we're careful with writes.
@@ -1052,11 +1091,8 @@ class DataSmart(MutableMapping):
         self.need_overrides()
         for var in self.overridedata:
             for (r, o) in self.overridedata[var]:
-                if o in self.overridesset:
+                if self._override_active(o):
                     overrides.add(var)
-                elif ":" in o:
-                    if set(o.split(":")).issubset(self.overridesset):
-                        overrides.add(var)
 
         for k in keylist(self.dict):
              yield k
@@ -17,6 +17,7 @@ import logging
 import pickle
 import sys
 import threading
+import time
 import traceback
 
 import bb.exceptions
@@ -62,6 +63,7 @@ def clean_class_handlers():
 _handlers = clean_class_handlers()
 _ui_handlers = {}
 _ui_logfilters = {}
+_ui_queues = {}
 _ui_handler_seq = 0
 _event_handler_map = {}
 _catchall_handlers = {}
@@ -187,7 +189,69 @@ def print_ui_queue():
             logger.removeHandler(stdout)
         ui_queue = []
 
-def fire_ui_handlers(event, d):
+class UIHandlerQueue(object):
+    """
+    Queue of the events to send to a UI handler. The events are sent by the
+    threads firing them without holding _thread_lock. A thread finding
+    another thread sending to the handler leaves its events for that thread
+    to send, so a slow handler doesn't hold up the others. Events are
+    queued under _thread_lock, see fire_ui_handlers().
+    """
+    def __init__(self, handlerNum, handler):
+        self.handlerNum = handlerNum
+        # We use pickle since it better handles object instances which
+        # xmlrpc's marshaller does not. Events *must* be serializable by
+        # pickle.
+        if hasattr(handler.event, "sendevent"):
+            self.sendevent = handler.event.sendevent
+            self.pickled = True
+        elif hasattr(handler.event, "sendpickle"):
+            sendpickle = handler.event.sendpickle
+            self.sendevent = lambda event, pickled: sendpickle(pickled)
+            self.pickled = True
+        else:
+            send = handler.event.send
+            self.sendevent = lambda event, pickled: send(event)
+            self.pickled = False
+        self.queue = collections.deque()
+        self.sendlock = threading.Lock()
+        self.failed = False
+        self.events = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def flush(self):
+        # Check the queue again after releasing the lock, an event may have
+        # been queued after the sending thread found it empty
+        while self.queue and not self.failed:
+            if not self.sendlock.acquire(blocking=False):
+                return
+            try:
+                while self.queue:
+                    event, pickled = self.queue.popleft()
+                    self.sendevent(event, pickled)
+                    self.events += 1
+                    if pickled is not None:
+                        self.bytes += len(pickled)
+            except:
+                self.remove()
+            finally:
+                self.sendlock.release()
+
+    def remove(self):
+        self.failed = True
+        self.queue.clear()
+        with bb.utils.lock_timeout(_thread_lock):
+            if _ui_queues.get(self.handlerNum) is self:
+                del _ui_handlers[self.handlerNum]
+                del _ui_queues[self.handlerNum]
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return {"events": self.events, "bytes": self.bytes, "pending": len(self.queue),
+                "events_per_sec": self.events / elapsed, "bytes_per_sec": self.bytes / elapsed}
+
+def fire_ui_handlers(event, d, pickled=None):
     global _thread_lock
 
     if not _uiready:
@@ -195,24 +259,48 @@ def fire_ui_handlers(event, d):
         ui_queue.append(event)
         return
 
+    # The event is pickled once for all the handlers, before taking the lock
+    # so a slow pickle doesn't hold up the other threads
+    pickle_failed = False
+    if pickled is None and any(q.pickled for q in list(_ui_queues.values())):
+        try:
+            pickled = pickle.dumps(event)
+        except:
+            pickle_failed = True
+
+    queued = []
+    failed = []
     with bb.utils.lock_timeout(_thread_lock):
-        errors = []
         for h in _ui_handlers:
-            #print "Sending event %s" % event
-            try:
-                 if not _ui_logfilters[h].filter(event):
-                     continue
-                 # We use pickle here since it better handles object instances
-                 # which xmlrpc's marshaller does not. Events *must* be serializable
-                 # by pickle.
-                 if hasattr(_ui_handlers[h].event, "sendpickle"):
-                    _ui_handlers[h].event.sendpickle((pickle.dumps(event)))
-                 else:
-                    _ui_handlers[h].event.send(event)
-            except:
-                errors.append(h)
-        for h in errors:
-            del _ui_handlers[h]
+            if not _ui_logfilters[h].filter(event):
+                continue
+            q = _ui_queues[h]
+            if q.pickled and pickled is None and not pickle_failed:
+                # The handler was registered after the check above
+                try:
+                    pickled = pickle.dumps(event)
+                except:
+                    pickle_failed = True
+            if q.pickled and pickle_failed:
+                # As when sending fails, the handlers are dropped
+                failed.append(q)
+                continue
+            q.queue.append((event, pickled))
+            queued.append(q)
+
+    for q in failed:
+        q.remove()
+    # Events queued by other threads may be sent here too
+    for q in queued:
+        q.flush()
+
+def get_uihandler_stats():
+    """
+    Return the number of events and bytes sent to each UI handler, the
+    events still queued and the rates since the handler was registered.
+    """
+    with bb.utils.lock_timeout(_thread_lock):
+        return {h: _ui_queues[h].stats() for h in _ui_handlers}
 
 def fire(event, d):
     """Fire off an Event"""
@@ -234,8 +322,8 @@ def fire(event, d):
             ui_queue = []
         fire_ui_handlers(event, d)
 
-def fire_from_worker(event, d):
-    fire_ui_handlers(event, d)
+def fire_from_worker(event, d, pickled=None):
+    fire_ui_handlers(event, d, pickled)
 
 noop = lambda _: None
 def register(name, handler, mask=None, filename=None, lineno=None, data=None):
@@ -261,13 +349,13 @@ def register(name, handler, mask=None, filename=None, lineno=None, data=None):
             if lineno is not None:
                 tmp = "\n" * (lineno-1) + tmp
             try:
-                code = bb.methodpool.compile_cache(tmp)
+                if filename is None:
+                    filename = "%s(e, d)" % name
+                code = bb.methodpool.compile_cache(tmp, filename, "exec")
                 if not code:
-                    if filename is None:
-                        filename = "%s(e, d)" % name
                     code = compile(tmp, filename, "exec", ast.PyCF_ONLY_AST)
                     code = compile(code, filename, "exec")
-                    bb.methodpool.compile_cache_add(tmp, code)
+                    bb.methodpool.compile_cache_add(tmp, code, filename, "exec")
             except SyntaxError:
                 logger.error("Unable to register event handler '%s':\n%s", name,
                              ''.join(traceback.format_exc(limit=0)))
@@ -330,6 +418,7 @@ def register_UIHhandler(handler, mainui=False):
     with bb.utils.lock_timeout(_thread_lock):
         bb.event._ui_handler_seq = bb.event._ui_handler_seq + 1
         _ui_handlers[_ui_handler_seq] = handler
+        _ui_queues[_ui_handler_seq] = UIHandlerQueue(_ui_handler_seq, handler)
         level, debug_domains = bb.msg.constructLogOptions()
         _ui_logfilters[_ui_handler_seq] = UIEventFilter(level, debug_domains)
         if mainui:
@@ -344,6 +433,9 @@ def unregister_UIHhandler(handlerNum, mainui=False):
     with bb.utils.lock_timeout(_thread_lock):
         if handlerNum in _ui_handlers:
             del _ui_handlers[handlerNum]
+            stats = _ui_queues.pop(handlerNum).stats()
+            logger.debug("UI handler %s sent %d events (%.1f/s), %d bytes (%.1f/s)" % (handlerNum,
+                stats["events"], stats["events_per_sec"], stats["bytes"], stats["bytes_per_sec"]))
     return
 
 def get_uihandler():
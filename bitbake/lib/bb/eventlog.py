@@ -0,0 +1,211 @@
+"""
+BitBake compressed event log
+
+The log is a sequence of zstd frames, each compressing a chunk of records, so
+"zstd -d" decompresses it as a whole. Each record is a header (RECORD) with
+the time the record was written and the lengths of the name and the data,
+followed by the name, the class of the event, and the data, the pickled
+event. The variables of the build are a record named "allvariables" holding
+the pickled variables.
+
+An index is written next to the log, one JSON line per chunk with the offset
+and length of the chunk in the log, the number of records, the times of the
+first and last records and the tasks the events are about. Readers use it to
+decompress only the chunks they need.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import io
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+
+import bb.compress.zstd
+
+RECORD = struct.Struct("<dHI")
+VARIABLES = "allvariables"
+
+def is_eventlog(filename):
+    """Return True if filename should be written as a compressed event log"""
+    return filename.endswith(".zst")
+
+def index_filename(filename):
+    return filename + ".index"
+
+class EventLogWriter(object):
+    """
+    Write records to a compressed event log. The records are compressed in
+    chunks of CHUNK_SIZE bytes, or less when CHUNK_TIME seconds passed since
+    the last chunk was written or flush() is called.
+    """
+    CHUNK_SIZE = 4 * 1024 * 1024
+    CHUNK_TIME = 30
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.chunk = bytearray()
+        self.last_flush = time.monotonic()
+
+    def write(self, name, data, task=None):
+        with self.lock:
+            now = time.time()
+            if not self.chunk:
+                self.records = 0
+                self.start = now
+                self.tasks = set()
+                self.variables = False
+            if name == VARIABLES:
+                self.variables = True
+            if task:
+                self.tasks.add(task)
+            name = name.encode("utf-8")
+            self.chunk += RECORD.pack(now, len(name), len(data))
+            self.chunk += name
+            self.chunk += data
+            self.records += 1
+            self.end = now
+            if len(self.chunk) >= self.CHUNK_SIZE or time.monotonic() - self.last_flush >= self.CHUNK_TIME:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.chunk:
+            return
+
+        with open(self.filename, "ab") as f:
+            offset = f.tell()
+            # The compressed file closes f
+            with bb.compress.zstd.open(f, "wb") as z:
+                z.write(self.chunk)
+        length = os.path.getsize(self.filename) - offset
+
+        chunk = {"offset": offset, "length": length, "records": self.records,
+                 "start": self.start, "end": self.end, "tasks": sorted(self.tasks)}
+        if self.variables:
+            chunk["variables"] = True
+        with open(index_filename(self.filename), "a") as f:
+            f.write("%s\n" % json.dumps(chunk))
+        self.chunk = bytearray()
+
+class EventLogReader(object):
+    """
+    Read the records of a compressed event log. The records of the whole log
+    are streamed, including chunks missing from the index (e.g. when the
+    build was interrupted), unless the records are selected by time or task,
+    which only reads the chunks of the index matching the selection.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = []
+        try:
+            with open(index_filename(filename)) as f:
+                for line in f:
+                    try:
+                        self.index.append(json.loads(line))
+                    except ValueError:
+                        # Truncated by an interrupted build
+                        break
+        except FileNotFoundError:
+            pass
+
+    def tasks(self):
+        """Return the tasks the events of the log are about"""
+        tasks = set()
+        for chunk in self.index:
+            tasks.update(chunk["tasks"])
+        return tasks
+
+    def chunks(self, start=None, end=None, task=None):
+        for chunk in self.index:
+            if start is not None and chunk["end"] < start:
+                continue
+            if end is not None and chunk["start"] > end:
+                continue
+            if task is not None and task not in chunk["tasks"]:
+                continue
+            yield chunk
+
+    def records(self, start=None, end=None, task=None):
+        """
+        Yield the (time, name, data) records written between the start and
+        end times. When a task is given, the records of the chunks with
+        events about the task are returned, the records aren't filtered
+        further.
+        """
+        if start is None and end is None and task is None:
+            yield from self._read(0)
+            return
+
+        for chunk in self.chunks(start, end, task):
+            for record in self._read(chunk["offset"], chunk["records"]):
+                if start is not None and record[0] < start:
+                    continue
+                if end is not None and record[0] > end:
+                    return
+                yield record
+
+    def events(self, start=None, end=None, task=None, classes=None):
+        """
+        Yield the events of the records, only the events of the classes
+        given by name (e.g. "bb.build.TaskStarted") if classes is set
+        """
+        for _, name, data in self.records(start, end, task):
+            if name == VARIABLES or (classes is not None and name not in classes):
+                continue
+            yield pickle.loads(data)
+
+    def variables(self):
+        """Return the variables of the build, or None"""
+        chunks = [c for c in self.index if c.get("variables")]
+        if chunks:
+            records = self._read(chunks[0]["offset"], chunks[0]["records"])
+        else:
+            records = self._read(0)
+        for _, name, data in records:
+            if name == VARIABLES:
+                records.close()
+                return pickle.loads(data)
+        return None
+
+    def _read(self, offset, count=None):
+        f = open(self.filename, "rb")
+        f.seek(offset)
+        reader = io.BufferedReader(bb.compress.zstd.open(f, "rb"), 1024 * 1024)
+        complete = False
+        try:
+            while count is None or count > 0:
+                header = reader.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    # End of the log, or a record truncated by an
+                    # interrupted build
+                    complete = True
+                    break
+                t, namelen, datalen = RECORD.unpack(header)
+                name = reader.read(namelen).decode("utf-8")
+                data = reader.read(datalen)
+                if len(data) < datalen:
+                    complete = True
+                    break
+                yield t, name, data
+                if count is not None:
+                    count -= 1
+        finally:
+            try:
+                reader.close()
+            except OSError:
+                # zstd fails writing to the closed pipe when the rest of the
+                # log wasn't read
+                if complete:
+                    raise
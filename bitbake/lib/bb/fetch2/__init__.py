@@ -15,6 +15,9 @@ BitBake build tools.
 import os, re
 import signal
 import logging
+import contextlib
+import concurrent.futures
+import threading
 import urllib.request, urllib.parse, urllib.error
 if 'git' not in urllib.parse.uses_netloc:
     urllib.parse.uses_netloc.append('git')
@@ -566,13 +569,17 @@ def verify_checksum(ud, d, precomputed={}, localpath=None, fatal_nochecksum=True
     if localpath is None:
         localpath = ud.localpath
 
+    # Compute all the missing checksums in a single pass over the file
+    missing = [checksum_id for checksum_id in CHECKSUM_LIST if checksum_id not in precomputed]
+    computed = bb.utils.file_checksums(localpath, missing) if missing else {}
+
     def compute_checksum_info(checksum_id):
         checksum_name = getattr(ud, "%s_name" % checksum_id)
 
         if checksum_id in precomputed:
             checksum_data = precomputed[checksum_id]
         else:
-            checksum_data = getattr(bb.utils, "%s_file" % checksum_id)(localpath)
+            checksum_data = computed[checksum_id]
 
         checksum_expected = getattr(ud, "%s_expected" % checksum_id)
 
@@ -1159,11 +1166,33 @@ def try_mirrors(fetch, d, origud, mirrors, check = False):
 
     uris, uds = build_mirroruris(origud, mirrors, ld)
 
-    for index, uri in enumerate(uris):
-        ret = try_mirror_url(fetch, origud, uds[index], ld, check)
-        if ret:
-            return ret
-    return None
+    if not fetch.parallel or len(uds) < 2:
+        for ud in uds:
+            with fetch.host_slot(ud):
+                ret = try_mirror_url(fetch, origud, ud, ld, check)
+            if ret:
+                return ret
+        return None
+
+    # The mirrors are checked ahead while the earlier ones are tried, still
+    # in their original order. Once a mirror has the file, the checks which
+    # haven't started yet are cancelled.
+    probes = fetch.probe_mirrors(uds, ld)
+    try:
+        for ud, probe in zip(uds, probes):
+            found = probe.result()
+            if found is False:
+                continue
+            if found and check:
+                return found
+            with fetch.host_slot(ud):
+                ret = try_mirror_url(fetch, origud, ud, ld, check)
+            if ret:
+                return ret
+        return None
+    finally:
+        for probe in probes:
+            probe.cancel()
 
 def trusted_network(d, url):
     """
@@ -1760,6 +1789,11 @@ class Fetch(object):
         self.d = d
         self.ud = {}
         self.connection_cache = connection_cache
+        self.threads = int(d.getVar("BB_FETCH_THREADS") or 1)
+        self.host_threads = int(d.getVar("BB_FETCH_HOST_THREADS") or 2)
+        self.host_limits = None
+        self.host_limits_lock = threading.Lock()
+        self.probe_executor = None
 
         fn = d.getVar('FILE')
         mc = d.getVar('__BBMULTICONFIG') or ""
@@ -1821,6 +1855,68 @@ class Fetch(object):
 
         return local
 
+    @property
+    def parallel(self):
+        return self.host_limits is not None
+
+    def host_slot(self, ud):
+        """
+        Returns a context manager limiting the number of connections made to
+        the host of a url at the same time when fetching in parallel
+        """
+        if self.host_limits is None or not ud.host or ud.type == "file":
+            return contextlib.nullcontext()
+        with self.host_limits_lock:
+            if ud.host not in self.host_limits:
+                self.host_limits[ud.host] = threading.BoundedSemaphore(self.host_threads)
+            return self.host_limits[ud.host]
+
+    def probe_mirrors(self, uds, d):
+        """
+        Check whether the mirror urls have the file from the threads shared
+        by all the entries, within the host slots. Returns a future for each
+        url, with the result of checkstatus() or None when the url couldn't
+        be checked.
+        """
+        def probe(ud, ld):
+            if type(ud.method).checkstatus is FetchMethod.checkstatus:
+                return None
+            try:
+                with self.host_slot(ud):
+                    return ud.method.checkstatus(self, ud, ld)
+            except Exception as e:
+                logger.debug("Unable to check mirror url %s: %s" % (ud.url, str(e)))
+                return None
+
+        return [self.probe_executor.submit(probe, ud, d.createCopy()) for ud in uds]
+
+    def run_parallel(self, func, urls):
+        """
+        Calls func(url, d) for each url from BB_FETCH_THREADS threads, each
+        with its own copy of the datastore. All the urls are processed even
+        if some fail, so that running again only has to deal with the
+        failed ones. Returns the results in the order of urls, raising the
+        exception for the first url which failed.
+        """
+        urls = list(dict.fromkeys(urls))
+        own_connection_cache = self.connection_cache is None
+        if own_connection_cache:
+            self.connection_cache = FetchConnectionCache()
+        self.host_limits = {}
+        # The mirror checks of all the entries share one bounded pool
+        self.probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(urls), self.threads)) as executor:
+                futures = [executor.submit(func, u, self.d.createCopy()) for u in urls]
+            return [f.result() for f in futures]
+        finally:
+            self.probe_executor.shutdown(cancel_futures=True)
+            self.probe_executor = None
+            self.host_limits = None
+            if own_connection_cache:
+                self.connection_cache.close_connections()
+                self.connection_cache = None
+
     def download(self, urls=None):
         """
         Fetch all urls
@@ -1831,103 +1927,118 @@ class Fetch(object):
         network = self.d.getVar("BB_NO_NETWORK")
         premirroronly = bb.utils.to_boolean(self.d.getVar("BB_FETCH_PREMIRRORONLY"))
 
-        checksum_missing_messages = []
-        for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            done = False
+        def download_url(u, d):
+            return self.download_url(u, d, network, premirroronly)
 
-            if ud.lockfile:
-                lf = bb.utils.lockfile(ud.lockfile)
+        if self.threads > 1:
+            checksum_missing_messages = self.run_parallel(download_url, urls)
+        else:
+            checksum_missing_messages = [download_url(u, self.d) for u in urls]
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
-                if m.verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
-                    done = True
-                elif m.try_premirror(ud, self.d):
-                    logger.debug("Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS'))
-                    done = m.try_mirrors(self, ud, self.d, mirrors)
-                    if done:
-                        try:
-                            # early checksum verification so that if the checksum of the premirror
-                            # contents mismatch the fetcher can still try upstream and mirrors
-                            m.update_donestamp(ud, self.d)
-                        except ChecksumError as e:
-                            logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
-                            logger.debug(str(e))
-                            done = False
-
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
-
-                firsterr = None
-                verified_stamp = False
+        checksum_missing_messages = [m for m in checksum_missing_messages if m]
+        if checksum_missing_messages:
+            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
+            raise BBFetchException("There was some missing checksums in the recipe")
+
+    def download_url(self, u, d, network, premirroronly):
+        """
+        Fetch a single url, returns the message for a missing checksum if
+        there is one
+        """
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        done = False
+
+        if ud.lockfile:
+            lf = bb.utils.lockfile(ud.lockfile)
+
+        try:
+            d.setVar("BB_NO_NETWORK", network)
+            if m.verify_donestamp(ud, d) and not m.need_update(ud, d):
+                done = True
+            elif m.try_premirror(ud, d):
+                logger.debug("Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS'))
+                done = m.try_mirrors(self, ud, d, mirrors)
                 if done:
-                    verified_stamp = m.verify_donestamp(ud, self.d)
-                if not done and (not verified_stamp or m.need_update(ud, self.d)):
                     try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug("Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        done = True
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        m.update_donestamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
+                        # early checksum verification so that if the checksum of the premirror
+                        # contents mismatch the fetcher can still try upstream and mirrors
+                        m.update_donestamp(ud, d)
+                    except ChecksumError as e:
+                        logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
+                        logger.debug(str(e))
+                        done = False
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            firsterr = None
+            verified_stamp = False
+            if done:
+                verified_stamp = m.verify_donestamp(ud, d)
+            if not done and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug("Trying Upstream")
+                    with self.host_slot(ud):
+                        m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
+                    done = True
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    m.update_donestamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(str(e))
+                        if os.path.exists(ud.localpath):
+                            rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
                         raise
+                    else:
+                        logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp and m.cleanup_upon_failure():
+                        m.clean(ud, d)
+                    logger.debug("Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS'))
+                    done = m.try_mirrors(self, ud, d, mirrors)
+
+            if not done or not m.done(ud, d):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            m.update_donestamp(ud, d)
+
+        except IOError as e:
+            if e.errno in [errno.ESTALE]:
+                logger.error("Stale Error Observed %s." % u)
+                raise ChecksumError("Stale Error Detected")
+
+        except BBFetchException as e:
+            if isinstance(e, NoChecksumError):
+                (message, _) = e.args
+                return message
+            elif isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(str(e))
-                            if os.path.exists(ud.localpath):
-                                rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp and m.cleanup_upon_failure():
-                            m.clean(ud, self.d)
-                        logger.debug("Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS'))
-                        done = m.try_mirrors(self, ud, self.d, mirrors)
-
-                if not done or not m.done(ud, self.d):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                m.update_donestamp(ud, self.d)
-
-            except IOError as e:
-                if e.errno in [errno.ESTALE]:
-                    logger.error("Stale Error Observed %s." % u)
-                    raise ChecksumError("Stale Error Detected")
-
-            except BBFetchException as e:
-                if isinstance(e, NoChecksumError):
-                    (message, _) = e.args
-                    checksum_missing_messages.append(message)
-                    continue
-                elif isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
+        finally:
+            if ud.lockfile:
+                bb.utils.unlockfile(lf)
 
-            finally:
-                if ud.lockfile:
-                    bb.utils.unlockfile(lf)
-        if checksum_missing_messages:
-            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
-            raise BBFetchException("There was some missing checksums in the recipe")
+        return None
 
     def checkstatus(self, urls=None):
         """
@@ -1941,24 +2052,31 @@ class Fetch(object):
         if not urls:
             urls = self.urls
 
-        for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            logger.debug("Testing URL %s", u)
-            # First try checking uri, u, from PREMIRRORS
-            mirrors = mirror_from_string(self.d.getVar('PREMIRRORS'))
-            ret = m.try_mirrors(self, ud, self.d, mirrors, True)
+        if self.threads > 1:
+            self.run_parallel(self.checkstatus_url, urls)
+        else:
+            for u in urls:
+                self.checkstatus_url(u, self.d)
+
+    def checkstatus_url(self, u, d):
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        logger.debug("Testing URL %s", u)
+        # First try checking uri, u, from PREMIRRORS
+        mirrors = mirror_from_string(d.getVar('PREMIRRORS'))
+        ret = m.try_mirrors(self, ud, d, mirrors, True)
+        if not ret:
+            # Next try checking from the original uri, u
+            with self.host_slot(ud):
+                ret = m.checkstatus(self, ud, d)
             if not ret:
-                # Next try checking from the original uri, u
-                ret = m.checkstatus(self, ud, self.d)
-                if not ret:
-                    # Finally, try checking uri, u, from MIRRORS
-                    mirrors = mirror_from_string(self.d.getVar('MIRRORS'))
-                    ret = m.try_mirrors(self, ud, self.d, mirrors, True)
+                # Finally, try checking uri, u, from MIRRORS
+                mirrors = mirror_from_string(d.getVar('MIRRORS'))
+                ret = m.try_mirrors(self, ud, d, mirrors, True)
 
-            if not ret:
-                raise FetchError("URL doesn't work", u)
+        if not ret:
+            raise FetchError("URL doesn't work", u)
 
     def unpack(self, root, urls=None):
         """
@@ -2034,9 +2152,23 @@ class Fetch(object):
 class FetchConnectionCache(object):
     """
         A class which represents an container for socket connections.
+        Connections are only reused by the thread which made them, so
+        the same cache can be used by urls fetched in parallel.
     """
     def __init__(self):
-        self.cache = {}
+        self.local = threading.local()
+        self.caches = []
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        try:
+            return self.local.cache
+        except AttributeError:
+            self.local.cache = {}
+            with self.lock:
+                self.caches.append(self.local.cache)
+            return self.local.cache
 
     def get_connection_name(self, host, port):
         return host + ':' + str(port)
@@ -2063,9 +2195,12 @@ class FetchConnectionCache(object):
             del self.cache[cn]
 
     def close_connections(self):
-        for cn in list(self.cache.keys()):
-            self.cache[cn].close()
-            del self.cache[cn]
+        with self.lock:
+            caches = list(self.caches)
+        for cache in caches:
+            for cn in list(cache.keys()):
+                cache[cn].close()
+                del cache[cn]
 
 from . import cvs
 from . import git
@@ -256,7 +256,8 @@ def create_bitbake_parser():
 
     logging_group.add_argument("-w", "--write-log", dest="writeeventlog",
                         default=os.environ.get("BBEVENTLOG"),
-                        help="Writes the event log of the build to a bitbake event json file. "
+                        help="Writes the event log of the build to a bitbake event json file, "
+                            "or to a compressed event log if the file name ends with '.zst'. "
                             "Use '' (empty string) to assign the name automatically.")
 
 
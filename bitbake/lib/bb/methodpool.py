@@ -4,7 +4,11 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import hashlib
+import marshal
+import sys
 from bb.utils import better_compile, better_exec
+from bb.cache import MultiProcessCache
 
 def insert_method(modulename, code, fn, lineno):
     """
@@ -14,14 +18,61 @@ def insert_method(modulename, code, fn, lineno):
     comp = better_compile(code, modulename, fn, lineno=lineno)
     better_exec(comp, None, code, fn)
 
+class CompileCache(MultiProcessCache):
+    """
+    Persistent cache of compiled python code, keyed by the hash of the code.
+    The code objects are stored marshalled so a cache file is only used by
+    one python version.
+    """
+    cache_file_name = "bb_compile_cache.%s.dat" % sys.implementation.cache_tag
+    CACHE_VERSION = 2
+
+    def get(self, key):
+        h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        data = self.cachedata[0].get(h) or self.cachedata_extras[0].get(h)
+        if data is None:
+            return None
+        return marshal.loads(data)
+
+    def add(self, key, compileobj):
+        h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        if h not in self.cachedata[0]:
+            self.cachedata_extras[0][h] = marshal.dumps(compileobj)
+
 compilecache = {}
+persistentcache = CompileCache()
+
+def _cache_key(code, filename, mode, lineno):
+    if filename is None:
+        return code
+    return "%s\0%s\0%s\0%s" % (filename, mode, lineno, code)
+
+def compile_cache(code, filename=None, mode=None, lineno=0):
+    """
+    Return the code object cached for code, or None. The filename, mode and
+    line number the code was compiled with are part of the key when given.
+    """
+    key = _cache_key(code, filename, mode, lineno)
+    if key in compilecache:
+        return compilecache[key]
+    compileobj = persistentcache.get(key)
+    if compileobj is not None:
+        compilecache[key] = compileobj
+    return compileobj
+
+def compile_cache_add(code, compileobj, filename=None, mode=None, lineno=0):
+    key = _cache_key(code, filename, mode, lineno)
+    compilecache[key] = compileobj
+    persistentcache.add(key, compileobj)
+
+def compile_cache_init(cachedir):
+    # Check if we already have the cache
+    if persistentcache.cachedata[0]:
+        return
+    persistentcache.init_cache(cachedir)
 
-def compile_cache(code):
-    h = hash(code)
-    if h in compilecache:
-        return compilecache[h]
-    return None
+def compile_cache_save():
+    persistentcache.save_extras()
 
-def compile_cache_add(code, compileobj):
-    h = hash(code)
-    compilecache[h] = compileobj
+def compile_cache_savemerge():
+    persistentcache.save_merge()
@@ -13,6 +13,7 @@
 #
 
 import re, bb, os
+import hashlib, io, pickle
 import bb.build, bb.utils, bb.data_smart
 
 from . import ConfHandler
@@ -35,8 +36,12 @@ __inpython__ = False
 __body__   = []
 __classname__ = ""
 __residue__ = []
+__warned__ = False
 
 cached_statements = {}
+# Hash of the code producing the statements, part of the keys of the
+# statements saved in BB_CACHEDIR
+statements_version = None
 
 def supports(fn, d):
     """Return True if fn has a supported extension"""
@@ -80,33 +85,90 @@ def inherit(files, fn, lineno, d, deferred=False):
                 raise ParseError("Could not inherit file %s: %s" % (fn, exc.strerror), fn, lineno)
             __inherit_cache = d.getVar('__inherit_cache', False) or []
 
-def get_statements(filename, absolute_filename, base_name):
+def statements_cachefile(cachedir, filename, base_name, content):
+    global statements_version
+
+    if statements_version is None:
+        h = hashlib.sha256()
+        for f in (__file__, ConfHandler.__file__, ast.__file__):
+            with open(f, "rb") as fd:
+                h.update(fd.read())
+        statements_version = h.hexdigest()
+
+    key = "\0".join((statements_version, filename, base_name, content))
+    return os.path.join(cachedir, "bb_statements", hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+def load_statements(cachefile):
+    try:
+        with open(cachefile, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.debug("Unable to load statements from %s: %s" % (cachefile, exc))
+        return None
+
+def save_statements(cachefile, statements):
+    tmpname = "%s.%d" % (cachefile, os.getpid())
+    try:
+        bb.utils.mkdirhier(os.path.dirname(cachefile))
+        with open(tmpname, "wb") as f:
+            pickle.dump(statements, f, -1)
+        os.rename(tmpname, cachefile)
+    except OSError as exc:
+        logger.debug("Unable to save statements to %s: %s" % (cachefile, exc))
+        bb.utils.remove(tmpname)
+
+def parse_statements(filename, base_name, f):
+    global __warned__
+
+    statements = ast.StatementGroup()
+    __warned__ = False
+
+    lineno = 0
+    while True:
+        lineno = lineno + 1
+        s = f.readline()
+        if not s: break
+        s = s.rstrip()
+        feeder(lineno, s, filename, base_name, statements)
+
+    if __inpython__:
+        # add a blank line to close out any python definition
+        feeder(lineno, "", filename, base_name, statements, eof=True)
+
+    if __residue__:
+        raise ParseError("Unparsed lines %s: %s" % (filename, str(__residue__)), filename, lineno)
+    if __body__:
+        raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
+
+    return statements
+
+def get_statements(filename, absolute_filename, base_name, cachedir=None):
     global cached_statements, __residue__, __body__
 
     try:
         return cached_statements[absolute_filename]
     except KeyError:
-        with open(absolute_filename, 'r') as f:
-            statements = ast.StatementGroup()
-
-            lineno = 0
-            while True:
-                lineno = lineno + 1
-                s = f.readline()
-                if not s: break
-                s = s.rstrip()
-                feeder(lineno, s, filename, base_name, statements)
-
-        if __inpython__:
-            # add a blank line to close out any python definition
-            feeder(lineno, "", filename, base_name, statements, eof=True)
-
-        if __residue__:
-            raise ParseError("Unparsed lines %s: %s" % (filename, str(__residue__)), filename, lineno)
-        if __body__:
-            raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
-
-        if filename.endswith(".bbclass") or filename.endswith(".inc"):
+        cacheable = filename.endswith(".bbclass") or filename.endswith(".inc")
+        if cacheable and cachedir:
+            # The statements are also kept on disk for other processes,
+            # keyed by the content of the file
+            with open(absolute_filename, 'r') as f:
+                content = f.read()
+            cachefile = statements_cachefile(cachedir, filename, base_name, content)
+            statements = load_statements(cachefile)
+            if statements is None:
+                statements = parse_statements(filename, base_name, io.StringIO(content))
+                # Parsing the file from the cache wouldn't show the warnings
+                # or the errors checked after evaluating the statements
+                if not (__warned__ or __infunc__):
+                    save_statements(cachefile, statements)
+        else:
+            with open(absolute_filename, 'r') as f:
+                statements = parse_statements(filename, base_name, f)
+
+        if cacheable:
             cached_statements[absolute_filename] = statements
         return statements
 
@@ -136,7 +198,7 @@ def handle(fn, d, include, baseconfig=False):
     abs_fn = resolve_file(fn, d)
 
     # actual loading
-    statements = get_statements(fn, abs_fn, base_name)
+    statements = get_statements(fn, abs_fn, base_name, d.getVar("BB_CACHEDIR"))
 
     # DONE WITH PARSING... time to evaluate
     if ext != ".bbclass" and abs_fn != oldfile:
@@ -163,7 +225,7 @@ def handle(fn, d, include, baseconfig=False):
     return d
 
 def feeder(lineno, s, fn, root, statements, eof=False):
-    global __inpython__, __infunc__, __body__, __residue__, __classname__
+    global __inpython__, __infunc__, __body__, __residue__, __classname__, __warned__
 
     # Check tabs in python functions:
     # - def py_funcname(): covered by __inpython__
@@ -173,6 +235,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
         tab = __python_tab_regexp__.match(s)
         if tab:
             bb.warn('python should use 4 spaces indentation, but found tabs in %s, line %s' % (root, lineno))
+            __warned__ = True
 
     if __infunc__:
         if s == '}':
@@ -244,6 +307,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
             m2 = re.match(r"addtask\s+(?P<func>\w+)(?P<ignores>.*)", s)
             if m2 and m2.group('ignores'):
                 logger.warning('addtask ignored: "%s"' % m2.group('ignores'))
+                __warned__ = True
 
         # Check and warn for "addtask task1 before task2 before task3", the
         # similar to "after"
@@ -251,6 +315,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
         for word in ('before', 'after'):
             if taskexpression.count(word) > 1:
                 logger.warning("addtask contained multiple '%s' keywords, only one is supported" % word)
+                __warned__ = True
 
         # Check and warn for having task with exprssion as part of task name
         for te in taskexpression:
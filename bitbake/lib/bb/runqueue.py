@@ -9,11 +9,13 @@ Handles preparation and execution of a queue of tasks
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import array
 import copy
 import os
 import sys
 import stat
 import errno
+import json
 import logging
 import re
 import bb
@@ -24,6 +26,7 @@ import pickle
 from multiprocessing import Process
 import shlex
 import pprint
+import struct
 import time
 
 bblogger = logging.getLogger("BitBake")
@@ -148,7 +151,7 @@ class RunQueueScheduler(object):
         self.rqdata = rqdata
         self.numTasks = len(self.rqdata.runtaskentries)
 
-        self.prio_map = [self.rqdata.runtaskentries.keys()]
+        self.prio_map = list(self.rqdata.runtaskentries.keys())
 
         self.buildable = set()
         self.skip_maxthread = {}
@@ -306,6 +309,24 @@ class RunQueueScheduler(object):
     def removebuildable(self, task):
         self.buildable.remove(task)
 
+    def taskstarted(self, task):
+        """
+        Called when a task has been sent to a worker for execution
+        """
+        pass
+
+    def taskcompleted(self, task):
+        """
+        Called when a task has completed successfully
+        """
+        pass
+
+    def finish(self):
+        """
+        Called once the runqueue has finished executing tasks
+        """
+        pass
+
     def describe_task(self, taskid):
         result = 'ID %s' % taskid
         if self.rev_prio_map:
@@ -442,6 +463,135 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
                     task_index += 1
         self.dump_prio('completion priorities')
 
+class RunQueueSchedulerCriticalPath(RunQueueSchedulerSpeed):
+    """
+    A scheduler which runs the tasks on the longest remaining path through
+    the task graph first, so long running tasks (and the tasks leading up to
+    them) are started as early as possible rather than ending up as the last
+    tasks of the build. The length of a path is the sum of the durations of
+    the tasks along it, taken from the history file in BB_TASK_DURATIONS which
+    is updated with the tasks executed at the end of each build. Tasks without
+    any history use the average duration of the other tasks of the same name.
+    """
+    name = "critical"
+
+    # Duration assumed for tasks when there is no history at all
+    default_duration = 1.0
+
+    def __init__(self, runqueue, rqdata):
+        super().__init__(runqueue, rqdata)
+
+        self.historyfile = self.get_historyfile(self.rq.cfgData)
+        self.history = self.load_history(self.historyfile)
+        self.started = {}
+        self.durations = {}
+
+        self.keys = {}
+        for tid in self.rqdata.runtaskentries:
+            (mc, fn, taskname, taskfn) = split_tid_mcfn(tid)
+            pn = self.rqdata.dataCaches[mc].pkg_fn[taskfn]
+            self.keys[tid] = "%s:%s" % (pn, taskname)
+
+        graph = RunQueueTaskGraph(self.rqdata.runtaskentries)
+        duration = self.estimate_durations(graph.tids)
+
+        # The rank of a task is its own duration plus the rank of the
+        # longest chain of tasks depending on it
+        rank = [duration[tid] for tid in graph.tids]
+        for taskid in reversed(graph.topological_order()):
+            longest = 0
+            for revdep in graph.revdeps(taskid):
+                if rank[revdep] > longest:
+                    longest = rank[revdep]
+            rank[taskid] += longest
+        self.rank = dict(zip(graph.tids, rank))
+
+        self.prio_map.sort(key=lambda tid: (self.rank[tid], self.rqdata.runtaskentries[tid].weight), reverse=True)
+        self.dump_prio('critical path priorities')
+
+    @staticmethod
+    def get_historyfile(d):
+        historyfile = d.getVar("BB_TASK_DURATIONS")
+        if not historyfile:
+            cachedir = d.getVar("PERSISTENT_DIR") or d.getVar("CACHE")
+            if not cachedir:
+                return None
+            historyfile = os.path.join(cachedir, "bb_task_durations.json")
+        return historyfile
+
+    @staticmethod
+    def load_history(historyfile):
+        if not historyfile:
+            return {}
+        try:
+            with open(historyfile) as f:
+                history = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            bb.warn("Unable to read task durations from %s: %s" % (historyfile, exc))
+            return {}
+        if not isinstance(history, dict):
+            bb.warn("Ignoring invalid task durations file %s" % historyfile)
+            return {}
+        return history
+
+    def estimate_durations(self, tids):
+        """
+        Return a dict of the expected duration of each task in tids
+        """
+        taskdurations = {}
+        for key, duration in self.history.items():
+            taskdurations.setdefault(key.rsplit(":", 1)[-1], []).append(duration)
+        for taskname in taskdurations:
+            taskdurations[taskname] = sum(taskdurations[taskname]) / len(taskdurations[taskname])
+        if self.history:
+            fallback = sum(self.history.values()) / len(self.history)
+        else:
+            fallback = self.default_duration
+
+        durations = {}
+        for tid in tids:
+            duration = self.history.get(self.keys[tid])
+            if duration is None:
+                duration = taskdurations.get(taskname_from_tid(tid), fallback)
+            durations[tid] = duration
+        return durations
+
+    def describe_task(self, taskid):
+        result = super().describe_task(taskid)
+        return result + (' rank %.1f' % self.rank[taskid])
+
+    def taskstarted(self, task):
+        self.started[task] = time.monotonic()
+
+    def taskcompleted(self, task):
+        if task in self.started:
+            self.durations[self.keys[task]] = time.monotonic() - self.started.pop(task)
+
+    def finish(self):
+        if not self.historyfile or not self.durations:
+            return
+
+        try:
+            bb.utils.mkdirhier(os.path.dirname(self.historyfile))
+            with bb.utils.fileslocked([self.historyfile + ".lock"]):
+                # Reload in case another build updated the file in the
+                # meantime, then smooth out variation between runs
+                history = self.load_history(self.historyfile)
+                for key, duration in self.durations.items():
+                    if key in history:
+                        duration = (history[key] + duration) / 2
+                    history[key] = round(duration, 2)
+
+                tmpfile = self.historyfile + ".tmp"
+                with open(tmpfile, "w") as f:
+                    json.dump(history, f, sort_keys=True, indent=0)
+                os.replace(tmpfile, self.historyfile)
+        except OSError as exc:
+            bb.warn("Unable to write task durations to %s: %s" % (self.historyfile, exc))
+        self.durations = {}
+
 class RunTaskEntry(object):
     def __init__(self):
         self.depends = set()
@@ -451,6 +601,88 @@ class RunTaskEntry(object):
         self.task = None
         self.weight = 1
 
+class RunQueueTaskGraph(object):
+    """
+    Compact, integer indexed view of the task dependency graph.
+
+    Tasks are numbered in sorted tid order so comparing two ids gives the
+    same result as comparing the tids themselves. The depends and reverse
+    dependency lists are stored as flat arrays of ids with a per task offset
+    array, which keeps the repeated walks over large task graphs away from
+    string hashing and per task sets. Convert back to tids with self.tids.
+    """
+    def __init__(self, runtaskentries):
+        self.tids = sorted(runtaskentries)
+        self.ids = dict((tid, taskid) for taskid, tid in enumerate(self.tids))
+
+        ids = self.ids
+        self.dep_offsets = array.array("L", [0])
+        self.dep_edges = array.array("L")
+        for tid in self.tids:
+            self.dep_edges.extend(sorted(ids[dep] for dep in runtaskentries[tid].depends))
+            self.dep_offsets.append(len(self.dep_edges))
+
+        # The reverse dependencies are derived from the depends lists
+        counts = [0] * (len(self.tids) + 1)
+        for dep in self.dep_edges:
+            counts[dep + 1] += 1
+        for taskid in range(len(self.tids)):
+            counts[taskid + 1] += counts[taskid]
+        self.revdep_offsets = array.array("L", counts)
+        fill = counts[:-1]
+        edges = [0] * len(self.dep_edges)
+        for taskid in range(len(self.tids)):
+            for i in range(self.dep_offsets[taskid], self.dep_offsets[taskid + 1]):
+                dep = self.dep_edges[i]
+                edges[fill[dep]] = taskid
+                fill[dep] += 1
+        self.revdep_edges = array.array("L", edges)
+
+    def __len__(self):
+        return len(self.tids)
+
+    def depends(self, taskid):
+        return self.dep_edges[self.dep_offsets[taskid]:self.dep_offsets[taskid + 1]]
+
+    def revdeps(self, taskid):
+        return self.revdep_edges[self.revdep_offsets[taskid]:self.revdep_offsets[taskid + 1]]
+
+    def num_depends(self, taskid):
+        return self.dep_offsets[taskid + 1] - self.dep_offsets[taskid]
+
+    def num_revdeps(self, taskid):
+        return self.revdep_offsets[taskid + 1] - self.revdep_offsets[taskid]
+
+    def topological_order(self):
+        """
+        Return the task ids ordered such that each task comes after all
+        of its dependencies. Tasks which are part of a dependency loop are
+        omitted.
+        """
+        order = []
+        for level in self.topological_levels():
+            order.extend(level)
+        return order
+
+    def topological_levels(self):
+        """
+        Yield lists of task ids such that all of the dependencies of the
+        tasks in a list are in the preceding lists. Tasks which are part of
+        a dependency loop are omitted.
+        """
+        remaining = [self.num_depends(taskid) for taskid in range(len(self.tids))]
+        level = [taskid for taskid in range(len(self.tids)) if not remaining[taskid]]
+        while level:
+            yield level
+            next_level = []
+            for taskid in level:
+                for i in range(self.revdep_offsets[taskid], self.revdep_offsets[taskid + 1]):
+                    revdep = self.revdep_edges[i]
+                    remaining[revdep] -= 1
+                    if not remaining[revdep]:
+                        next_level.append(revdep)
+            level = next_level
+
 class RunQueueData:
     """
     BitBake Run Queue implementation
@@ -498,12 +730,13 @@ class RunQueueData:
         taskname = taskname_from_tid(task) + task_name_suffix
         return "%s:%s" % (pn, taskname)
 
-    def circular_depchains_handler(self, tasks):
+    def circular_depchains_handler(self, tasks, graph=None):
         """
         Some tasks aren't buildable, likely due to circular dependency issues.
         Identify the circular dependencies and print them in a user readable format.
         """
-        from copy import deepcopy
+        if graph is None:
+            graph = RunQueueTaskGraph(self.runtaskentries)
 
         valid_chains = []
         explored_deps = {}
@@ -516,51 +749,27 @@ class RunQueueData:
             """
             Reorder a dependency chain so the lowest task id is first
             """
-            lowest = 0
-            new_chain = []
-            for entry in range(len(chain)):
-                if chain[entry] < chain[lowest]:
-                    lowest = entry
-            new_chain.extend(chain[lowest:])
-            new_chain.extend(chain[:lowest])
-            return new_chain
-
-        def chain_compare_equal(chain1, chain2):
-            """
-            Compare two dependency chains and see if they're the same
-            """
-            if len(chain1) != len(chain2):
-                return False
-            for index in range(len(chain1)):
-                if chain1[index] != chain2[index]:
-                    return False
-            return True
-
-        def chain_array_contains(chain, chain_array):
-            """
-            Return True if chain_array contains chain
-            """
-            for ch in chain_array:
-                if chain_compare_equal(ch, chain):
-                    return True
-            return False
-
-        def find_chains(tid, prev_chain):
-            prev_chain.append(tid)
-            total_deps = []
-            total_deps.extend(self.runtaskentries[tid].revdeps)
-            for revdep in self.runtaskentries[tid].revdeps:
+            lowest = chain.index(min(chain))
+            return chain[lowest:] + chain[:lowest]
+
+        def find_chains(taskid, prev_chain):
+            prev_chain.append(taskid)
+            total_deps = set()
+            revdeps = graph.revdeps(taskid)
+            total_deps.update(revdeps)
+            for revdep in revdeps:
                 if revdep in prev_chain:
                     idx = prev_chain.index(revdep)
                     # To prevent duplicates, reorder the chain to start with the lowest taskid
                     # and search through an array of those we've already printed
                     chain = prev_chain[idx:]
                     new_chain = chain_reorder(chain)
-                    if not chain_array_contains(new_chain, valid_chains):
+                    if new_chain not in valid_chains:
                         valid_chains.append(new_chain)
                         msgs.append("Dependency loop #%d found:\n" % len(valid_chains))
                         for dep in new_chain:
-                            msgs.append("  Task %s (dependent Tasks %s)\n" % (dep, self.runq_depends_names(self.runtaskentries[dep].depends)))
+                            tid = graph.tids[dep]
+                            msgs.append("  Task %s (dependent Tasks %s)\n" % (tid, self.runq_depends_names(self.runtaskentries[tid].depends)))
                         msgs.append("\n")
                     if len(valid_chains) > 10:
                         msgs.append("Halted dependency loops search after 10 matches.\n")
@@ -571,27 +780,23 @@ class RunQueueData:
                     scan = True
                 elif revdep in explored_deps[revdep]:
                     scan = True
-                else:
-                    for dep in prev_chain:
-                        if dep in explored_deps[revdep]:
-                            scan = True
+                elif not explored_deps[revdep].isdisjoint(prev_chain):
+                    scan = True
                 if scan:
-                    find_chains(revdep, copy.deepcopy(prev_chain))
-                for dep in explored_deps[revdep]:
-                    if dep not in total_deps:
-                        total_deps.append(dep)
+                    find_chains(revdep, list(prev_chain))
+                total_deps.update(explored_deps[revdep])
 
-            explored_deps[tid] = total_deps
+            explored_deps[taskid] = total_deps
 
         try:
             for task in tasks:
-                find_chains(task, [])
+                find_chains(graph.ids[task], [])
         except TooManyLoops:
             pass
 
         return msgs
 
-    def calculate_task_weights(self, endpoints):
+    def calculate_task_weights(self, endpoints, graph=None):
         """
         Calculate a number representing the "weight" of each task. Heavier weighted tasks
         have more dependencies and hence should be executed sooner for maximum speed.
@@ -599,42 +804,44 @@ class RunQueueData:
         This function also sanity checks the task list finding tasks that are not
         possible to execute due to circular dependencies.
         """
+        if graph is None:
+            graph = RunQueueTaskGraph(self.runtaskentries)
 
-        numTasks = len(self.runtaskentries)
-        weight = {}
-        deps_left = {}
-        task_done = {}
+        numTasks = len(graph)
+        weight = [1] * numTasks
+        deps_left = [graph.num_revdeps(taskid) for taskid in range(numTasks)]
+        task_done = [False] * numTasks
 
-        for tid in self.runtaskentries:
-            task_done[tid] = False
-            weight[tid] = 1
-            deps_left[tid] = len(self.runtaskentries[tid].revdeps)
-
-        for tid in endpoints:
-            weight[tid] = 10
-            task_done[tid] = True
+        endpoints = [graph.ids[tid] for tid in endpoints]
+        for taskid in endpoints:
+            weight[taskid] = 10
+            task_done[taskid] = True
 
-        while True:
+        dep_offsets = graph.dep_offsets
+        dep_edges = graph.dep_edges
+        while endpoints:
             next_points = []
-            for tid in endpoints:
-                for revdep in self.runtaskentries[tid].depends:
-                    weight[revdep] = weight[revdep] + weight[tid]
-                    deps_left[revdep] = deps_left[revdep] - 1
-                    if deps_left[revdep] == 0:
-                        next_points.append(revdep)
-                        task_done[revdep] = True
+            for taskid in endpoints:
+                taskweight = weight[taskid]
+                for i in range(dep_offsets[taskid], dep_offsets[taskid + 1]):
+                    dep = dep_edges[i]
+                    weight[dep] += taskweight
+                    deps_left[dep] -= 1
+                    if deps_left[dep] == 0:
+                        next_points.append(dep)
+                        task_done[dep] = True
             endpoints = next_points
-            if not next_points:
-                break
 
         # Circular dependency sanity check
         problem_tasks = []
+        weights = {}
         for tid in self.runtaskentries:
-            if task_done[tid] is False or deps_left[tid] != 0:
+            taskid = graph.ids[tid]
+            if task_done[taskid] is False or deps_left[taskid] != 0:
                 problem_tasks.append(tid)
                 logger.debug2("Task %s is not buildable", tid)
-                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[tid], deps_left[tid])
-            self.runtaskentries[tid].weight = weight[tid]
+                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[taskid], deps_left[taskid])
+            self.runtaskentries[tid].weight = weights[tid] = weight[taskid]
 
         if problem_tasks:
             message = "%s unbuildable tasks were found.\n" % len(problem_tasks)
@@ -642,14 +849,14 @@ class RunQueueData:
             message = message + "Identifying dependency loops (this may take a short while)...\n"
             logger.error(message)
 
-            msgs = self.circular_depchains_handler(problem_tasks)
+            msgs = self.circular_depchains_handler(problem_tasks, graph)
 
             message = "\n"
             for msg in msgs:
                 message = message + msg
             bb.msg.fatal("RunQueue", message)
 
-        return weight
+        return weights
 
     def prepare(self):
         """
@@ -1120,9 +1327,12 @@ class RunQueueData:
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts(self.cooker.data)
 
+        # Integer indexed view of the final task graph for the walks below
+        graph = RunQueueTaskGraph(self.runtaskentries)
+
         # Calculate task weights
         # Check of higher length circular dependencies
-        self.runq_weight = self.calculate_task_weights(endpoints)
+        self.runq_weight = self.calculate_task_weights(endpoints, graph)
 
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts(self.cooker.data)
@@ -1273,26 +1483,33 @@ class RunQueueData:
 
         bb.parse.siggen.set_setscene_tasks(self.runq_setscene_tids)
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(self.runtaskentries)
-        while todeal:
-            for tid in todeal.copy():
-                if not (self.runtaskentries[tid].depends - dealtwith):
-                    dealtwith.add(tid)
-                    todeal.remove(tid)
-                    self.prepare_task_hash(tid)
-                bb.event.check_for_interrupts(self.cooker.data)
+        # Iterate over the task list and call into the siggen code, dependencies
+        # first. The tasks in each level only depend on tasks in earlier levels,
+        # so their unihashes can be looked up together in a single batch rather
+        # than waiting for the hash equivalence server once per task.
+        for level in graph.topological_levels():
+            self.prepare_task_hashes([graph.tids[taskid] for taskid in level])
 
         bb.parse.siggen.writeout_file_checksum_cache()
 
         #self.dump_data()
         return len(self.runtaskentries)
 
+    def prepare_task_hashes(self, tids):
+        """
+        Compute the hashes of tids, whose dependencies must already have
+        theirs, and look up their unihashes in one batch
+        """
+        for tid in tids:
+            bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+            self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+            bb.event.check_for_interrupts(self.cooker.data)
+        unihashes = bb.parse.siggen.get_unihashes(tids)
+        for tid in tids:
+            self.runtaskentries[tid].unihash = unihashes[tid]
+
     def prepare_task_hash(self, tid):
-        bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-        self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-        self.runtaskentries[tid].unihash = bb.parse.siggen.get_unihash(tid)
+        self.prepare_task_hashes([tid])
 
     def dump_data(self):
         """
@@ -1337,13 +1554,7 @@ class RunQueue:
 
     @staticmethod
     def send_pickled_data(worker, data, name):
-        msg = bytearray()
-        msg.extend(b"<" + name.encode() + b">")
-        pickled_data = pickle.dumps(data)
-        msg.extend(len(pickled_data).to_bytes(4, 'big'))
-        msg.extend(pickled_data)
-        msg.extend(b"</" + name.encode() + b">")
-        worker.stdin.write(msg)
+        worker.stdin.write(worker_frame(name, pickle.dumps(data)))
 
     def _start_worker(self, mc, fakeroot = False, rqexec = None):
         logger.debug("Starting bitbake-worker")
@@ -1613,6 +1824,7 @@ class RunQueue:
 
         if build_done and self.rqexe:
             bb.parse.siggen.save_unitaskhashes()
+            self.rqexe.sched.finish()
             self.teardown_workers()
             if self.rqexe:
                 if self.rqexe.stats.failed:
@@ -2079,6 +2291,7 @@ class RunQueueExecute:
 
     def task_complete(self, task):
         self.stats.taskCompleted()
+        self.sched.taskcompleted(task)
         bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
         self.task_completeoutright(task)
         self.runq_tasksrun.add(task)
@@ -2386,6 +2599,7 @@ class RunQueueExecute:
             self.build_stamps2.append(self.build_stamps[task])
             self.runq_running.add(task)
             self.stats.taskActive()
+            self.sched.taskstarted(task)
             if self.can_start_task():
                 return True
 
@@ -2560,13 +2774,23 @@ class RunQueueExecute:
         while next:
             current = next.copy()
             next = set()
+            ready = []
             for tid in current:
                 if self.rqdata.runtaskentries[p].depends and not self.rqdata.runtaskentries[tid].depends.isdisjoint(total):
                     continue
+                ready.append(tid)
+
+            # Look up the new unihashes of everything ready in one batch
+            newhashes = {}
+            for tid in ready:
+                newhashes[tid] = bb.parse.siggen.get_taskhash(tid, self.rqdata.runtaskentries[tid].depends, self.rqdata.dataCaches)
+            newunis = bb.parse.siggen.get_unihashes(ready)
+
+            for tid in ready:
                 orighash = self.rqdata.runtaskentries[tid].hash
-                newhash = bb.parse.siggen.get_taskhash(tid, self.rqdata.runtaskentries[tid].depends, self.rqdata.dataCaches)
+                newhash = newhashes[tid]
                 origuni = self.rqdata.runtaskentries[tid].unihash
-                newuni = bb.parse.siggen.get_unihash(tid)
+                newuni = newunis[tid]
                 # FIXME, need to check it can come from sstate at all for determinism?
                 remapped = False
                 if newuni == origuni:
@@ -3236,6 +3460,60 @@ class taskUniHashUpdate(bb.event.Event):
         self.unihash = unihash
         bb.event.Event.__init__(self)
 
+#
+# Messages between the server and bitbake-worker are framed as a one byte
+# message type followed by the length of the payload as a 4 byte big endian
+# number. The payload of an "events" message is a batch of pickled events,
+# each prefixed by its length, so batches can simply be concatenated.
+#
+# "started" and "failed" are only used between the worker and its zygotes.
+#
+WORKER_MESSAGES = ("cookerconfig", "extraconfigdata", "workerdata", "newtaskhashes", "runtask",
+                   "finishnow", "ping", "quit", "events", "exitcode", "started", "failed")
+_worker_message_ids = dict((name, i) for i, name in enumerate(WORKER_MESSAGES))
+_worker_frame_header = struct.Struct(">BI")
+_worker_event_header = struct.Struct(">I")
+
+def worker_frame(name, payload):
+    return _worker_frame_header.pack(_worker_message_ids[name], len(payload)) + payload
+
+def worker_event(pickled):
+    """
+    Return the pickled event as a batch of one event for an "events" message
+    """
+    return _worker_event_header.pack(len(pickled)) + pickled
+
+def read_worker_frames(queue):
+    """
+    Remove the complete messages from the start of the queue bytearray and
+    return them as a list of (name, payload) tuples
+    """
+    frames = []
+    pos = 0
+    while len(queue) - pos >= _worker_frame_header.size:
+        msgid, length = _worker_frame_header.unpack_from(queue, pos)
+        start = pos + _worker_frame_header.size
+        if len(queue) < start + length:
+            break
+        if msgid >= len(WORKER_MESSAGES):
+            raise ValueError("Invalid worker message type %d" % msgid)
+        frames.append((WORKER_MESSAGES[msgid], bytes(queue[start:start + length])))
+        pos = start + length
+    if pos:
+        del queue[:pos]
+    return frames
+
+def worker_events(payload):
+    """
+    Iterate over the pickled events of an "events" message
+    """
+    pos = 0
+    while pos < len(payload):
+        length, = _worker_event_header.unpack_from(payload, pos)
+        pos += _worker_event_header.size
+        yield payload[pos:pos + length]
+        pos += length
+
 class runQueuePipe():
     """
     Abstraction for a pipe between a worker thread and the server
@@ -3266,40 +3544,27 @@ class runQueuePipe():
             if e.errno != errno.EAGAIN:
                 raise
         end = len(self.queue)
-        found = True
-        while found and self.queue:
-            found = False
-            index = self.queue.find(b"</event>")
-            while index != -1 and self.queue.startswith(b"<event>"):
-                try:
-                    event = pickle.loads(self.queue[7:index])
-                except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
-                    if isinstance(e, pickle.UnpicklingError) and "truncated" in str(e):
-                        # The pickled data could contain "</event>" so search for the next occurance
-                        # unpickling again, this should be the only way an unpickle error could occur
-                        index = self.queue.find(b"</event>", index + 1)
-                        continue
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
-                bb.event.fire_from_worker(event, self.d)
-                if isinstance(event, taskUniHashUpdate):
-                    self.rqexec.updated_taskhash_queue.append((event.taskid, event.unihash))
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find(b"</event>")
-            index = self.queue.find(b"</exitcode>")
-            while index != -1 and self.queue.startswith(b"<exitcode>"):
+        for name, payload in read_worker_frames(self.queue):
+            if name == "events":
+                for pickled in worker_events(payload):
+                    try:
+                        event = pickle.loads(pickled)
+                    except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
+                        bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, pickled))
+                    # The UI handlers can be sent the event as pickled by the worker
+                    bb.event.fire_from_worker(event, self.d, pickled)
+                    if isinstance(event, taskUniHashUpdate):
+                        self.rqexec.updated_taskhash_queue.append((event.taskid, event.unihash))
+            elif name == "exitcode":
                 try:
-                    task, status = pickle.loads(self.queue[10:index])
+                    task, status = pickle.loads(payload)
                 except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, payload))
                 (_, _, _, taskfn) = split_tid_mcfn(task)
                 fakerootlog = None
                 if self.fakerootlogs and taskfn and taskfn in self.fakerootlogs:
                     fakerootlog = self.fakerootlogs[taskfn]
                 self.rqexec.runqueue_process_waitpid(task, status, fakerootlog=fakerootlog)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find(b"</exitcode>")
         return (end > start)
 
     def close(self):
@@ -870,7 +870,9 @@ class ConnectionWriter(object):
         gc.enable()
 
     def send(self, obj):
-        obj = multiprocessing.reduction.ForkingPickler.dumps(obj)
+        self.sendpickle(multiprocessing.reduction.ForkingPickler.dumps(obj))
+
+    def sendpickle(self, obj):
         # See notes/code in CookerParser
         # We must not terminate holding this lock else processes will hang.
         # For SIGTERM, raising afterwards avoids this.
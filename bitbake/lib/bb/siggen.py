@@ -687,11 +687,10 @@ class SignatureGeneratorUniHashMixIn(object):
                 uncached_query[key] = unihash
 
         if self.max_parallel <= 1 or len(uncached_query) <= 1:
-            # No parallelism required. Make the query serially with the single client
+            # No parallelism required. Pipeline the queries over the single client
             with self.client() as client:
-                uncached_result = {
-                    key: client.unihash_exists(value) for key, value in uncached_query.items()
-                }
+                keys = list(uncached_query.keys())
+                uncached_result = dict(zip(keys, client.unihash_exists_batch([uncached_query[key] for key in keys])))
         else:
             with self.client_pool() as client_pool:
                 uncached_result = client_pool.unihashes_exist(uncached_query)
@@ -726,10 +725,10 @@ class SignatureGeneratorUniHashMixIn(object):
             return result
 
         if self.max_parallel <= 1 or len(queries) <= 1:
-            # No parallelism required. Make the query serially with the single client
+            # No parallelism required. Pipeline the queries over the single client
             with self.client() as client:
-                for tid, args in queries.items():
-                    query_result[tid] = client.get_unihash(*args)
+                keys = list(queries.keys())
+                query_result = dict(zip(keys, client.get_unihash_batch([queries[key] for key in keys])))
         else:
             with self.client_pool() as client_pool:
                 query_result = client_pool.get_unihashes(queries)
@@ -0,0 +1,411 @@
+#
+# BitBake Tests for cache.py
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import sys
+import pickle
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import bb
+import bb.cache
+import bb.data
+import bb.methodpool
+
+class TestRecipeInfo(bb.cache.RecipeInfoCommon):
+    cachefile = "bb_cache_test.dat"
+
+    def __init__(self, value):
+        self.value = value
+
+def siggen_info(varvals):
+    info = bb.cache.SiggenRecipeInfo.__new__(bb.cache.SiggenRecipeInfo)
+    info.siggen_gendeps = {}
+    info.siggen_taskdeps = []
+    info.siggen_varvals = varvals
+    return info
+
+class IndexedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cachefile = os.path.join(self.tempdir.name, "bb_cache_test.dat")
+
+    def tearDown(self):
+        bb.cache.SiggenRecipeInfo.reset()
+        self.tempdir.cleanup()
+
+    def write(self, entries):
+        lazy = bb.cache.LazyRecipeInfoCache()
+        for key, value in entries.items():
+            lazy[key] = value
+        self.write_lazy(lazy, type(next(iter(entries.values()))[0]))
+
+    def write_lazy(self, lazy, cache_class):
+        table = bb.cache.CacheValueTable()
+        bb.cache.IndexedCacheFile.write(self.cachefile, lazy.records(0, cache_class, table), None, table)
+
+    def test_roundtrip(self):
+        self.write({"a.bb": [TestRecipeInfo("a")], "b.bb": [TestRecipeInfo("b")]})
+
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        self.addCleanup(cachefile.close)
+        self.assertEqual(cachefile.cache_version, bb.cache.__cache_version__)
+        self.assertEqual(cachefile.bitbake_version, bb.__version__)
+        self.assertEqual(set(cachefile.index), {"a.bb", "b.bb"})
+        self.assertEqual(cachefile.load("b.bb").value, "b")
+        self.assertEqual(cachefile.load("a.bb").value, "a")
+
+    def test_invalid(self):
+        with open(self.cachefile, "wb") as f:
+            pickle.dump(bb.cache.__cache_version__, f)
+        with self.assertRaises(ValueError):
+            bb.cache.IndexedCacheFile(self.cachefile)
+
+    def test_lazy_decode(self):
+        self.write({"a.bb": [TestRecipeInfo("a")], "b.bb": [TestRecipeInfo("b")]})
+
+        lazy = bb.cache.LazyRecipeInfoCache([bb.cache.IndexedCacheFile(self.cachefile)])
+        self.addCleanup(lazy.close)
+        self.assertEqual(len(lazy), 2)
+        self.assertIn("a.bb", lazy)
+        self.assertNotIn("c.bb", lazy)
+        self.assertEqual(lazy.entries, {})
+
+        self.assertEqual(lazy["a.bb"][0].value, "a")
+        self.assertEqual(list(lazy.entries), ["a.bb"])
+        with self.assertRaises(KeyError):
+            lazy["c.bb"]
+
+        del lazy["b.bb"]
+        self.assertNotIn("b.bb", lazy)
+        lazy["c.bb"] = [TestRecipeInfo("c")]
+        self.assertEqual(set(lazy), {"a.bb", "c.bb"})
+
+    def test_rewrite(self):
+        self.write({"a.bb": [TestRecipeInfo("a")], "b.bb": [TestRecipeInfo("b")]})
+
+        lazy = bb.cache.LazyRecipeInfoCache([bb.cache.IndexedCacheFile(self.cachefile)])
+        self.addCleanup(lazy.close)
+        # Reassigning the same entry doesn't require re-encoding it
+        lazy["a.bb"] = lazy["a.bb"]
+        self.assertIn("a.bb", lazy.ondisk)
+        lazy["b.bb"] = [TestRecipeInfo("b2")]
+        self.assertNotIn("b.bb", lazy.ondisk)
+        self.write_lazy(lazy, TestRecipeInfo)
+
+        # The old mapping must still be readable after the file was replaced
+        self.assertEqual(lazy.cachefiles[0].load("a.bb").value, "a")
+
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        self.addCleanup(cachefile.close)
+        self.assertEqual(cachefile.load("a.bb").value, "a")
+        self.assertEqual(cachefile.load("b.bb").value, "b2")
+
+    def test_siggen_records_independent(self):
+        shared = frozenset(["A", "B"])
+        self.write({"a.bb": [siggen_info({"do_a": shared})], "b.bb": [siggen_info({"do_b": shared})]})
+
+        cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+        self.addCleanup(cachefile.close)
+        # Decoding in a different order from the one written must still work
+        self.assertEqual(cachefile.load("b.bb").siggen_varvals, {"do_b": shared})
+        self.assertEqual(cachefile.load("a.bb").siggen_varvals, {"do_a": shared})
+
+    def test_siggen_values_shared(self):
+        shared = "x" * 1000
+        self.write({"a.bb": [siggen_info({"do_a": shared})], "b.bb": [siggen_info({"do_b": shared})]})
+        with open(self.cachefile, "rb") as f:
+            self.assertEqual(f.read().count(shared.encode()), 1)
+
+    def test_siggen_table_restart(self):
+        self.write({"a.bb": [siggen_info({"do_a": "a"})], "b.bb": [siggen_info({"do_b": "b"})]})
+
+        sizes = []
+        for i in range(4):
+            lazy = bb.cache.LazyRecipeInfoCache([bb.cache.IndexedCacheFile(self.cachefile)])
+            self.addCleanup(lazy.close)
+            lazy["b.bb"] = [siggen_info({"do_b": "b%d" % i})]
+            self.write_lazy(lazy, bb.cache.SiggenRecipeInfo)
+
+            cachefile = bb.cache.IndexedCacheFile(self.cachefile)
+            self.addCleanup(cachefile.close)
+            self.assertEqual(cachefile.load("a.bb").siggen_varvals, {"do_a": "a"})
+            self.assertEqual(cachefile.load("b.bb").siggen_varvals, {"do_b": "b%d" % i})
+            sizes.append(len(cachefile.table))
+
+        # The values of the replaced records are dropped once the table doubled
+        self.assertEqual(sizes, [3, 4, 5, 2])
+
+class FakeDataBuilder(object):
+    def __init__(self, cachedir):
+        self.data = bb.data.init()
+        self.data.setVar("CACHE", cachedir)
+
+class RevdepsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache = bb.cache.Cache(FakeDataBuilder(self.tempdir.name), "", "hash", [TestRecipeInfo])
+        self.files = {}
+        for name in ("a.bb", "b.bb", "common.bbclass", "a.inc"):
+            self.files[name] = os.path.join(self.tempdir.name, name)
+            with open(self.files[name], "w") as f:
+                f.write(name)
+        bb.parse.clear_cache()
+
+    def tearDown(self):
+        bb.parse.clear_cache()
+        self.tempdir.cleanup()
+
+    def add(self, fn, *depends):
+        fn = self.files[fn]
+        self.cache.depends_cache[fn] = [TestRecipeInfo(fn)]
+        self.cache.revdeps_pending[fn] = [(fn, bb.parse.cached_mtime(fn))] + \
+            [(self.files[f], bb.parse.cached_mtime(self.files[f])) for f in depends]
+
+    def test_check_depends(self):
+        self.add("a.bb", "common.bbclass", "a.inc")
+        self.add("b.bb", "common.bbclass")
+        self.cache.update_revdeps()
+        self.assertEqual(self.cache.revdeps_indexed, {self.files["a.bb"], self.files["b.bb"]})
+
+        self.cache.check_depends()
+        self.assertEqual(self.cache.depends_changed, {})
+
+        bb.parse.clear_cache()
+        os.utime(self.files["a.inc"], (0, 0))
+        self.cache.check_depends()
+        self.assertEqual(self.cache.depends_changed, {self.files["a.bb"]: self.files["a.inc"]})
+
+        bb.parse.clear_cache()
+        os.unlink(self.files["common.bbclass"])
+        self.cache.check_depends()
+        self.assertEqual(set(self.cache.depends_changed), {self.files["a.bb"], self.files["b.bb"]})
+
+    def test_update_revdeps(self):
+        self.add("a.bb", "common.bbclass")
+        self.add("b.bb", "common.bbclass")
+        self.cache.update_revdeps()
+
+        del self.cache.depends_cache[self.files["b.bb"]]
+        self.cache.depends_cache.ondisk.add(self.files["a.bb"])
+        self.cache.update_revdeps()
+        self.assertEqual(self.cache.revdeps_indexed, {self.files["a.bb"]})
+        self.assertNotIn(self.files["b.bb"], self.cache.revdeps)
+        for mtimes in self.cache.revdeps.values():
+            for fns in mtimes.values():
+                self.assertEqual(fns, {self.files["a.bb"]})
+
+    def test_update_revdeps_reused(self):
+        # The cache is kept in memory for the next parse, so entries parsed
+        # by the last one stay indexed although they aren't in a cache file
+        self.add("a.bb", "common.bbclass")
+        self.add("b.bb", "common.bbclass")
+        self.cache.update_revdeps()
+
+        self.cache.start_check()
+        self.add("a.bb", "a.inc")
+        self.cache.update_revdeps()
+        self.assertEqual(self.cache.revdeps_indexed, {self.files["a.bb"], self.files["b.bb"]})
+        self.assertEqual(self.cache.revdeps[self.files["common.bbclass"]],
+                         {bb.parse.cached_mtime(self.files["common.bbclass"]): {self.files["b.bb"]}})
+        self.assertIn(self.files["a.bb"], self.cache.revdeps[self.files["a.inc"]][bb.parse.cached_mtime(self.files["a.inc"])])
+
+class LazyLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.classfile = os.path.join(self.tempdir.name, "common.bbclass")
+        with open(self.classfile, "w") as f:
+            f.write("common")
+        bb.parse.clear_cache()
+        self.addCleanup(bb.parse.clear_cache)
+        self.addCleanup(bb.cache.SiggenRecipeInfo.reset)
+
+    def new_cache(self):
+        cache = bb.cache.Cache(FakeDataBuilder(self.tempdir.name), "", "hash",
+                               [bb.cache.CoreRecipeInfo, bb.cache.SiggenRecipeInfo])
+        cache.prepare_cache(lambda p: None)
+        return cache
+
+    def parse(self, pn):
+        fn = os.path.join(self.tempdir.name, "%s.bb" % pn)
+        with open(fn, "w") as f:
+            f.write(pn)
+        d = bb.data.init()
+        d.setVar("PN", pn)
+        d.setVar("__BBTASKS", ["do_build"])
+        d.setVar("__depends", [(self.classfile, bb.parse.cached_mtime(self.classfile))])
+        d.setVar("__siggen_varvals", {"do_build": "%s value" % pn})
+        d.setVar("__siggen_gendeps", {"do_build": frozenset(["PN"])})
+        d.setVar("__siggen_taskdeps", {"do_build": frozenset(["PN"])})
+        return fn, [bb.cache.CoreRecipeInfo(fn, d), bb.cache.SiggenRecipeInfo(fn, d)]
+
+    def test_startup_decodes(self):
+        cache = self.new_cache()
+        cachedata = bb.cache.CacheData(cache.caches_array)
+        fns = []
+        for i in range(20):
+            fn, info_array = self.parse("recipe%d" % i)
+            cache.add_info(fn, info_array, cachedata, parsed=True)
+            fns.append(fn)
+        cache.sync()
+        bb.cache.SiggenRecipeInfo.reset()
+
+        decoded = []
+        load = bb.cache.IndexedCacheFile.load
+
+        def counting_load(cachefile, key):
+            value = load(cachefile, key)
+            decoded.append(type(value).__name__)
+            return value
+
+        # As when starting "bitbake -e recipe3", all the recipes are loaded
+        # from the cache but only one has its task signatures computed
+        with patch.object(bb.cache.IndexedCacheFile, "load", counting_load):
+            cache = self.new_cache()
+            # Checking whether the entries are valid only reads the index
+            for fn in fns:
+                self.assertTrue(cache.cacheValid(fn, []))
+            self.assertEqual(decoded, [])
+
+            cachedata = bb.cache.CacheData(cache.caches_array)
+            for fn in fns:
+                for virtualfn, info_array in cache.loadCached(fn, []):
+                    cache.add_info(virtualfn, info_array, cachedata)
+            self.assertEqual(decoded, ["CoreRecipeInfo"] * 20)
+            self.assertEqual(cachedata.pkg_fn[fns[3]], "recipe3")
+
+            self.assertEqual(cachedata.siggen_varvals[fns[3]], {"do_build": "recipe3 value"})
+            self.assertEqual(cachedata.siggen_gendeps[fns[3]], {"do_build": frozenset(["PN"])})
+            self.assertIn(fns[4], cachedata.siggen_taskdeps)
+            self.assertEqual(decoded, ["CoreRecipeInfo"] * 20 + ["SiggenRecipeInfo"])
+
+    def test_invalid_without_decoding(self):
+        cache = self.new_cache()
+        cachedata = bb.cache.CacheData(cache.caches_array)
+        for pn in ("a", "b"):
+            fn, info_array = self.parse(pn)
+            cache.add_info(fn, info_array, cachedata, parsed=True)
+        cache.sync()
+
+        os.utime(self.classfile, (0, 0))
+        bb.parse.clear_cache()
+        with patch.object(bb.cache.IndexedCacheFile, "load") as load:
+            cache = self.new_cache()
+            fn = os.path.join(self.tempdir.name, "a.bb")
+            self.assertFalse(cache.cacheValid(fn, []))
+            self.assertNotIn(fn, cache.depends_cache)
+            load.assert_not_called()
+
+class TestMultiProcessCache(bb.cache.MultiProcessCache):
+    cache_file_name = "bb_test_cache.dat"
+    CACHE_VERSION = 1
+
+class MultiProcessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.cachefile = os.path.join(self.tempdir.name, TestMultiProcessCache.cache_file_name)
+
+    def new_cache(self):
+        cache = TestMultiProcessCache()
+        cache.init_cache(self.tempdir.name)
+        return cache
+
+    def segments(self):
+        return [f for f in os.listdir(self.tempdir.name) if f.startswith(TestMultiProcessCache.cache_file_name + "-")]
+
+    def test_segments(self):
+        for key in ("a", "b"):
+            cache = self.new_cache()
+            cache.cachedata_extras[0][key] = key.upper()
+            cache.save_extras()
+            # Entries are only written once
+            cache.save_extras()
+            self.assertEqual(cache.cachedata[0][key], key.upper())
+        self.assertEqual(len(self.segments()), 2)
+        self.assertFalse(os.path.exists(self.cachefile))
+        self.assertEqual(self.new_cache().cachedata[0], {"a": "A", "b": "B"})
+
+        cache.save_merge()
+        self.assertEqual(self.segments(), [])
+        self.assertTrue(os.path.exists(self.cachefile))
+        self.assertEqual(self.new_cache().cachedata[0], {"a": "A", "b": "B"})
+
+    def test_compaction_threshold(self):
+        cache = self.new_cache()
+        cache.cachedata_extras[0].update((str(i), "x" * 100) for i in range(100))
+        cache.save_extras()
+        cache.save_merge()
+        self.assertEqual(self.segments(), [])
+
+        cache = self.new_cache()
+        cache.cachedata_extras[0]["new"] = "y"
+        cache.save_extras()
+        cache.save_merge()
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(self.new_cache().cachedata[0]["new"], "y")
+
+        for i in range(TestMultiProcessCache.COMPACT_SEGMENTS):
+            cache.cachedata_extras[0]["new%s" % i] = "y"
+            cache.save_extras()
+        cache.save_merge()
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(len(self.new_cache().cachedata[0]), 100 + 1 + TestMultiProcessCache.COMPACT_SEGMENTS)
+
+    def test_invalid_segment(self):
+        with open(self.cachefile + "-1", "wb") as f:
+            pickle.dump([[{"old": "X"}], 0], f)
+        with open(self.cachefile + "-2", "wb") as f:
+            f.write(b"corrupt")
+        cache = self.new_cache()
+        self.assertEqual(cache.cachedata[0], {})
+        cache.cachedata_extras[0]["a"] = "A"
+        cache.save_extras()
+        cache.save_merge()
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.new_cache().cachedata[0], {"a": "A"})
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def test_roundtrip(self):
+        cache = bb.methodpool.CompileCache()
+        cache.init_cache(self.tempdir.name)
+        self.assertIsNone(cache.get("1 + 2"))
+        cache.add("1 + 2", compile("1 + 2", "<test>", "eval"))
+        self.assertEqual(eval(cache.get("1 + 2")), 3)
+        cache.save_extras()
+        cache.save_merge()
+
+        cache = bb.methodpool.CompileCache()
+        cache.init_cache(self.tempdir.name)
+        self.assertIn(sys.implementation.cache_tag, cache.cachefile)
+        code = cache.get("1 + 2")
+        self.assertEqual(code.co_filename, "<test>")
+        self.assertEqual(eval(code), 3)
+
+    def test_snippet_cached(self):
+        d = bb.data.init()
+        d.setVar("FOO", "${@'compile' + 'cachetest'}")
+        self.assertEqual(d.getVar("FOO"), "compilecachetest")
+        code = bb.methodpool.compile_cache("'compile' + 'cachetest'", "Var <FOO>", "eval")
+        self.assertEqual(code.co_filename, "Var <FOO>")
+        self.assertIsNone(bb.methodpool.compile_cache("'compile' + 'cachetest'", "Var <BAR>", "eval"))
+
+    def test_function_location_cached(self):
+        text = "def compilecachetest():\n    pass\n"
+        code = bb.utils.better_compile(text, "compilecachetest", "/a/test.bbclass", lineno=10)
+        self.assertEqual(code.co_consts[0].co_firstlineno, 11)
+        code = bb.utils.better_compile(text, "compilecachetest", "/a/test.bbclass", lineno=20)
+        self.assertEqual(code.co_consts[0].co_firstlineno, 21)
+        code = bb.utils.better_compile(text, "compilecachetest", "/b/test.bbclass", lineno=20)
+        self.assertEqual(code.co_filename, "/b/test.bbclass")
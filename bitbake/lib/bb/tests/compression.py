@@ -12,6 +12,7 @@ import os
 import shutil
 import tempfile
 import unittest
+import unittest.mock
 import subprocess
 
 
@@ -88,6 +89,28 @@ class ZStdTests(CompressionTests, unittest.TestCase):
             yield f
 
 
+class ZStdThreadsTests(CompressionTests, unittest.TestCase):
+    def setUp(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("'zstd' not found")
+        super().setUp()
+
+    @contextlib.contextmanager
+    def do_open(self, *args, **kwargs):
+        # zstd compresses with several threads when pzstd isn't found
+        which = shutil.which
+        with unittest.mock.patch("shutil.which", lambda cmd: None if cmd == "pzstd" else which(cmd)):
+            with bb.compress.zstd.open(*args, num_threads=2, **kwargs) as f:
+                yield f
+
+    def test_threads(self):
+        tmp_file = self.tmpdir / "compressed"
+        with self.do_open(tmp_file, mode="wb") as f:
+            self.assertEqual(f.p.args[:2], ["zstd", "-T2"])
+        with self.do_open(tmp_file, mode="rb") as f:
+            self.assertEqual(f.p.args[:2], ["zstd", "-d"])
+
+
 class PZStdTests(CompressionTests, unittest.TestCase):
     def setUp(self):
         if shutil.which("pzstd") is None:
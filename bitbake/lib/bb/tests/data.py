@@ -431,6 +431,29 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("BAR:append:unusedoverride", "testvalue2")
         self.assertEqual(self.d.getVar("BAR"), None)
 
+    def test_override_changes(self):
+        self.d.setVar("TEST:foo", "testvalue2")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue2")
+        self.d.setVar("TEST:local", "testvalue3")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue3")
+        self.d.delVar("TEST:local")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue2")
+        self.d.setVar("OVERRIDES", "bar:local")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue")
+        d2 = self.d.createCopy()
+        d2.setVar("OVERRIDES", "foo")
+        self.assertEqual(d2.getVar("TEST"), "testvalue2")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue")
+
+    def test_override_stats(self):
+        stats = self.d.enableOverrideStats()
+        self.d.setVar("TEST:foo", "testvalue2")
+        self.assertEqual(self.d.getVar("TEST"), "testvalue2")
+        self.assertEqual(self.d.getVar("TEST", False), "testvalue2")
+        self.assertEqual(self.d.createCopy().getVar("TEST", False), "testvalue2")
+        self.assertEqual(stats["lookups"], 3)
+        self.assertEqual(stats["resolved"], 2)
+
 class TestKeyExpansion(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
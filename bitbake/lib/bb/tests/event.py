@@ -9,16 +9,21 @@
 import collections
 import importlib
 import logging
+import os
 import pickle
+import shutil
+import subprocess
 import threading
 import time
 import unittest
 import tempfile
 from unittest.mock import Mock
 from unittest.mock import call
+from unittest.mock import patch
 
 import bb
 import bb.event
+import bb.eventlog
 from bb.msg import BBLogFormatter
 
 
@@ -57,6 +62,13 @@ class PickleEventQueueStub(EventQueueStubBase):
         super(PickleEventQueueStub, self)._store_event_data_string(event)
 
 
+class SlowPickleEvent(bb.event.Event):
+    """ Event taking a while to pickle """
+    def __getstate__(self):
+        time.sleep(0.5)
+        return self.__dict__
+
+
 class UIClientStub(object):
     """ Class used as specification for UI event handler stub objects """
     def __init__(self):
@@ -292,6 +304,71 @@ class EventHandlingTest(unittest.TestCase):
         self.assertEqual(self._test_ui2.event.sendpickle.call_args_list,
                          expected)
 
+    def test_fire_ui_handlers_pickle_once(self):
+        """ Test events are pickled once for all the UI handlers """
+        self._test_ui1.event = PickleEventQueueStub()
+        bb.event.register_UIHhandler(self._test_ui1, mainui=True)
+        self._test_ui2.event = PickleEventQueueStub()
+        bb.event.register_UIHhandler(self._test_ui2, mainui=True)
+        event1 = bb.event.OperationStarted()
+        with patch("bb.event.pickle.dumps", wraps=pickle.dumps) as dumps:
+            bb.event.fire_ui_handlers(event1, None)
+        self.assertEqual(dumps.call_count, 1)
+        self.assertEqual(self._test_ui1.event.event_calls, ["OperationStarted"])
+        self.assertEqual(self._test_ui2.event.event_calls, ["OperationStarted"])
+
+        stats = bb.event.get_uihandler_stats()
+        self.assertEqual(set(stats), {1, 2})
+        self.assertEqual(stats[1]["events"], 1)
+        self.assertEqual(stats[1]["bytes"], len(pickle.dumps(event1)))
+        self.assertEqual(stats[1]["pending"], 0)
+
+    def test_fire_ui_handlers_failed(self):
+        """ Test UI handlers failing to send events are removed """
+        self._test_ui1.event = Mock(spec_set=EventQueueStub)
+        self._test_ui1.event.send.side_effect = OSError
+        bb.event.register_UIHhandler(self._test_ui1, mainui=True)
+        self._test_ui2.event = Mock(spec_set=EventQueueStub)
+        bb.event.register_UIHhandler(self._test_ui2, mainui=True)
+        event1 = bb.event.OperationStarted()
+        event2 = bb.event.OperationCompleted(total=1)
+        bb.event.fire_ui_handlers(event1, None)
+        bb.event.fire_ui_handlers(event2, None)
+        self.assertEqual(self._test_ui1.event.send.call_args_list, [call(event1)])
+        self.assertEqual(self._test_ui2.event.send.call_args_list, [call(event1), call(event2)])
+        self.assertEqual(list(bb.event.get_uihandler_stats()), [2])
+
+    def test_fire_ui_handlers_slow_pickle(self):
+        """ Test an event slow to pickle doesn't hold up the events fired
+            by other threads """
+        self._test_ui1.event = PickleEventQueueStub()
+        bb.event.register_UIHhandler(self._test_ui1, mainui=True)
+        worker1 = threading.Thread(target=bb.event.fire_ui_handlers,
+                                   args=(SlowPickleEvent(), None))
+        worker1.start()
+        time.sleep(0.05)
+        bb.event.fire_ui_handlers(bb.event.OperationStarted(), None)
+        self.assertEqual(self._test_ui1.event.event_calls, ["OperationStarted"])
+        worker1.join()
+        self.assertEqual(self._test_ui1.event.event_calls,
+                         ["OperationStarted", "SlowPickleEvent"])
+        self.assertEqual(bb.event.get_uihandler_stats()[1]["pending"], 0)
+
+    def test_fire_ui_handlers_pickle_interrupted(self):
+        """ Test an event failing to pickle doesn't stop the later events """
+        self._test_ui1.event = PickleEventQueueStub()
+        bb.event.register_UIHhandler(self._test_ui1, mainui=True)
+        self._test_ui2.event = EventQueueStub()
+        bb.event.register_UIHhandler(self._test_ui2, mainui=True)
+        event1 = SlowPickleEvent()
+        with patch.object(SlowPickleEvent, "__getstate__", side_effect=KeyboardInterrupt):
+            bb.event.fire_ui_handlers(event1, None)
+        bb.event.fire_ui_handlers(bb.event.OperationStarted(), None)
+        self.assertEqual(self._test_ui1.event.event_calls, [])
+        self.assertEqual(self._test_ui2.event.event_calls,
+                         ["SlowPickleEvent", "OperationStarted"])
+        self.assertEqual(list(bb.event.get_uihandler_stats()), [2])
+
     def test_ui_handler_mask_filter(self):
         """ Test filters for UI handlers """
         mask = ["bb.event.OperationStarted"]
@@ -456,9 +533,10 @@ class EventHandlingTest(unittest.TestCase):
         """ Test enable_threadlock method """
         self._set_threadlock_test_mockups()
         self._set_and_run_threadlock_test_workers()
-        # Calls to UI handlers should be in order as all the registered
-        # handlers for the event coming from the first worker should be
-        # called before processing the event from the second worker.
+        # Each UI handler should get the event coming from the first worker
+        # before the event from the second worker. The second worker sends
+        # both events to the second handler while the first worker is busy
+        # with the first handler.
         self.assertEqual(self._threadlock_test_calls,
                          ["w1_ui1", "w1_ui2", "w2_ui1", "w2_ui2"])
 
@@ -974,3 +1052,68 @@ test_lineno_in_eventhandler[eventmask] = "bb.event.ConfigParsed"
 
         output = "".join(logs.output)
         self.assertTrue(" line 5\n" in output)
+
+class EventLogTest(unittest.TestCase):
+    """ Compressed event log test class """
+
+    def setUp(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("'zstd' not found")
+        self._t = tempfile.TemporaryDirectory()
+        self.addCleanup(self._t.cleanup)
+        self.logfile = os.path.join(self._t.name, "eventlog.zst")
+
+    def _write_log(self):
+        """ Write a log of three chunks, the task of the second chunk is
+            "a.bb:do_compile" """
+        writer = bb.eventlog.EventLogWriter(self.logfile)
+        writer.write(bb.eventlog.VARIABLES, pickle.dumps({"A": {"v": "1"}}))
+        for chunk in range(3):
+            task = "a.bb:do_compile" if chunk == 1 else None
+            for i in range(5):
+                event = bb.event.OperationProgress(chunk * 5 + i, 15)
+                writer.write("bb.event.OperationProgress", pickle.dumps(event), task)
+            writer.flush()
+
+    def test_events(self):
+        self._write_log()
+        reader = bb.eventlog.EventLogReader(self.logfile)
+        self.assertEqual(len(reader.index), 3)
+        self.assertEqual(reader.variables(), {"A": {"v": "1"}})
+        self.assertEqual([e.current for e in reader.events()], list(range(15)))
+        self.assertEqual(list(reader.events(classes=["bb.event.OperationStarted"])), [])
+
+        # The log is a valid zstd stream
+        output = subprocess.check_output(["zstd", "-d", "-c", self.logfile])
+        self.assertEqual(len(output), sum(len(r[2]) + len(r[1]) + bb.eventlog.RECORD.size
+                                          for r in reader.records()))
+
+    def test_seek(self):
+        self._write_log()
+        reader = bb.eventlog.EventLogReader(self.logfile)
+        self.assertEqual(reader.tasks(), {"a.bb:do_compile"})
+        self.assertEqual([e.current for e in reader.events(task="a.bb:do_compile")],
+                         list(range(5, 10)))
+
+        records = list(reader.records())
+        start = records[6][0]
+        end = records[12][0]
+        self.assertEqual([r[0] for r in reader.records(start=start, end=end)],
+                         [r[0] for r in records if start <= r[0] <= end])
+
+        # Stopping before the end of a chunk
+        for event in reader.events(task="a.bb:do_compile"):
+            break
+        self.assertEqual(event.current, 5)
+
+    def test_missing_index(self):
+        self._write_log()
+        writer = bb.eventlog.EventLogWriter(self.logfile)
+        writer.write("bb.event.OperationProgress", pickle.dumps(bb.event.OperationProgress(15, 15)))
+        writer.flush()
+        os.unlink(bb.eventlog.index_filename(self.logfile))
+
+        reader = bb.eventlog.EventLogReader(self.logfile)
+        self.assertEqual(reader.index, [])
+        self.assertEqual(reader.variables(), {"A": {"v": "1"}})
+        self.assertEqual([e.current for e in reader.events()], list(range(16)))
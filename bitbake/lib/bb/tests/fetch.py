@@ -6,6 +6,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import contextlib
 import unittest
 import hashlib
@@ -14,6 +15,8 @@ import collections
 import os
 import signal
 import tarfile
+import threading
+from unittest.mock import patch
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
@@ -1574,6 +1577,111 @@ class FetchCheckStatusTest(FetcherTest):
         connection_cache.close_connections()
 
 
+class FetchParallelTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.srcdir = os.path.join(self.tempdir, "server")
+        os.makedirs(os.path.join(self.srcdir, "mirror"))
+        self.server = HTTPService(self.srcdir, host="127.0.0.1")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.d.setVar("BB_FETCH_HOST_THREADS", "2")
+
+    def make_files(self, count, subdir=""):
+        urls = []
+        for i in range(count):
+            name = "file%d.txt" % i
+            data = ("test file %d\n" % i).encode("utf-8")
+            with open(os.path.join(self.srcdir, subdir, name), "wb") as f:
+                f.write(data)
+            self.d.setVarFlag("SRC_URI", "file%d.sha256sum" % i, hashlib.sha256(data).hexdigest())
+            urls.append("http://127.0.0.1:%d/%s;name=file%d" % (self.server.port, name, i))
+        return urls
+
+    def test_parallel_download(self):
+        urls = self.make_files(8)
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        for i in range(8):
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.txt.done" % i)))
+        self.assertIsNone(fetcher.connection_cache)
+        self.assertFalse(fetcher.parallel)
+
+    def test_parallel_failure(self):
+        urls = self.make_files(4)
+        os.unlink(os.path.join(self.srcdir, "file1.txt"))
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+        # The other files are still downloaded
+        for i in (0, 2, 3):
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.txt.done" % i)))
+
+    def test_parallel_checksum_failure(self):
+        urls = self.make_files(4)
+        with open(os.path.join(self.srcdir, "file2.txt"), "w") as f:
+            f.write("corrupted\n")
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+        self.assertFalse(os.path.exists(os.path.join(self.dldir, "file2.txt.done")))
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file3.txt.done")))
+
+    def test_parallel_mirrors(self):
+        urls = self.make_files(4, subdir="mirror")
+        self.d.setVar("PREMIRRORS", "http://.*/.* http://127.0.0.1:%d/missing/ http://.*/.* http://127.0.0.1:%d/mirror/" % (self.server.port, self.server.port))
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        for i in range(4):
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.txt.done" % i)))
+
+        fetcher.checkstatus()
+
+    def parallel_fetcher(self, urls, threads):
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.host_limits = {}
+        fetcher.probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        def cleanup():
+            fetcher.probe_executor.shutdown()
+            fetcher.probe_executor = None
+            fetcher.host_limits = None
+        self.addCleanup(cleanup)
+        return fetcher
+
+    def test_probe_mirrors(self):
+        urls = self.make_files(1, subdir="mirror")
+        self.d.setVar("MIRRORS", "http://.*/.* http://127.0.0.1:%d/missing/ http://.*/.* http://127.0.0.1:%d/mirror/" % (self.server.port, self.server.port))
+        fetcher = self.parallel_fetcher(urls, 4)
+        ud = fetcher.ud[urls[0]]
+        uris, uds = bb.fetch2.build_mirroruris(ud, bb.fetch2.mirror_from_string(self.d.getVar("MIRRORS")), self.d)
+        self.assertEqual([f.result() for f in fetcher.probe_mirrors(uds, self.d)], [False, True])
+
+    def test_probe_mirrors_first_hit(self):
+        # The first mirror has the file, checking the second one is held up
+        # until the file was fetched, so the third one is never checked
+        urls = self.make_files(1, subdir="mirror")
+        self.d.setVar("PREMIRRORS", " ".join("http://.*/.* http://127.0.0.1:%d/%s/" % (self.server.port, m)
+                                             for m in ("mirror", "slow", "unused")))
+        fetcher = self.parallel_fetcher(urls, 1)
+        checked = []
+        fetched = threading.Event()
+        checkstatus = bb.fetch2.wget.Wget.checkstatus
+        def slow_checkstatus(method, fetch, ud, d):
+            checked.append(ud.url.split("/")[3])
+            if "/slow/" in ud.url:
+                fetched.wait(10)
+            return checkstatus(method, fetch, ud, d)
+
+        with patch.object(bb.fetch2.wget.Wget, "checkstatus", slow_checkstatus):
+            ud = fetcher.ud[urls[0]]
+            self.assertTrue(bb.fetch2.try_mirrors(fetcher, self.d, ud, bb.fetch2.mirror_from_string(self.d.getVar("PREMIRRORS"))))
+            fetched.set()
+            fetcher.probe_executor.shutdown()
+        self.assertEqual(checked, ["mirror", "slow"])
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file0.txt")))
+
+
 class GitMakeShallowTest(FetcherTest):
     def setUp(self):
         FetcherTest.setUp(self)
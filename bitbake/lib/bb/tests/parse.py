@@ -7,6 +7,7 @@
 #
 
 import unittest
+import unittest.mock
 import tempfile
 import logging
 import bb
@@ -341,3 +342,49 @@ EXPORT_FUNCTIONS do_compile do_compilepython
             self.assertIn("else", d.getVar("do_compilepython"))
             check_function_flags(d)
 
+
+    cached_include = """
+A = "1"
+do_install() {
+	echo "hello"
+}
+"""
+    def test_parse_statements_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            cachedir = os.path.join(tempdir, "cache")
+            self.d.setVar("BB_CACHEDIR", cachedir)
+            f = self.parsehelper(self.cached_include, suffix=".inc")
+            bb.parse.BBHandler.cached_statements = {}
+            d = bb.parse.handle(f.name, bb.data.createCopy(self.d), True)
+            self.assertEqual(d.getVar("A"), "1")
+            cachefiles = os.listdir(os.path.join(cachedir, "bb_statements"))
+            self.assertEqual(len(cachefiles), 1)
+
+            # Another process loads the statements from the cache
+            bb.parse.BBHandler.cached_statements = {}
+            with unittest.mock.patch.object(bb.parse.BBHandler, "parse_statements") as parse_statements:
+                d = bb.parse.handle(f.name, bb.data.createCopy(self.d), True)
+            parse_statements.assert_not_called()
+            self.assertEqual(d.getVar("A"), "1")
+            self.assertIn("hello", d.getVar("do_install"))
+
+            # A change of the content is a different entry
+            f.write(b'B = "2"\n')
+            f.flush()
+            bb.parse.BBHandler.cached_statements = {}
+            d = bb.parse.handle(f.name, bb.data.createCopy(self.d), True)
+            self.assertEqual(d.getVar("B"), "2")
+            cachefiles = os.listdir(os.path.join(cachedir, "bb_statements"))
+            self.assertEqual(len(cachefiles), 2)
+
+    def test_parse_statements_cache_warnings(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            cachedir = os.path.join(tempdir, "cache")
+            self.d.setVar("BB_CACHEDIR", cachedir)
+            f = self.parsehelper(self.addtask_deltask, suffix=".inc")
+            for _ in range(2):
+                bb.parse.BBHandler.cached_statements = {}
+                with self.assertLogs() as logs:
+                    bb.parse.handle(f.name, bb.data.createCopy(self.d), True)
+                self.assertIn('addtask ignored: " do_patch"', "".join(logs.output))
+            self.assertFalse(os.path.exists(os.path.join(cachedir, "bb_statements")))
@@ -6,6 +6,8 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import json
+import pickle
 import unittest
 import os
 import tempfile
@@ -13,6 +15,8 @@ import subprocess
 import sys
 import time
 
+import bb.runqueue
+
 #
 # TODO:
 # Add tests on task ordering (X happens before Y after Z)
@@ -61,6 +65,134 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_critical_scheduler(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "a1"]
+            historyfile = tempdir + "/durations.json"
+            extraenv = {
+                "BB_SCHEDULER" : "critical",
+                "BB_TASK_DURATIONS" : historyfile
+            }
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            expected = ['a1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+
+            with open(historyfile) as f:
+                history = json.load(f)
+            self.assertIn("a1:do_compile", history)
+
+            self.shutdown(tempdir)
+
+    def test_worker_zygotes(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "b1"]
+            extraenv = {
+                "BB_WORKER_ZYGOTES" : "1"
+            }
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks]
+            expected.remove('a1:build')
+            expected.remove('a1:package_qa')
+            self.assertEqual(set(tasks), set(expected))
+
+            self.shutdown(tempdir)
+
+    def test_worker_zygotes_setscene(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "b1"]
+            sstatevalid = self.a1_sstatevalid + " " + self.b1_sstatevalid
+            extraenv = {
+                "BB_WORKER_ZYGOTES" : "4"
+            }
+            tasks = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv)
+            expected = ['a1:package_write_ipk_setscene', 'a1:package_write_rpm_setscene', 'a1:packagedata_setscene',
+                        'b1:build', 'a1:populate_sysroot_setscene', 'b1:package_write_ipk_setscene', 'b1:package_write_rpm_setscene',
+                        'b1:packagedata_setscene', 'b1:package_qa_setscene', 'b1:populate_sysroot_setscene']
+            self.assertEqual(set(tasks), set(expected))
+
+            self.shutdown(tempdir)
+
+    def test_worker_zygotes_parse_vars(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "b1"]
+            parselog = os.path.join(tempdir, "parse.log")
+            extraenv = {
+                "BB_WORKER_ZYGOTES" : "4",
+                "PARSETASKLOG" : parselog,
+                "NOZYGOTES" : "a1",
+            }
+            tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+            with open(parselog) as f:
+                parsed = [line.split() for line in f]
+
+            # The zygote of b1 parses it once, with the variables of its first
+            # task set. The zygote of a1 declines and its tasks each parse
+            # the recipe.
+            self.assertTrue(all(taskdepdata == "True" for _, taskdepdata in parsed))
+            a1 = sorted(task for task, _ in parsed if task.startswith("a1:"))
+            self.assertEqual(a1, sorted(["a1:fetch"] + [task for task in tasks if task.startswith("a1:")]))
+            b1 = [task for task, _ in parsed if task.startswith("b1:")]
+            self.assertEqual(b1, ["b1:fetch"])
+            self.assertEqual(len([task for task in tasks if task.startswith("b1:")]), len(self.alltasks))
+
+            self.shutdown(tempdir)
+
+    def test_reparse_dependents(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            layerdir = os.path.join(tempdir, "layer")
+            os.mkdir(layerdir)
+            with open(os.path.join(layerdir, "g1.bb"), "w") as f:
+                f.write("require g1.inc\n")
+            with open(os.path.join(layerdir, "g1.inc"), "w") as f:
+                f.write('DESCRIPTION = "g1"\n')
+            with open(os.path.join(layerdir, "h1.bb"), "w") as f:
+                f.write('DESCRIPTION = "h1"\n')
+
+            parselog = os.path.join(tempdir, "parse.log")
+            extraenv = {
+                "PARSELOG" : parselog,
+                "EXTRA_BBFILES" : layerdir + "/*.bb",
+                # Keep the server and its caches between the commands
+                "BB_SERVER_TIMEOUT" : "60",
+            }
+
+            def parsed():
+                if not os.path.exists(parselog):
+                    return []
+                with open(parselog) as f:
+                    recipes = sorted(line.strip() for line in f)
+                os.remove(parselog)
+                return recipes
+
+            def touch(fn, delay):
+                mtime = time.time() + delay
+                os.utime(os.path.join(layerdir, fn), (mtime, mtime))
+
+            self.run_bitbakecmd(["bitbake", "-p"], tempdir, extraenv=extraenv)
+            self.assertEqual(parsed(), ["a1", "b1", "c1", "d1", "e1", "f1", "g1", "h1"])
+
+            # Only the recipe including the changed file is parsed again
+            touch("g1.inc", 10)
+            self.run_bitbakecmd(["bitbake", "-p"], tempdir, extraenv=extraenv)
+            self.assertEqual(parsed(), ["g1"])
+
+            touch("g1.inc", 20)
+            tasks = self.run_bitbakecmd(["bitbake", "h1"], tempdir, extraenv=extraenv)
+            self.assertEqual(parsed(), ["g1"])
+            self.assertEqual(set(tasks), set("h1:" + x for x in self.alltasks))
+
+            touch("h1.bb", 30)
+            self.run_bitbakecmd(["bitbake", "-p"], tempdir, extraenv=extraenv)
+            self.assertEqual(parsed(), ["h1"])
+
+            self.run_bitbakecmd(["bitbake", "-m"], tempdir, extraenv=extraenv)
+            # The cache written by the server is valid when it starts again
+            self.run_bitbakecmd(["bitbake", "-p"], tempdir, extraenv=extraenv)
+            self.assertEqual(parsed(), [])
+
+            self.run_bitbakecmd(["bitbake", "-m"], tempdir, extraenv=extraenv)
+            self.shutdown(tempdir)
+
     def test_single_setscenevalid(self):
         with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
             cmd = ["bitbake", "a1"]
@@ -399,3 +531,56 @@ class RunQueueTests(unittest.TestCase):
         while (os.path.exists(tempdir + "/hashserve.sock") or os.path.exists(tempdir + "cache/hashserv.db-wal") or os.path.exists(tempdir + "/bitbake.lock")):
             time.sleep(0.5)
 
+
+class RunQueueTaskGraphTests(unittest.TestCase):
+    def graph(self, depends):
+        entries = {}
+        for tid, deps in depends.items():
+            entries[tid] = bb.runqueue.RunTaskEntry()
+            entries[tid].depends = set(deps)
+        return bb.runqueue.RunQueueTaskGraph(entries)
+
+    def test_adjacency(self):
+        graph = self.graph({"a:do_b": ["a:do_a"], "a:do_a": [], "a:do_c": ["a:do_a", "a:do_b"]})
+        self.assertEqual(graph.tids, ["a:do_a", "a:do_b", "a:do_c"])
+        self.assertEqual(list(graph.depends(graph.ids["a:do_c"])), [0, 1])
+        self.assertEqual(list(graph.revdeps(graph.ids["a:do_a"])), [1, 2])
+        self.assertEqual(graph.num_revdeps(graph.ids["a:do_c"]), 0)
+
+    def test_topological_order(self):
+        graph = self.graph({"d": ["b", "c"], "c": ["a"], "b": ["a"], "a": [], "x": ["y"], "y": ["x"]})
+        order = [graph.tids[taskid] for taskid in graph.topological_order()]
+        self.assertEqual(set(order), {"a", "b", "c", "d"})
+        for tid in order:
+            for dep in graph.depends(graph.ids[tid]):
+                self.assertLess(order.index(graph.tids[dep]), order.index(tid))
+
+    def test_topological_levels(self):
+        graph = self.graph({"d": ["b", "c"], "c": ["a"], "b": ["a"], "a": [], "e": ["b"]})
+        levels = [sorted(graph.tids[taskid] for taskid in level) for level in graph.topological_levels()]
+        self.assertEqual(levels, [["a"], ["b", "c"], ["d", "e"]])
+
+
+class RunQueueWorkerFrameTests(unittest.TestCase):
+    def test_frames(self):
+        data = bb.runqueue.worker_frame("runtask", b"task") + bb.runqueue.worker_frame("quit", b"")
+        queue = bytearray(data[:-3])
+        self.assertEqual(bb.runqueue.read_worker_frames(queue), [("runtask", b"task")])
+        self.assertEqual(bb.runqueue.read_worker_frames(queue), [])
+        queue.extend(data[-3:])
+        self.assertEqual(bb.runqueue.read_worker_frames(queue), [("quit", b"")])
+        self.assertEqual(queue, b"")
+
+    def test_invalid_frame(self):
+        with self.assertRaises(ValueError):
+            bb.runqueue.read_worker_frames(bytearray(b"\xff\x00\x00\x00\x00"))
+
+    def test_events(self):
+        events = [pickle.dumps(bb.event.Event()), pickle.dumps("</event>"), b""]
+        # Batches of events are concatenated when forwarded
+        batch = bb.runqueue.worker_event(events[0]) + bb.runqueue.worker_event(events[1])
+        batch += bb.runqueue.worker_event(events[2])
+        queue = bytearray(bb.runqueue.worker_frame("events", batch))
+        [(name, payload)] = bb.runqueue.read_worker_frames(queue)
+        self.assertEqual(name, "events")
+        self.assertEqual(list(bb.runqueue.worker_events(payload)), events)
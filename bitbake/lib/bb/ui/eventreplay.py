@@ -13,6 +13,8 @@ import json
 import pickle
 import codecs
 
+import bb.eventlog
+
 
 class EventPlayer:
     """Emulate a connection to a bitbake server."""
@@ -21,9 +23,21 @@ class EventPlayer:
         self.eventfile = eventfile
         self.variables = variables
         self.eventmask = []
+        self.records = None
+        if isinstance(eventfile, bb.eventlog.EventLogReader):
+            self.records = eventfile.records()
 
     def waitEvent(self, _timeout):
         """Read event from the file."""
+        if self.records is not None:
+            # The events not in the mask are skipped without unpickling them
+            for _, name, data in self.records:
+                if name == bb.eventlog.VARIABLES:
+                    self.variables = pickle.loads(data)
+                elif name in self.eventmask:
+                    return pickle.loads(data)
+            return
+
         line = self.eventfile.readline().strip()
         if not line:
             return
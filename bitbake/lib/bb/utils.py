@@ -311,13 +311,13 @@ def better_compile(text, file, realfile, mode = "exec", lineno = 0):
     will print the offending lines.
     """
     try:
-        cache = bb.methodpool.compile_cache(text)
+        cache = bb.methodpool.compile_cache(text, realfile, mode, lineno)
         if cache:
             return cache
         # We can't add to the linenumbers for compile, we can pad to the correct number of blank lines though
         text2 = "\n" * int(lineno) + text
         code = compile(text2, realfile, mode)
-        bb.methodpool.compile_cache_add(text, code)
+        bb.methodpool.compile_cache_add(text, code, realfile, mode, lineno)
         return code
     except Exception as e:
         error = []
@@ -584,6 +584,37 @@ def sha512_file(filename):
     import hashlib
     return _hasher(hashlib.sha512(), filename)
 
+def file_checksums(filename, checksum_names):
+    """
+    Return a dict of the hex string representations of the checksums of
+    filename for each of the checksum names (e.g. "md5", "sha256"), reading
+    the file only once.
+    """
+    import hashlib
+    import mmap
+
+    methods = {}
+    for name in checksum_names:
+        if name == "md5":
+            try:
+                methods[name] = hashlib.new('MD5', usedforsecurity=False)
+            except TypeError:
+                # Some configurations don't appear to support two arguments
+                methods[name] = hashlib.new('MD5')
+        else:
+            methods[name] = hashlib.new(name)
+
+    with open(filename, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for chunk in iter(lambda: mm.read(1024 * 1024), b''):
+                    for method in methods.values():
+                        method.update(chunk)
+        except ValueError:
+            # You can't mmap() an empty file so silence this exception
+            pass
+    return {name: method.hexdigest() for name, method in methods.items()}
+
 def preserved_envvars_exported():
     """Variables which are taken from the environment and placed in and exported
     from the metadata"""
@@ -25,6 +25,8 @@ def create_server(
     anon_perms=None,
     admin_username=None,
     admin_password=None,
+    replicate=None,
+    cache_size=None,
 ):
     def sqlite_engine():
         from .sqlite import DatabaseEngine
@@ -46,6 +48,9 @@ def create_server(
     if anon_perms is None:
         anon_perms = server.DEFAULT_ANON_PERMS
 
+    if cache_size is None:
+        cache_size = server.DEFAULT_CACHE_SIZE
+
     s = server.Server(
         db_engine,
         upstream=upstream,
@@ -53,6 +58,8 @@ def create_server(
         anon_perms=anon_perms,
         admin_username=admin_username,
         admin_password=admin_password,
+        replicate=replicate,
+        cache_size=cache_size,
     )
 
     (typ, a) = parse_address(addr)
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import asyncio
 import logging
 import socket
 import bb.asyncrpc
@@ -18,6 +19,10 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     MODE_GET_STREAM = 1
     MODE_EXIST_STREAM = 2
 
+    # Maximum number of stream requests sent ahead of their responses when
+    # pipelining a batch of requests
+    MAX_STREAM_IN_FLIGHT = 256
+
     def __init__(self, username=None, password=None):
         super().__init__("OEHASHEQUIV", "1.1", logger)
         self.mode = self.MODE_NORMAL
@@ -44,6 +49,48 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
 
         return await self._send_wrapper(proc)
 
+    async def send_stream_batch(self, mode, msgs):
+        """
+        Send a list of stream mode messages, pipelining them so that up to
+        MAX_STREAM_IN_FLIGHT requests are outstanding at once instead of
+        waiting a round trip for each one. The server answers stream
+        requests in order, so the responses are returned in the same order
+        as msgs.
+        """
+        if not msgs:
+            return []
+
+        async def proc():
+            await self._set_mode(mode)
+
+            in_flight = asyncio.Semaphore(self.MAX_STREAM_IN_FLIGHT)
+
+            async def send():
+                for msg in msgs:
+                    await in_flight.acquire()
+                    await self.socket.send(msg)
+
+            async def recv():
+                results = []
+                for _ in msgs:
+                    results.append(await self.socket.recv())
+                    in_flight.release()
+                return results
+
+            send_task = asyncio.ensure_future(send())
+            recv_task = asyncio.ensure_future(recv())
+            done, pending = await asyncio.wait(
+                (send_task, recv_task), return_when=asyncio.FIRST_EXCEPTION
+            )
+            for t in pending:
+                t.cancel()
+            for t in done:
+                # Raise any exception so the connection is reset and retried
+                t.result()
+            return recv_task.result()
+
+        return await self._send_wrapper(proc)
+
     async def invoke(self, *args, **kwargs):
         # It's OK if connection errors cause a failure here, because the mode
         # is also reset to normal on a new connection
@@ -94,6 +141,17 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
             return None
         return r
 
+    async def get_unihash_batch(self, args):
+        """
+        Query the unihashes for a list of (method, taskhash) tuples over this
+        connection, returning a list of the unihashes (or None if not
+        found) in the same order
+        """
+        result = await self.send_stream_batch(
+            self.MODE_GET_STREAM, ["%s %s" % (method, taskhash) for method, taskhash in args]
+        )
+        return [r or None for r in result]
+
     async def report_unihash(self, taskhash, method, outhash, unihash, extra={}):
         m = extra.copy()
         m["taskhash"] = taskhash
@@ -118,6 +176,14 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
         r = await self.send_stream(self.MODE_EXIST_STREAM, unihash)
         return r == "true"
 
+    async def unihash_exists_batch(self, unihashes):
+        """
+        Check the existence of a list of unihashes over this connection,
+        returning a list of True or False in the same order
+        """
+        result = await self.send_stream_batch(self.MODE_EXIST_STREAM, list(unihashes))
+        return [r == "true" for r in result]
+
     async def get_outhash(self, method, outhash, taskhash, with_unihash=True):
         return await self.invoke(
             {
@@ -133,6 +199,25 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     async def get_stats(self):
         return await self.invoke({"get-stats": None})
 
+    async def get_replication_updates(self, log_id, limit, wait=0):
+        """
+        Get the entries of the server replication log after the entry with
+        the given id, waiting up to "wait" seconds for new entries if there
+        are none yet. Each entry is a unihash or outhash row added to or
+        removed from the server. Replicas must start again from the beginning
+        if the "epoch" of the result changes, or if "pruned" is past the last
+        entry they got, since removals up to that entry are no longer logged
+        """
+        return await self.invoke(
+            {
+                "get-replication-updates": {
+                    "log_id": log_id,
+                    "limit": limit,
+                    "wait": wait,
+                }
+            }
+        )
+
     async def reset_stats(self):
         return await self.invoke({"reset-stats": None})
 
@@ -237,12 +322,15 @@ class Client(bb.asyncrpc.Client):
             "connect_tcp",
             "connect_websocket",
             "get_unihash",
+            "get_unihash_batch",
             "report_unihash",
             "report_unihash_equiv",
             "get_taskhash",
             "unihash_exists",
+            "unihash_exists_batch",
             "get_outhash",
             "get_stats",
+            "get_replication_updates",
             "reset_stats",
             "backfill_wait",
             "remove",
@@ -295,17 +383,22 @@ class ClientPool(bb.asyncrpc.ClientPool):
     def _run_key_tasks(self, queries, call):
         results = {key: None for key in queries.keys()}
 
-        def make_task(key, args):
+        # Split the queries evenly between the clients, each of which
+        # pipelines its share of the queries over its connection
+        keys = list(queries.keys())
+        num_tasks = min(self.max_clients, len(keys))
+
+        def make_task(chunk):
             async def task(client):
                 nonlocal results
-                unihash = await call(client, args)
-                results[key] = unihash
+                values = await call(client, [queries[key] for key in chunk])
+                results.update(zip(chunk, values))
 
             return task
 
         def gen_tasks():
-            for key, args in queries.items():
-                yield make_task(key, args)
+            for i in range(num_tasks):
+                yield make_task(keys[i::num_tasks])
 
         self.run_tasks(gen_tasks())
         return results
@@ -323,8 +416,7 @@ class ClientPool(bb.asyncrpc.ClientPool):
         """
 
         async def call(client, args):
-            method, taskhash = args
-            return await client.get_unihash(method, taskhash)
+            return await client.get_unihash_batch(args)
 
         return self._run_key_tasks(queries, call)
 
@@ -340,7 +432,7 @@ class ClientPool(bb.asyncrpc.ClientPool):
         None if there was a failure)
         """
 
-        async def call(client, unihash):
-            return await client.unihash_exists(unihash)
+        async def call(client, unihashes):
+            return await client.unihash_exists_batch(unihashes)
 
         return self._run_key_tasks(queries, call)
@@ -4,6 +4,7 @@
 #
 
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import asyncio
 import logging
 import math
@@ -49,6 +50,22 @@ TOKEN_SIZE = 48
 
 SALT_SIZE = 8
 
+# Maximum number of replication log entries returned by a single replication
+# request, and the longest time a request waits for new entries
+REPLICATION_MAX_ROWS = 5000
+REPLICATION_MAX_WAIT = 20
+
+# How long removals are kept in the replication log. Replicas that haven't
+# caught up with the removals dropped from it synchronize again from scratch
+REPLICATION_LOG_MAX_AGE = timedelta(days=7)
+
+# Delay before a replica retries after losing the connection to the server
+# it replicates from
+REPLICATION_RETRY_DELAY = 5
+
+# Default number of query results kept in memory by the server
+DEFAULT_CACHE_SIZE = 100000
+
 
 class Measurement(object):
     def __init__(self, sample):
@@ -143,6 +160,69 @@ class Stats(object):
         }
 
 
+class QueryCache(object):
+    """
+    Least recently used cache of database query results.
+
+    Rows are never modified once they are added to the database, so only
+    results which found a row are cached and the cache only needs to be
+    cleared when rows are removed.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def size(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        if not self.hits:
+            return 0
+        return self.hits / (self.hits + self.misses)
+
+    def todict(self):
+        return {
+            k: getattr(self, k)
+            for k in ("size", "max_size", "hits", "misses", "evictions", "hit_rate")
+        }
+
+
 token_refresh_semaphore = asyncio.Lock()
 
 
@@ -165,6 +245,10 @@ def new_salt():
     return os.getrandom(SALT_SIZE, os.GRND_NONBLOCK).hex()
 
 
+def new_replication_epoch():
+    return os.getrandom(16, os.GRND_NONBLOCK).hex()
+
+
 def hash_token(algo, salt, token):
     h = hashlib.new(algo)
     h.update(salt.encode("utf-8"))
@@ -238,6 +322,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 "get-stats": self.handle_get_stats,
                 "get-db-usage": self.handle_get_db_usage,
                 "get-db-query-columns": self.handle_get_db_query_columns,
+                "get-replication-updates": self.handle_get_replication_updates,
                 # Not always read-only, but internally checks if the server is
                 # read-only
                 "report": self.handle_report,
@@ -310,7 +395,9 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         for k in self.handlers.keys():
             if k in msg:
                 self.logger.debug("Handling %s" % k)
-                if "stream" in k:
+                # Stream requests are measured per message, and replication
+                # requests wait for updates so would skew the statistics
+                if "stream" in k or k == "get-replication-updates":
                     return await self.handlers[k](msg[k])
                 else:
                     with self.server.request_stats.start_sample() as self.request_sample, self.request_sample.measure():
@@ -337,16 +424,42 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 d = await self.upstream_client.get_taskhash(method, taskhash, True)
                 await self.update_unified(d)
         else:
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                d = {k: row[k] for k in row.keys()}
+            if unihash is not None:
+                d = {"taskhash": taskhash, "method": method, "unihash": unihash}
             elif self.upstream_client is not None:
                 d = await self.upstream_client.get_taskhash(method, taskhash)
                 await self.db.insert_unihash(d["method"], d["taskhash"], d["unihash"])
 
         return d
 
+    async def get_equivalent(self, method, taskhash):
+        key = ("equivalent", method, taskhash)
+        unihash = self.server.query_cache.get(key)
+        if unihash is None:
+            row = await self.db.get_equivalent(method, taskhash)
+            if row is None:
+                return None
+            unihash = row["unihash"]
+            self.server.query_cache.set(key, unihash)
+        return unihash
+
+    async def unihash_exists(self, unihash):
+        key = ("exists", unihash)
+        if self.server.query_cache.get(key):
+            return True
+
+        if await self.db.unihash_exists(unihash):
+            self.server.query_cache.set(key, True)
+            return True
+
+        return False
+
+    def invalidate_unihash(self, method, taskhash, unihash):
+        self.server.query_cache.invalidate(("equivalent", method, taskhash))
+        self.server.query_cache.invalidate(("exists", unihash))
+
     @permissions(READ_PERM)
     async def handle_get_outhash(self, request):
         method = request["method"]
@@ -414,11 +527,11 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         async def handler(l):
             (method, taskhash) = l.split()
             # self.logger.debug('Looking up %s %s' % (method, taskhash))
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                # self.logger.debug('Found equivalent task %s -> %s', (row['taskhash'], row['unihash']))
-                return row["unihash"]
+            if unihash is not None:
+                # self.logger.debug('Found equivalent task %s -> %s', (taskhash, unihash))
+                return unihash
 
             if self.upstream_client is not None:
                 upstream = await self.upstream_client.get_unihash(method, taskhash)
@@ -433,7 +546,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     @permissions(READ_PERM)
     async def handle_exists_stream(self, request):
         async def handler(l):
-            if await self.db.unihash_exists(l):
+            if await self.unihash_exists(l):
                 return "true"
 
             if self.upstream_client is not None:
@@ -508,6 +621,8 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                         unihash = upstream_data["unihash"]
 
             await self.db.insert_unihash(data["method"], data["taskhash"], unihash)
+            self.invalidate_unihash(data["method"], data["taskhash"], unihash)
+            self.server.notify_replicas()
 
         unihash_data = await self.get_unihash(data["method"], data["taskhash"])
         if unihash_data is not None:
@@ -523,7 +638,9 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
     @permissions(READ_PERM, REPORT_PERM)
     async def handle_equivreport(self, data):
-        await self.db.insert_unihash(data["method"], data["taskhash"], data["unihash"])
+        if await self.db.insert_unihash(data["method"], data["taskhash"], data["unihash"]):
+            self.invalidate_unihash(data["method"], data["taskhash"], data["unihash"])
+            self.server.notify_replicas()
 
         # Fetch the unihash that will be reported for the taskhash. If the
         # unihash matches, it means this row was inserted (or the mapping
@@ -543,15 +660,18 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     async def handle_get_stats(self, request):
         return {
             "requests": self.server.request_stats.todict(),
+            "cache": self.server.query_cache.todict(),
         }
 
     @permissions(DB_ADMIN_PERM)
     async def handle_reset_stats(self, request):
         d = {
             "requests": self.server.request_stats.todict(),
+            "cache": self.server.query_cache.todict(),
         }
 
         self.server.request_stats.reset()
+        self.server.query_cache.reset()
         return d
 
     @permissions(READ_PERM)
@@ -562,13 +682,50 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         await self.server.backfill_queue.join()
         return d
 
+    @permissions(READ_PERM)
+    async def handle_get_replication_updates(self, request):
+        log_id = int(request.get("log_id", 0))
+        limit = max(1, min(int(request.get("limit", REPLICATION_MAX_ROWS)), REPLICATION_MAX_ROWS))
+        wait = max(0, min(float(request.get("wait", 0)), REPLICATION_MAX_WAIT))
+        deadline = time.monotonic() + wait
+
+        while True:
+            # Get the event before querying so that entries added after the
+            # query wake this request up
+            event = self.server.replication_event
+
+            updates = await self.db.get_replication_log(log_id, limit)
+
+            remaining = deadline - time.monotonic()
+            if updates or remaining <= 0:
+                break
+
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        return {
+            "epoch": await self.db.get_config("replication-epoch"),
+            "pruned": int(await self.db.get_config("replication-pruned") or 0),
+            "updates": updates,
+        }
+
+    async def hashes_removed(self, count):
+        if count:
+            self.server.query_cache.clear()
+            await self.db.prune_replication_log(datetime.now() - REPLICATION_LOG_MAX_AGE)
+            self.server.notify_replicas()
+
     @permissions(DB_ADMIN_PERM)
     async def handle_remove(self, request):
         condition = request["where"]
         if not isinstance(condition, dict):
             raise TypeError("Bad condition type %s" % type(condition))
 
-        return {"count": await self.db.remove(condition)}
+        count = await self.db.remove(condition)
+        await self.hashes_removed(count)
+        return {"count": count}
 
     @permissions(DB_ADMIN_PERM)
     async def handle_gc_mark(self, request):
@@ -598,6 +755,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             )
 
         count = await self.db.gc_sweep()
+        await self.hashes_removed(count)
 
         return {"count": count}
 
@@ -614,7 +772,9 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     async def handle_clean_unused(self, request):
         max_age = request["max_age_seconds"]
         oldest = datetime.now() - timedelta(seconds=-max_age)
-        return {"count": await self.db.clean_unused(oldest)}
+        count = await self.db.clean_unused(oldest)
+        await self.hashes_removed(count)
+        return {"count": count}
 
     @permissions(DB_ADMIN_PERM)
     async def handle_get_db_usage(self, request):
@@ -792,12 +952,23 @@ class Server(bb.asyncrpc.AsyncServer):
         anon_perms=DEFAULT_ANON_PERMS,
         admin_username=None,
         admin_password=None,
+        replicate=None,
+        cache_size=DEFAULT_CACHE_SIZE,
     ):
         if upstream and read_only:
             raise bb.asyncrpc.ServerError(
                 "Read-only hashserv cannot pull from an upstream server"
             )
 
+        if upstream and replicate:
+            raise bb.asyncrpc.ServerError(
+                "Replica hashserv cannot pull from an upstream server"
+            )
+
+        # A replica only ever gets its hashes from the server it replicates
+        if replicate:
+            read_only = True
+
         disallowed_perms = set(anon_perms) - set(
             [NONE_PERM, READ_PERM, REPORT_PERM, DB_ADMIN_PERM]
         )
@@ -810,9 +981,13 @@ class Server(bb.asyncrpc.AsyncServer):
         super().__init__(logger)
 
         self.request_stats = Stats()
+        self.query_cache = QueryCache(cache_size)
         self.db_engine = db_engine
         self.upstream = upstream
         self.read_only = read_only
+        self.replicate = replicate
+        self.replication_event = None
+        self.replication_worker = None
         self.backfill_queue = None
         self.anon_perms = set(anon_perms)
         self.admin_username = admin_username
@@ -859,17 +1034,110 @@ class Server(bb.asyncrpc.AsyncServer):
                 method, taskhash = item
                 d = await client.get_taskhash(method, taskhash)
                 if d is not None:
-                    await db.insert_unihash(d["method"], d["taskhash"], d["unihash"])
+                    if await db.insert_unihash(d["method"], d["taskhash"], d["unihash"]):
+                        self.notify_replicas()
                 self.backfill_queue.task_done()
 
+    def notify_replicas(self):
+        """
+        Wake up any replication requests waiting for new rows
+        """
+        self.replication_event.set()
+        self.replication_event = asyncio.Event()
+
+    async def replicate_batch(self, db, client, position):
+        updates = await client.get_replication_updates(
+            position["log_id"],
+            REPLICATION_MAX_ROWS,
+            REPLICATION_MAX_WAIT,
+        )
+
+        if updates["epoch"] != position["epoch"] or 0 < position["log_id"] < updates["pruned"]:
+            # This is a different source, or removals this replica hasn't
+            # seen yet have been dropped from its log, so start again from an
+            # empty database. Anything replicating from this server has to do
+            # the same
+            self.logger.info("Replication log not available, synchronizing all hashes")
+            await db.clear_hashes()
+            self.query_cache.clear()
+            await db.set_config("replication-epoch", new_replication_epoch())
+            position["epoch"] = updates["epoch"]
+            position["log_id"] = 0
+            await db.set_config("replica-source-epoch", position["epoch"])
+            await db.set_config("replica-log-id", "0")
+            self.notify_replicas()
+            return True
+
+        removed = False
+        for row in updates["updates"]:
+            position["log_id"] = row.pop("id")
+            kind = row.pop("kind")
+            if row.pop("removed"):
+                if kind == "unihash":
+                    await db.remove_unihash(row["method"], row["taskhash"])
+                else:
+                    await db.remove_outhash(row["method"], row["taskhash"], row["outhash"])
+                removed = True
+            elif kind == "unihash":
+                await db.insert_unihash(row["method"], row["taskhash"], row["unihash"])
+            else:
+                await db.insert_outhash(row)
+
+        if removed:
+            self.query_cache.clear()
+            await db.prune_replication_log(datetime.now() - REPLICATION_LOG_MAX_AGE)
+
+        if updates["updates"]:
+            await db.set_config("replica-log-id", str(position["log_id"]))
+            self.notify_replicas()
+            self.logger.debug("Replicated %d changes", len(updates["updates"]))
+            return True
+
+        return False
+
+    async def replication_worker_task(self):
+        self.replication_worker = asyncio.current_task()
+        try:
+            async with self.db_engine.connect(self.logger) as db:
+                position = {
+                    "epoch": await db.get_config("replica-source-epoch"),
+                    "log_id": int(await db.get_config("replica-log-id") or 0),
+                }
+
+                while True:
+                    try:
+                        async with await create_async_client(self.replicate) as client:
+                            while True:
+                                await self.replicate_batch(db, client, position)
+                    except (OSError, ConnectionError, bb.asyncrpc.InvokeError) as e:
+                        self.logger.warning(
+                            "Unable to replicate from %s: %s", self.replicate, e
+                        )
+                        await asyncio.sleep(REPLICATION_RETRY_DELAY)
+        except asyncio.CancelledError:
+            pass
+
+    async def init_replication_epoch(self):
+        async with self.db_engine.connect(self.logger) as db:
+            if await db.get_config("replication-epoch") is None:
+                await db.set_config("replication-epoch", new_replication_epoch())
+
     def start(self):
         tasks = super().start()
         if self.upstream:
             self.backfill_queue = asyncio.Queue()
             tasks += [self.backfill_worker_task()]
 
+        self.replication_event = asyncio.Event()
+
         self.loop.run_until_complete(self.db_engine.create())
 
+        if self.replicate or not self.read_only:
+            self.loop.run_until_complete(self.init_replication_epoch())
+
+        if self.replicate:
+            tasks += [self.replication_worker_task()]
+
         if self.admin_username:
             self.loop.run_until_complete(self.create_admin_user())
 
@@ -878,4 +1146,6 @@ class Server(bb.asyncrpc.AsyncServer):
     async def stop(self):
         if self.backfill_queue is not None:
             await self.backfill_queue.put(None)
+        if self.replication_worker is not None:
+            self.replication_worker.cancel()
         await super().stop()
@@ -17,6 +17,7 @@ from sqlalchemy import (
     Table,
     Text,
     Integer,
+    Boolean,
     UniqueConstraint,
     DateTime,
     Index,
@@ -24,6 +25,8 @@ from sqlalchemy import (
     insert,
     exists,
     literal,
+    null,
+    text,
     and_,
     delete,
     update,
@@ -94,6 +97,33 @@ class Config(Base):
     )
 
 
+class ReplicationLog(Base):
+    __tablename__ = "replication_log"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(Text, nullable=False)
+    removed = Column(Boolean, nullable=False)
+    method = Column(Text, nullable=False)
+    taskhash = Column(Text, nullable=False)
+    outhash = Column(Text)
+    created = Column(DateTime)
+
+    __table_args__ = (
+        Index("replication_log_lookup", "kind", "method", "taskhash", "outhash"),
+    )
+
+
+# The columns that identify a row of each kind in the replication log, and
+# the columns of the table sent to replicas for an added row
+REPLICATION_TABLES = {
+    "unihash": (UnihashesV3, ("method", "taskhash"), ("unihash",)),
+    "outhash": (
+        OuthashesV2,
+        ("method", "taskhash", "outhash"),
+        ("created", "owner", "PN", "PV", "PR", "task", "outhash_siginfo"),
+    ),
+}
+
+
 #
 # Old table versions
 #
@@ -158,10 +188,34 @@ class DatabaseEngine(object):
                 await conn.run_sync(Base.metadata.drop_all, [UnihashesV2.__table__])
                 self.logger.info("Upgrade complete")
 
+            # Databases from before the replication log was added need their
+            # existing rows in it for replicas to get them
+            result = await conn.execute(select(ReplicationLog.id).limit(1))
+            if result.first() is None:
+                for kind in REPLICATION_TABLES:
+                    await conn.execute(_log_rows(kind, False, None))
+
     def connect(self, logger):
         return Database(self.engine, logger)
 
 
+def _log_rows(kind, removed, created, *where):
+    table, keys, _ = REPLICATION_TABLES[kind]
+    return insert(ReplicationLog).from_select(
+        ["kind", "removed", "method", "taskhash", "outhash", "created"],
+        select(
+            literal(kind),
+            literal(removed),
+            table.method,
+            table.taskhash,
+            table.outhash if "outhash" in keys else null(),
+            literal(created) if created is not None else null(),
+        )
+        .where(*where)
+        .order_by(table.id),
+    )
+
+
 def map_row(row):
     if row is None:
         return None
@@ -207,6 +261,49 @@ class Database(object):
         self.logger.debug("%s", statement)
         return await self.db.execute(statement)
 
+    async def _lock_replication_log(self):
+        # Postgresql allocates the ids before the rows are committed. Writing
+        # the log one transaction at a time makes the entries commit in id
+        # order, so that replicas never move past an entry before it is
+        # visible
+        if self.engine.name == "postgresql":
+            await self._execute(text("LOCK TABLE replication_log IN EXCLUSIVE MODE"))
+
+    async def _log_added(self, kind, keys):
+        await self._lock_replication_log()
+        await self._execute(
+            insert(ReplicationLog).values(
+                kind=kind,
+                removed=False,
+                method=keys["method"],
+                taskhash=keys["taskhash"],
+                outhash=keys.get("outhash"),
+                created=datetime.now(),
+            )
+        )
+
+    async def _log_removed(self, kind, where):
+        """
+        Record the removal of the rows of the kind matching where in the
+        replication log. The log entries of the rows being added are removed,
+        since a replica catching up no longer needs to add them
+        """
+        table, keys, _ = REPLICATION_TABLES[kind]
+        await self._lock_replication_log()
+        await self._execute(
+            delete(ReplicationLog).where(
+                ReplicationLog.kind == kind,
+                ReplicationLog.removed.is_(False),
+                select(table.id)
+                .where(
+                    *where,
+                    *(getattr(table, k) == getattr(ReplicationLog, k) for k in keys),
+                )
+                .exists(),
+            )
+        )
+        await self._execute(_log_rows(kind, True, datetime.now(), *where))
+
     async def _set_config(self, name, value):
         while True:
             result = await self._execute(
@@ -238,6 +335,14 @@ class Database(object):
             return None
         return row.value
 
+    async def get_config(self, name):
+        async with self.db.begin():
+            return await self._get_config(name)
+
+    async def set_config(self, name, value):
+        async with self.db.begin():
+            await self._set_config(name, value)
+
     async def get_unihash_by_taskhash_full(self, method, taskhash):
         async with self.db.begin():
             result = await self._execute(
@@ -348,19 +453,116 @@ class Database(object):
             )
             return map_row(result.first())
 
+    async def get_replication_log(self, last_id, limit):
+        columns = [
+            ReplicationLog.id,
+            ReplicationLog.kind,
+            ReplicationLog.removed,
+            ReplicationLog.method,
+            ReplicationLog.taskhash,
+            ReplicationLog.outhash,
+        ]
+        joins = []
+        for kind, (table, keys, values) in REPLICATION_TABLES.items():
+            columns.extend(getattr(table, v).label(v) for v in values)
+            joins.append(
+                (
+                    table,
+                    and_(
+                        ReplicationLog.kind == kind,
+                        ReplicationLog.removed.is_(False),
+                        *(getattr(table, k) == getattr(ReplicationLog, k) for k in keys),
+                    ),
+                )
+            )
+
+        statement = select(*columns).select_from(ReplicationLog)
+        for table, onclause in joins:
+            statement = statement.outerjoin(table, onclause)
+
+        async with self.db.begin():
+            result = await self._execute(
+                statement.where(ReplicationLog.id > last_id)
+                .order_by(ReplicationLog.id.asc())
+                .limit(limit)
+            )
+
+            updates = []
+            for row in result:
+                row = map_row(row)
+                _, keys, values = REPLICATION_TABLES[row["kind"]]
+                d = {
+                    "id": row["id"],
+                    "kind": row["kind"],
+                    "removed": bool(row["removed"]),
+                }
+                d.update((k, row[k]) for k in keys)
+                if not d["removed"]:
+                    d.update((v, row[v]) for v in values)
+                updates.append(d)
+            return updates
+
+    async def prune_replication_log(self, oldest):
+        async with self.db.begin():
+            result = await self._execute(
+                select(func.max(ReplicationLog.id)).where(
+                    ReplicationLog.removed.is_(True),
+                    ReplicationLog.created < oldest,
+                )
+            )
+            pruned = result.scalar()
+            if pruned is None:
+                return 0
+
+            # Replicas that haven't seen all the pruned removals yet have to
+            # synchronize again from scratch
+            await self._set_config("replication-pruned", str(pruned))
+            result = await self._execute(
+                delete(ReplicationLog).where(
+                    ReplicationLog.removed.is_(True),
+                    ReplicationLog.id <= pruned,
+                )
+            )
+            return result.rowcount
+
+    async def clear_hashes(self):
+        async with self.db.begin():
+            await self._execute(delete(OuthashesV2))
+            await self._execute(delete(UnihashesV3))
+            await self._execute(delete(ReplicationLog))
+
+    async def remove_unihash(self, method, taskhash):
+        where = [UnihashesV3.method == method, UnihashesV3.taskhash == taskhash]
+        async with self.db.begin():
+            await self._log_removed("unihash", where)
+            result = await self._execute(delete(UnihashesV3).where(*where))
+            return result.rowcount
+
+    async def remove_outhash(self, method, taskhash, outhash):
+        where = [
+            OuthashesV2.method == method,
+            OuthashesV2.taskhash == taskhash,
+            OuthashesV2.outhash == outhash,
+        ]
+        async with self.db.begin():
+            await self._log_removed("outhash", where)
+            result = await self._execute(delete(OuthashesV2).where(*where))
+            return result.rowcount
+
     async def remove(self, condition):
-        async def do_remove(table):
+        async def do_remove(kind, table):
             where = _make_condition_statement(table, condition)
             if where:
                 async with self.db.begin():
+                    await self._log_removed(kind, where)
                     result = await self._execute(delete(table).where(*where))
                 return result.rowcount
 
             return 0
 
         count = 0
-        count += await do_remove(UnihashesV3)
-        count += await do_remove(OuthashesV2)
+        count += await do_remove("unihash", UnihashesV3)
+        count += await do_remove("outhash", OuthashesV2)
 
         return count
 
@@ -405,36 +607,33 @@ class Database(object):
 
     async def gc_sweep(self):
         async with self.db.begin():
-            result = await self._execute(
-                delete(UnihashesV3).where(
-                    # A sneaky conditional that provides some errant use
-                    # protection: If the config mark is NULL, this will not
-                    # match any rows because No default is specified in the
-                    # select statement
-                    UnihashesV3.gc_mark
-                    != self._get_config_subquery("gc-mark")
-                )
-            )
+            # A sneaky conditional that provides some errant use
+            # protection: If the config mark is NULL, this will not
+            # match any rows because No default is specified in the
+            # select statement
+            where = [UnihashesV3.gc_mark != self._get_config_subquery("gc-mark")]
+            await self._log_removed("unihash", where)
+            result = await self._execute(delete(UnihashesV3).where(*where))
             await self._set_config("gc-mark", None)
 
             return result.rowcount
 
     async def clean_unused(self, oldest):
-        async with self.db.begin():
-            result = await self._execute(
-                delete(OuthashesV2).where(
-                    OuthashesV2.created < oldest,
-                    ~(
-                        select(UnihashesV3.id)
-                        .where(
-                            UnihashesV3.method == OuthashesV2.method,
-                            UnihashesV3.taskhash == OuthashesV2.taskhash,
-                        )
-                        .limit(1)
-                        .exists()
-                    ),
+        where = [
+            OuthashesV2.created < oldest,
+            ~(
+                select(UnihashesV3.id)
+                .where(
+                    UnihashesV3.method == OuthashesV2.method,
+                    UnihashesV3.taskhash == OuthashesV2.taskhash,
                 )
-            )
+                .limit(1)
+                .exists()
+            ),
+        ]
+        async with self.db.begin():
+            await self._log_removed("outhash", where)
+            result = await self._execute(delete(OuthashesV2).where(*where))
             return result.rowcount
 
     async def insert_unihash(self, method, taskhash, unihash):
@@ -461,7 +660,12 @@ class Database(object):
         try:
             async with self.db.begin():
                 result = await self._execute(statement)
-                return result.rowcount != 0
+                if result.rowcount == 0:
+                    return False
+                await self._log_added(
+                    "unihash", {"method": method, "taskhash": taskhash}
+                )
+                return True
         except IntegrityError:
             self.logger.debug(
                 "%s, %s, %s already in unihash database", method, taskhash, unihash
@@ -491,7 +695,10 @@ class Database(object):
         try:
             async with self.db.begin():
                 result = await self._execute(statement)
-                return result.rowcount != 0
+                if result.rowcount == 0:
+                    return False
+                await self._log_added("outhash", data)
+                return True
         except IntegrityError:
             self.logger.debug(
                 "%s, %s already in outhash database", data["method"], data["outhash"]
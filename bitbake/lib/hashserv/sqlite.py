@@ -6,6 +6,7 @@
 #
 import sqlite3
 import logging
+from datetime import datetime
 from contextlib import closing
 from . import User
 
@@ -52,6 +53,17 @@ CONFIG_TABLE_DEFINITION = (
 
 CONFIG_TABLE_COLUMNS = tuple(name for name, _, _ in CONFIG_TABLE_DEFINITION)
 
+# The columns that identify a row of each kind in the replication log, and
+# the columns of the table sent to replicas for an added row
+REPLICATION_TABLES = {
+    "unihash": ("unihashes_v3", ("method", "taskhash"), ("unihash",)),
+    "outhash": (
+        "outhashes_v2",
+        ("method", "taskhash", "outhash"),
+        tuple(c for c in OUTHASH_TABLE_COLUMNS if c not in ("method", "taskhash", "outhash")),
+    ),
+}
+
 
 def _make_table(cursor, name, definition):
     cursor.execute(
@@ -71,6 +83,64 @@ def _make_table(cursor, name, definition):
     )
 
 
+def _make_replication_log(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS replication_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            removed INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            taskhash TEXT NOT NULL,
+            outhash TEXT,
+            created DATETIME
+            )
+        """
+    )
+
+
+def _log_added(cursor, kind, keys):
+    cursor.execute(
+        """
+        INSERT INTO replication_log (kind, removed, method, taskhash, outhash, created)
+        VALUES (:kind, 0, :method, :taskhash, :outhash, :created)
+        """,
+        {
+            "kind": kind,
+            "method": keys["method"],
+            "taskhash": keys["taskhash"],
+            "outhash": keys.get("outhash"),
+            "created": datetime.now(),
+        },
+    )
+
+
+def _log_removed(cursor, kind, clause, where):
+    """
+    Record the removal of the rows of the kind matching clause in the
+    replication log. The log entries of the rows being added are removed,
+    since a replica catching up no longer needs to add them
+    """
+    table, keys, _ = REPLICATION_TABLES[kind]
+    match = " AND ".join("%s.%s=replication_log.%s" % (table, k, k) for k in keys)
+    cursor.execute(
+        f"""
+        DELETE FROM replication_log WHERE kind='{kind}' AND removed=0 AND EXISTS (
+            SELECT {table}.id FROM {table} WHERE ({clause}) AND {match}
+        )
+        """,
+        where,
+    )
+    cursor.execute(
+        f"""
+        INSERT INTO replication_log (kind, removed, method, taskhash, outhash, created)
+        SELECT '{kind}', 1, method, taskhash, {"outhash" if "outhash" in keys else "NULL"}, :log_created
+        FROM {table} WHERE {clause}
+        """,
+        dict(where, log_created=datetime.now()),
+    )
+
+
 def map_user(row):
     if row is None:
         return None
@@ -124,6 +194,7 @@ class DatabaseEngine(object):
             _make_table(cursor, "outhashes_v2", OUTHASH_TABLE_DEFINITION)
             _make_table(cursor, "users", USERS_TABLE_DEFINITION)
             _make_table(cursor, "config", CONFIG_TABLE_DEFINITION)
+            _make_replication_log(cursor)
 
             cursor.execute("PRAGMA journal_mode = WAL")
             cursor.execute(
@@ -151,6 +222,9 @@ class DatabaseEngine(object):
                 "CREATE INDEX IF NOT EXISTS outhash_lookup_v3 ON outhashes_v2 (method, outhash)"
             )
             cursor.execute("CREATE INDEX IF NOT EXISTS config_lookup ON config (name)")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS replication_log_lookup ON replication_log (kind, method, taskhash, outhash)"
+            )
 
             sqlite_version = _get_sqlite_version(cursor)
 
@@ -171,6 +245,20 @@ class DatabaseEngine(object):
                 db.commit()
                 self.logger.info("Upgrade complete")
 
+            # Databases from before the replication log was added need their
+            # existing rows in it for replicas to get them
+            cursor.execute("SELECT id FROM replication_log LIMIT 1")
+            if cursor.fetchone() is None:
+                for kind, (table, keys, _) in REPLICATION_TABLES.items():
+                    cursor.execute(
+                        f"""
+                        INSERT INTO replication_log (kind, removed, method, taskhash, outhash)
+                        SELECT '{kind}', 0, method, taskhash, {"outhash" if "outhash" in keys else "NULL"}
+                        FROM {table} ORDER BY id ASC
+                        """
+                    )
+                db.commit()
+
     def connect(self, logger):
         return Database(logger, self.dbname, self.sync)
 
@@ -224,6 +312,15 @@ class Database(object):
     async def close(self):
         self.db.close()
 
+    async def get_config(self, name):
+        with closing(self.db.cursor()) as cursor:
+            return await self._get_config(cursor, name)
+
+    async def set_config(self, name, value):
+        with closing(self.db.cursor()) as cursor:
+            await self._set_config(cursor, name, value)
+            self.db.commit()
+
     async def get_unihash_by_taskhash_full(self, method, taskhash):
         with closing(self.db.cursor()) as cursor:
             cursor.execute(
@@ -318,10 +415,106 @@ class Database(object):
             )
             return cursor.fetchone()
 
+    async def get_replication_log(self, last_id, limit):
+        joins = []
+        columns = []
+        for kind, (table, keys, values) in REPLICATION_TABLES.items():
+            match = " AND ".join(
+                "%s.%s=replication_log.%s" % (table, k, k) for k in keys
+            )
+            joins.append(
+                f"LEFT JOIN {table} ON replication_log.kind='{kind}' AND replication_log.removed=0 AND {match}"
+            )
+            columns.extend("%s.%s AS %s" % (table, v, v) for v in values)
+
+        with closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                """
+                SELECT replication_log.id AS id, kind, removed,
+                    replication_log.method AS method,
+                    replication_log.taskhash AS taskhash,
+                    replication_log.outhash AS outhash,
+                    {columns}
+                FROM replication_log
+                {joins}
+                WHERE replication_log.id>:last_id
+                ORDER BY replication_log.id ASC
+                LIMIT :limit
+                """.format(columns=", ".join(columns), joins=" ".join(joins)),
+                {
+                    "last_id": last_id,
+                    "limit": limit,
+                },
+            )
+
+            updates = []
+            for row in cursor.fetchall():
+                _, keys, values = REPLICATION_TABLES[row["kind"]]
+                d = {
+                    "id": row["id"],
+                    "kind": row["kind"],
+                    "removed": bool(row["removed"]),
+                }
+                d.update((k, row[k]) for k in keys)
+                if not d["removed"]:
+                    d.update((v, row[v]) for v in values)
+                updates.append(d)
+            return updates
+
+    async def prune_replication_log(self, oldest):
+        with closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                "SELECT MAX(id) FROM replication_log WHERE removed=1 AND created<:oldest",
+                {
+                    "oldest": oldest,
+                },
+            )
+            pruned = cursor.fetchone()[0]
+            if pruned is None:
+                return 0
+
+            # Replicas that haven't seen all the pruned removals yet have to
+            # synchronize again from scratch
+            await self._set_config(cursor, "replication-pruned", str(pruned))
+            cursor.execute(
+                "DELETE FROM replication_log WHERE removed=1 AND id<=:pruned",
+                {
+                    "pruned": pruned,
+                },
+            )
+            self.db.commit()
+            return cursor.rowcount
+
+    async def clear_hashes(self):
+        with closing(self.db.cursor()) as cursor:
+            cursor.execute("DELETE FROM outhashes_v2")
+            cursor.execute("DELETE FROM unihashes_v3")
+            cursor.execute("DELETE FROM replication_log")
+            self.db.commit()
+
+    async def remove_unihash(self, method, taskhash):
+        with closing(self.db.cursor()) as cursor:
+            where = {"method": method, "taskhash": taskhash}
+            clause = "method=:method AND taskhash=:taskhash"
+            _log_removed(cursor, "unihash", clause, where)
+            cursor.execute(f"DELETE FROM unihashes_v3 WHERE {clause}", where)
+            self.db.commit()
+            return cursor.rowcount
+
+    async def remove_outhash(self, method, taskhash, outhash):
+        with closing(self.db.cursor()) as cursor:
+            where = {"method": method, "taskhash": taskhash, "outhash": outhash}
+            clause = "method=:method AND taskhash=:taskhash AND outhash=:outhash"
+            _log_removed(cursor, "outhash", clause, where)
+            cursor.execute(f"DELETE FROM outhashes_v2 WHERE {clause}", where)
+            self.db.commit()
+            return cursor.rowcount
+
     async def remove(self, condition):
-        def do_remove(columns, table_name, cursor):
+        def do_remove(columns, kind, table_name, cursor):
             where, clause = _make_condition_statement(columns, condition)
             if where:
+                _log_removed(cursor, kind, clause, where)
                 query = f"DELETE FROM {table_name} WHERE {clause}"
                 cursor.execute(query, where)
                 return cursor.rowcount
@@ -330,8 +523,8 @@ class Database(object):
 
         count = 0
         with closing(self.db.cursor()) as cursor:
-            count += do_remove(OUTHASH_TABLE_COLUMNS, "outhashes_v2", cursor)
-            count += do_remove(UNIHASH_TABLE_COLUMNS, "unihashes_v3", cursor)
+            count += do_remove(OUTHASH_TABLE_COLUMNS, "outhash", "outhashes_v2", cursor)
+            count += do_remove(UNIHASH_TABLE_COLUMNS, "unihash", "unihashes_v3", cursor)
             self.db.commit()
 
         return count
@@ -387,12 +580,9 @@ class Database(object):
         with closing(self.db.cursor()) as cursor:
             # NOTE: COALESCE is not used in this query so that if the current
             # mark is NULL, nothing will happen
-            cursor.execute(
-                """
-                DELETE FROM unihashes_v3 WHERE
-                    gc_mark!=(SELECT value FROM config WHERE name='gc-mark')
-                """
-            )
+            clause = "gc_mark!=(SELECT value FROM config WHERE name='gc-mark')"
+            _log_removed(cursor, "unihash", clause, {})
+            cursor.execute(f"DELETE FROM unihashes_v3 WHERE {clause}")
             count = cursor.rowcount
             await self._set_config(cursor, "gc-mark", None)
 
@@ -401,16 +591,16 @@ class Database(object):
 
     async def clean_unused(self, oldest):
         with closing(self.db.cursor()) as cursor:
-            cursor.execute(
-                """
-                DELETE FROM outhashes_v2 WHERE created<:oldest AND NOT EXISTS (
+            clause = """
+                outhashes_v2.created<:oldest AND NOT EXISTS (
                     SELECT unihashes_v3.id FROM unihashes_v3 WHERE unihashes_v3.method=outhashes_v2.method AND unihashes_v3.taskhash=outhashes_v2.taskhash LIMIT 1
                 )
-                """,
-                {
-                    "oldest": oldest,
-                },
-            )
+                """
+            where = {
+                "oldest": oldest,
+            }
+            _log_removed(cursor, "outhash", clause, where)
+            cursor.execute(f"DELETE FROM outhashes_v2 WHERE {clause}", where)
             self.db.commit()
             return cursor.rowcount
 
@@ -433,8 +623,11 @@ class Database(object):
                     "unihash": unihash,
                 },
             )
+            inserted = cursor.lastrowid != prevrowid
+            if inserted:
+                _log_added(cursor, "unihash", {"method": method, "taskhash": taskhash})
             self.db.commit()
-            return cursor.lastrowid != prevrowid
+            return inserted
 
     async def insert_outhash(self, data):
         data = {k: v for k, v in data.items() if k in OUTHASH_TABLE_COLUMNS}
@@ -446,8 +639,11 @@ class Database(object):
         with closing(self.db.cursor()) as cursor:
             prevrowid = cursor.lastrowid
             cursor.execute(query, data)
+            inserted = cursor.lastrowid != prevrowid
+            if inserted:
+                _log_added(cursor, "outhash", data)
             self.db.commit()
-            return cursor.lastrowid != prevrowid
+            return inserted
 
     def _get_user(self, username):
         with closing(self.db.cursor()) as cursor:
@@ -42,7 +42,7 @@ class HashEquivalenceTestSetup(object):
     server_index = 0
     client_index = 0
 
-    def start_server(self, dbpath=None, upstream=None, read_only=False, prefunc=server_prefunc, anon_perms=DEFAULT_ANON_PERMS, admin_username=None, admin_password=None):
+    def start_server(self, dbpath=None, upstream=None, read_only=False, prefunc=server_prefunc, anon_perms=DEFAULT_ANON_PERMS, admin_username=None, admin_password=None, replicate=None, cache_size=None):
         self.server_index += 1
         if dbpath is None:
             dbpath = self.make_dbpath()
@@ -60,7 +60,9 @@ class HashEquivalenceTestSetup(object):
                                read_only=read_only,
                                anon_perms=anon_perms,
                                admin_username=admin_username,
-                               admin_password=admin_password)
+                               admin_password=admin_password,
+                               replicate=replicate,
+                               cache_size=cache_size)
         server.dbpath = dbpath
 
         server.serve_as_process(prefunc=prefunc, args=(self.server_index,))
@@ -478,6 +480,74 @@ class HashEquivalenceCommonTests(object):
         self.assertClientGetHash(rw_client, taskhash2, None)
 
 
+    def test_replica_server(self):
+        replica_server = self.start_server(replicate=self.server_address)
+        replica_client = self.start_client(replica_server.address)
+
+        def wait_for_hash(taskhash, unihash):
+            for _ in range(100):
+                if replica_client.get_unihash(self.METHOD, taskhash) == unihash:
+                    return
+                time.sleep(0.1)
+            self.assertClientGetHash(replica_client, taskhash, unihash)
+
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+        wait_for_hash(taskhash, unihash)
+        self.assertTrue(replica_client.unihash_exists(unihash))
+
+        # The outhash is replicated as well
+        result = replica_client.get_outhash(self.METHOD, outhash, taskhash)
+        self.assertEqual(result['unihash'], unihash)
+
+        # Equivalent hashes reported later are picked up
+        taskhash2 = '3bf6f1e89d26205aec90da04854fbdbf73afe6b4'
+        result = self.client.report_unihash_equiv(taskhash2, self.METHOD, unihash)
+        wait_for_hash(taskhash2, unihash)
+
+        # Reports to the replica don't change it or the server it replicates
+        taskhash3 = 'c665584ee6817aa99edfc77a44dd853828279370'
+        outhash3 = '3c979c3db45c569f51ab7626a4651074be3a9d11a84b1db076f5b14f7d39db44'
+        unihash3 = '90e9bc1d1f094c51824adca7f8ea79a048d68824'
+        result = replica_client.report_unihash(taskhash3, self.METHOD, outhash3, unihash3)
+        self.assertEqual(result['unihash'], unihash3)
+        self.assertClientGetHash(replica_client, taskhash3, None)
+        self.assertClientGetHash(self.client, taskhash3, None)
+
+        # Removed hashes are removed from the replica as well, without it
+        # having to synchronize again
+        epoch = replica_client.get_replication_updates(0, 1)["epoch"]
+        self.client.remove({"taskhash": taskhash})
+        wait_for_hash(taskhash, None)
+        self.assertClientGetHash(replica_client, taskhash2, unihash)
+        self.assertEqual(replica_client.get_replication_updates(0, 1)["epoch"], epoch)
+
+    def test_replication_log(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        updates = self.client.get_replication_updates(0, 100)
+        self.assertEqual(updates["pruned"], 0)
+        self.assertEqual(
+            [(u["kind"], u["removed"], u["taskhash"]) for u in updates["updates"]],
+            [("outhash", False, taskhash), ("unihash", False, taskhash)],
+        )
+        self.assertEqual(updates["updates"][0]["outhash"], outhash)
+        self.assertEqual(updates["updates"][1]["unihash"], unihash)
+        last_id = updates["updates"][-1]["id"]
+
+        # Removals are sent as log entries, and the epoch doesn't change
+        self.client.remove({"taskhash": taskhash})
+        removed = self.client.get_replication_updates(last_id, 100)
+        self.assertEqual(removed["epoch"], updates["epoch"])
+        self.assertEqual(
+            [(u["kind"], u["removed"], u["taskhash"]) for u in removed["updates"]],
+            [("outhash", True, taskhash), ("unihash", True, taskhash)],
+        )
+        self.assertNotIn("unihash", removed["updates"][1])
+
+        # Replicas starting from scratch don't get the removed hashes at all
+        updates = self.client.get_replication_updates(0, 100)
+        self.assertEqual([u["removed"] for u in updates["updates"]], [True, True])
+
     def test_slow_server_start(self):
         # Ensures that the server will exit correctly even if it gets a SIGTERM
         # before entering the main loop
@@ -556,6 +626,84 @@ class HashEquivalenceCommonTests(object):
         self.assertClientGetHash(self.client, taskhash2, unihash2)
 
 
+    def test_stream_batch(self):
+        # Enough queries to exceed the number of requests allowed in flight
+        taskhashes = []
+        for i in range(1000):
+            taskhash = hashlib.sha256()
+            taskhash.update(str(i).encode('utf-8'))
+            taskhashes.append(taskhash.hexdigest())
+
+        for taskhash in taskhashes[::2]:
+            outhash = hashlib.sha256(taskhash.encode('utf-8')).hexdigest()
+            self.client.report_unihash(taskhash, self.METHOD, outhash, taskhash)
+
+        expected = [taskhash if i % 2 == 0 else None for i, taskhash in enumerate(taskhashes)]
+        result = self.client.get_unihash_batch([(self.METHOD, taskhash) for taskhash in taskhashes])
+        self.assertEqual(result, expected)
+
+        result = self.client.unihash_exists_batch(taskhashes)
+        self.assertEqual(result, [i % 2 == 0 for i in range(len(taskhashes))])
+
+        # Normal and single stream requests still work afterwards
+        self.assertClientGetHash(self.client, taskhashes[0], taskhashes[0])
+        self.assertEqual(self.client.get_unihash_batch([]), [])
+        self.assertTrue(self.client.unihash_exists(taskhashes[0]))
+        self.client.get_stats()
+
+    def test_query_cache(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+        self.client.reset_stats()
+
+        # The first query fills the cache, the others are answered from it
+        for _ in range(3):
+            self.assertClientGetHash(self.client, taskhash, unihash)
+            self.assertEqual(self.client.get_unihash_batch([(self.METHOD, taskhash)]), [unihash])
+            self.assertTrue(self.client.unihash_exists(unihash))
+
+        stats = self.client.get_stats()["cache"]
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["hits"], 8)
+        self.assertEqual(stats["misses"], 1)
+
+        # Removing the hash must not leave stale cache entries
+        self.client.remove({"unihash": unihash})
+        self.assertClientGetHash(self.client, taskhash, None)
+        self.assertFalse(self.client.unihash_exists(unihash))
+        self.assertEqual(self.client.get_stats()["cache"]["size"], 0)
+
+        # Missing hashes aren't cached, so reporting the hash again makes
+        # it visible immediately
+        self.client.report_unihash(taskhash, self.METHOD, outhash, unihash)
+        self.assertClientGetHash(self.client, taskhash, unihash)
+        self.assertTrue(self.client.unihash_exists(unihash))
+
+        stats = self.client.reset_stats()["cache"]
+        self.assertEqual(stats["evictions"], 0)
+        self.assertEqual(self.client.get_stats()["cache"]["hits"], 0)
+
+    def test_query_cache_evictions(self):
+        server = self.start_server(cache_size=2)
+        client = self.start_client(server.address)
+
+        taskhashes = [hashlib.sha256(str(i).encode('utf-8')).hexdigest() for i in range(4)]
+        for taskhash in taskhashes:
+            client.report_unihash(taskhash, self.METHOD, taskhash, taskhash)
+            self.assertClientGetHash(client, taskhash, taskhash)
+
+        stats = client.get_stats()["cache"]
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["max_size"], 2)
+        self.assertEqual(stats["evictions"], 2)
+
+        # The least recently used entries were evicted
+        client.reset_stats()
+        self.assertClientGetHash(client, taskhashes[3], taskhashes[3])
+        self.assertClientGetHash(client, taskhashes[0], taskhashes[0])
+        stats = client.get_stats()["cache"]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
     def test_client_pool_get_unihashes(self):
         TEST_INPUT = (
             # taskhash                                   outhash                                                            unihash
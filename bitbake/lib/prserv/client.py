@@ -9,6 +9,8 @@ import bb.asyncrpc
 
 logger = logging.getLogger("BitBake.PRserv")
 
+EXPORT_BATCH_SIZE = 5000
+
 class PRAsyncClient(bb.asyncrpc.AsyncClient):
     def __init__(self):
         super().__init__("PRSERVICE", "1.0", logger)
@@ -48,6 +50,13 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
         if response:
             return response["value"]
 
+    async def importmany(self, rows):
+        response = await self.invoke(
+            {"import-many": {"rows": rows}}
+        )
+        if response:
+            return response["conflicts"]
+
     async def export(self, version, pkgarch, checksum, colinfo):
         response = await self.invoke(
             {"export": {"version": version, "pkgarch": pkgarch, "checksum": checksum, "colinfo": colinfo}}
@@ -55,6 +64,18 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
         if response:
             return (response["metainfo"], response["datainfo"])
 
+    async def export_batch(self, version, pkgarch, checksum, after, limit):
+        response = await self.invoke(
+            {"export-batch": {"version": version, "pkgarch": pkgarch, "checksum": checksum, "after": after, "limit": limit}}
+        )
+        if response:
+            return response["datainfo"]
+
+    async def compact(self, full=False):
+        return await self.invoke(
+            {"compact": {"full": full}}
+        )
+
     async def is_readonly(self):
         response = await self.invoke(
             {"is-readonly": {}}
@@ -65,7 +86,22 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
 class PRClient(bb.asyncrpc.Client):
     def __init__(self):
         super().__init__()
-        self._add_methods("getPR", "test_pr", "test_package", "importone", "export", "is_readonly")
+        self._add_methods("getPR", "test_pr", "test_package", "importone", "importmany", "export", "export_batch", "compact", "is_readonly")
 
     def _get_async_client(self):
         return PRAsyncClient()
+
+    def export_iter(self, version, pkgarch, checksum, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Iterates over the exported rows, fetching them from the server a
+        batch at a time
+        """
+        after = None
+        while True:
+            datainfo = self.export_batch(version, pkgarch, checksum, after, batch_size)
+            yield from datainfo
+            # The server may return smaller batches than asked for
+            if not datainfo:
+                break
+            last = datainfo[-1]
+            after = (last["version"], last["pkgarch"], last["checksum"])
@@ -58,11 +58,18 @@ class PRTable(object):
 
     def _execute(self, *query):
         """Execute a query, waiting to acquire a lock if necessary"""
+        return self._retry_locked(self.conn.execute, *query)
+
+    def _executemany(self, *query):
+        """Execute a query for each set of parameters, waiting to acquire a lock if necessary"""
+        return self._retry_locked(self.conn.executemany, *query)
+
+    def _retry_locked(self, func, *args):
         start = time.time()
         end = start + 20
         while True:
             try:
-                return self.conn.execute(*query)
+                return func(*args)
             except sqlite3.OperationalError as exc:
                 if "is locked" in str(exc) and end > time.time():
                     continue
@@ -258,6 +265,68 @@ class PRTable(object):
         else:
             return self._import_hist(version, pkgarch, checksum, value)
 
+    def importmany(self, rows):
+        """
+        Imports a list of (version, pkgarch, checksum, value) rows in a single
+        transaction. Returns the rows for which the database has a different
+        value afterwards, as (version, pkgarch, checksum, value, dbvalue)
+        """
+        if self.read_only:
+            return None
+
+        rows = [tuple(row) for row in rows]
+        self._executemany("INSERT OR IGNORE INTO %s VALUES (?, ?, ?, ?);" % (self.table), rows)
+        if self.nohist:
+            self._executemany("UPDATE %s SET value=? WHERE version=? AND pkgarch=? AND checksum=? AND value<?" % (self.table),
+                              [(value, version, pkgarch, checksum, value) for (version, pkgarch, checksum, value) in rows])
+
+        self.dirty = True
+
+        conflicts = []
+        for (version, pkgarch, checksum, value) in rows:
+            dbvalue = self.find_value(version, pkgarch, checksum)
+            if dbvalue != value:
+                conflicts.append((version, pkgarch, checksum, value, dbvalue))
+        return conflicts
+
+    def _export_query(self, version, pkgarch, checksum):
+        if self.nohist:
+            sqlstmt = "SELECT T1.version, T1.pkgarch, T1.checksum, T1.value FROM %s as T1 \
+                    WHERE T1.value=(SELECT max(value) FROM %s as T2 WHERE T2.version=T1.version AND T2.pkgarch=T1.pkgarch) " % (self.table, self.table)
+        else:
+            sqlstmt = "SELECT * FROM %s as T1 WHERE 1=1 " % self.table
+        sqlarg = []
+        if version:
+            sqlstmt += "AND T1.version=? "
+            sqlarg.append(str(version))
+        if pkgarch:
+            sqlstmt += "AND T1.pkgarch=? "
+            sqlarg.append(str(pkgarch))
+        if checksum:
+            sqlstmt += "AND T1.checksum=? "
+            sqlarg.append(str(checksum))
+        return (sqlstmt, sqlarg)
+
+    def export_batch(self, version, pkgarch, checksum, after, limit):
+        """
+        Returns up to limit rows of the export, ordered by (version, pkgarch,
+        checksum) and starting after the given (version, pkgarch, checksum),
+        or from the first row if after is None. Exporting a large table a
+        batch at a time doesn't need the whole table in memory at once.
+        """
+        (sqlstmt, sqlarg) = self._export_query(version, pkgarch, checksum)
+        sqlstmt += "AND T1.version!='' "
+        if after:
+            sqlstmt += "AND (T1.version, T1.pkgarch, T1.checksum) > (?, ?, ?) "
+            sqlarg.extend(str(a) for a in after)
+        sqlstmt += "ORDER BY T1.version, T1.pkgarch, T1.checksum LIMIT ?;"
+        sqlarg.append(int(limit))
+
+        datainfo = []
+        for row in self._execute(sqlstmt, tuple(sqlarg)):
+            datainfo.append({k: row[k] for k in ("version", "pkgarch", "checksum", "value")})
+        return datainfo
+
     def export(self, version, pkgarch, checksum, colinfo):
         metainfo = {}
         #column info
@@ -278,25 +347,8 @@ class PRTable(object):
         #data info
         datainfo = []
 
-        if self.nohist:
-            sqlstmt = "SELECT T1.version, T1.pkgarch, T1.checksum, T1.value FROM %s as T1, \
-                    (SELECT version, pkgarch, max(value) as maxvalue FROM %s GROUP BY version, pkgarch) as T2 \
-                    WHERE T1.version=T2.version AND T1.pkgarch=T2.pkgarch AND T1.value=T2.maxvalue " % (self.table, self.table)
-        else:
-            sqlstmt = "SELECT * FROM %s as T1 WHERE 1=1 " % self.table
-        sqlarg = []
-        where = ""
-        if version:
-            where += "AND T1.version=? "
-            sqlarg.append(str(version))
-        if pkgarch:
-            where += "AND T1.pkgarch=? "
-            sqlarg.append(str(pkgarch))
-        if checksum:
-            where += "AND T1.checksum=? "
-            sqlarg.append(str(checksum))
-
-        sqlstmt += where + ";"
+        (sqlstmt, sqlarg) = self._export_query(version, pkgarch, checksum)
+        sqlstmt += ";"
 
         if len(sqlarg):
             data = self._execute(sqlstmt, tuple(sqlarg))
@@ -339,11 +391,38 @@ class PRData(object):
         if not self.read_only:
             self.connection.execute("pragma synchronous = off;")
             self.connection.execute("PRAGMA journal_mode = MEMORY;")
+            # Only takes effect for new databases, existing ones need a full
+            # vacuum() to be converted
+            self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         self._tables={}
 
     def disconnect(self):
         self.connection.close()
 
+    def free_pages(self):
+        return self.connection.execute("PRAGMA freelist_count;").fetchone()[0]
+
+    def incremental_vacuum_enabled(self):
+        return self.connection.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2
+
+    def incremental_vacuum(self, pages):
+        """
+        Returns up to the given number of free pages to the filesystem and
+        returns the number of free pages left
+        """
+        # Each step of the statement frees one page
+        self.connection.execute("PRAGMA incremental_vacuum(%d);" % pages).fetchall()
+        return self.free_pages()
+
+    def vacuum(self):
+        """
+        Rebuilds the whole database, which also enables incremental vacuum.
+        No other queries can run until it completes.
+        """
+        self.connection.commit()
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        self.connection.execute("VACUUM;")
+
     def __getitem__(self, tblname):
         if not isinstance(tblname, str):
             raise TypeError("tblname argument must be a string, not '%s'" %
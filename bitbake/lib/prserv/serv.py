@@ -6,6 +6,7 @@
 
 import os,sys,logging
 import signal, time
+import asyncio
 import socket
 import io
 import sqlite3
@@ -19,6 +20,16 @@ logger = logging.getLogger("BitBake.PRserv")
 PIDPREFIX = "/tmp/PRServer_%s_%s.pid"
 singleton = None
 
+# Largest number of rows imported or exported by a single request
+MAX_BATCH_ROWS = 10000
+
+# Number of pages freed by each step of an online compaction, other requests
+# are served between the steps
+COMPACT_STEP_PAGES = 256
+
+# Requests which don't use the database and so don't wait for a compaction
+NO_DB_REQUESTS = ("ping", "compact")
+
 class PRServerClient(bb.asyncrpc.AsyncServerConnection):
     def __init__(self, socket, server):
         super().__init__(socket, "PRSERVICE", server.logger)
@@ -30,7 +41,10 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
             "test-package": self.handle_test_package,
             "max-package-pr": self.handle_max_package_pr,
             "import-one": self.handle_import_one,
+            "import-many": self.handle_import_many,
             "export": self.handle_export,
+            "export-batch": self.handle_export_batch,
+            "compact": self.handle_compact,
             "is-readonly": self.handle_is_readonly,
         })
 
@@ -38,13 +52,19 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
         return (self.proto_version == (1, 0))
 
     async def dispatch_message(self, msg):
-        try:
+        if any(k in msg for k in NO_DB_REQUESTS):
             return await super().dispatch_message(msg)
-        except:
-            self.server.table.sync()
-            raise
-        else:
-            self.server.table.sync_if_dirty()
+
+        # The compaction runs outside of the event loop, so the database
+        # accesses are serialized with a lock
+        async with self.server.db_lock:
+            try:
+                return await super().dispatch_message(msg)
+            except:
+                self.server.table.sync()
+                raise
+            else:
+                self.server.table.sync_if_dirty()
 
     async def handle_test_pr(self, request):
         '''Finds the PR value corresponding to the request. If not found, returns None and doesn't insert a new value'''
@@ -99,6 +119,18 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
 
         return response
 
+    async def handle_import_many(self, request):
+        response = None
+        if not self.server.read_only:
+            rows = request["rows"]
+            if len(rows) > MAX_BATCH_ROWS:
+                raise bb.asyncrpc.InvokeError("Too many rows in import (%d > %d)" % (len(rows), MAX_BATCH_ROWS))
+
+            conflicts = self.server.table.importmany(rows)
+            response = {"conflicts": conflicts}
+
+        return response
+
     async def handle_export(self, request):
         version = request["version"]
         pkgarch = request["pkgarch"]
@@ -113,6 +145,63 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
 
         return {"metainfo": metainfo, "datainfo": datainfo}
 
+    async def handle_export_batch(self, request):
+        version = request["version"]
+        pkgarch = request["pkgarch"]
+        checksum = request["checksum"]
+        after = request.get("after")
+        limit = max(1, min(int(request.get("limit", MAX_BATCH_ROWS)), MAX_BATCH_ROWS))
+
+        datainfo = self.server.table.export_batch(version, pkgarch, checksum, after, limit)
+        return {"datainfo": datainfo}
+
+    async def handle_compact(self, request):
+        '''Returns the free pages of the database to the filesystem in small steps, letting other requests run in between'''
+        response = None
+        if not self.server.read_only:
+            full = request.get("full", False)
+            db = self.server.db
+            table = self.server.table
+            loop = asyncio.get_running_loop()
+            start_time = time.monotonic()
+
+            def vacuum_step():
+                remaining = db.incremental_vacuum(COMPACT_STEP_PAGES)
+                table.sync()
+                return remaining
+
+            # The vacuum runs in an executor thread so that the server can
+            # still accept connections and answer pings, the database lock is
+            # only held for one step at a time
+            async with self.server.db_lock:
+                free_pages = db.free_pages()
+                incremental = db.incremental_vacuum_enabled()
+
+            if full or not incremental:
+                if not full:
+                    raise bb.asyncrpc.InvokeError("Database doesn't use incremental vacuum, a full compaction is needed once")
+                self.logger.info("Running full compaction of %s", self.server.dbfile)
+                async with self.server.db_lock:
+                    await loop.run_in_executor(None, db.vacuum)
+            else:
+                remaining = free_pages
+                while remaining:
+                    last = remaining
+                    async with self.server.db_lock:
+                        remaining = await loop.run_in_executor(None, vacuum_step)
+                    if remaining >= last:
+                        break
+
+            async with self.server.db_lock:
+                table.sync()
+                response = {
+                    "full": bool(full),
+                    "freed_pages": free_pages - db.free_pages(),
+                    "seconds": time.monotonic() - start_time,
+                }
+
+        return response
+
     async def handle_is_readonly(self, request):
         return {"readonly": self.server.read_only}
 
@@ -122,12 +211,14 @@ class PRServer(bb.asyncrpc.AsyncServer):
         self.dbfile = dbfile
         self.table = None
         self.read_only = read_only
+        self.db_lock = None
 
     def accept_client(self, socket):
         return PRServerClient(socket, self)
 
     def start(self):
         tasks = super().start()
+        self.db_lock = asyncio.Lock()
         self.db = prserv.db.PRData(self.dbfile, read_only=self.read_only)
         self.table = self.db["PRMAIN"]
 
@@ -378,6 +469,20 @@ def ping(host, port):
         conn.connect_tcp(host, port)
         return conn.ping()
 
+def compact(host, port, full=False):
+    from . import client
+
+    with client.PRClient() as conn:
+        conn.connect_tcp(host, port)
+        result = conn.compact(full)
+
+    if result is None:
+        sys.stderr.write("Database of PR service %s:%d is read-only\n" % (host, port))
+        return 1
+
+    print("Freed %d pages in %.2fs" % (result["freed_pages"], result["seconds"]))
+    return 0
+
 def connect(host, port):
     from . import client
 
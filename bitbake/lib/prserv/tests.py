@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from . import db, serv
+from .client import PRClient
+from bb.asyncrpc import InvokeError
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+PKGARCH = "core2-64"
+
+def make_rows(count, version="1.0", pkgarch=PKGARCH, value=0):
+    return [(version, pkgarch, "%040x" % i, value + i) for i in range(count)]
+
+def make_version_rows(count):
+    # Only the highest value of each version and pkgarch is exported without
+    # history, so give each row its own version
+    return [("%06d" % i, PKGARCH, "%040x" % i, i) for i in range(count)]
+
+class PRTableTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="bb-prserv")
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def open_table(self, nohist):
+        prdata = db.PRData(os.path.join(self.temp_dir.name, "prserv.sqlite3"), nohist=nohist)
+        self.addCleanup(prdata.disconnect)
+        return prdata["PRMAIN"]
+
+    def test_importmany_nohist(self):
+        table = self.open_table(nohist=True)
+        table.importone("1.0", PKGARCH, "a", 5)
+        table.importone("1.0", PKGARCH, "b", 1)
+
+        conflicts = table.importmany([("1.0", PKGARCH, "a", 3),
+                                      ("1.0", PKGARCH, "b", 4),
+                                      ("1.0", PKGARCH, "c", 2)])
+        # Lower values don't replace the existing ones, higher values do
+        self.assertEqual(conflicts, [("1.0", PKGARCH, "a", 3, 5)])
+        self.assertEqual(table.find_value("1.0", PKGARCH, "a"), 5)
+        self.assertEqual(table.find_value("1.0", PKGARCH, "b"), 4)
+        self.assertEqual(table.find_value("1.0", PKGARCH, "c"), 2)
+
+    def test_importmany_hist(self):
+        table = self.open_table(nohist=False)
+        table.importone("1.0", PKGARCH, "a", 5)
+
+        conflicts = table.importmany([("1.0", PKGARCH, "a", 6),
+                                      ("1.0", PKGARCH, "b", 2)])
+        # Existing values are never replaced
+        self.assertEqual(conflicts, [("1.0", PKGARCH, "a", 6, 5)])
+        self.assertEqual(table.find_value("1.0", PKGARCH, "a"), 5)
+        self.assertEqual(table.find_value("1.0", PKGARCH, "b"), 2)
+
+    def test_importmany_matches_importone(self):
+        rows = [("1.0", PKGARCH, "a", 3), ("1.0", PKGARCH, "b", 7), ("2.0", PKGARCH, "a", 1)]
+        existing = [("1.0", PKGARCH, "a", 5), ("1.0", PKGARCH, "b", 6)]
+        for nohist in (True, False):
+            with self.subTest(nohist=nohist):
+                prdata = db.PRData(os.path.join(self.temp_dir.name, "one-%s.sqlite3" % nohist), nohist=nohist)
+                self.addCleanup(prdata.disconnect)
+                one = prdata["PRMAIN"]
+                prdata = db.PRData(os.path.join(self.temp_dir.name, "many-%s.sqlite3" % nohist), nohist=nohist)
+                self.addCleanup(prdata.disconnect)
+                many = prdata["PRMAIN"]
+
+                for row in existing:
+                    one.importone(*row)
+                    many.importone(*row)
+
+                # importmany() reports the rows importone() rejects
+                rejected = [row for row in rows if one.importone(*row) != row[3]]
+                conflicts = many.importmany(rows)
+                self.assertEqual([c[:4] for c in conflicts], rejected)
+                self.assertEqual(many.export(None, None, None, False), one.export(None, None, None, False))
+
+    def test_export_batch_hist(self):
+        table = self.open_table(nohist=False)
+        table.importmany(make_rows(30) + make_rows(20, version="2.0") + make_rows(7, pkgarch="x86"))
+
+        (_, datainfo) = table.export(None, None, None, False)
+        self.assertEqual(len(datainfo), 57)
+        batches = []
+        after = None
+        while True:
+            batch = table.export_batch(None, None, None, after, 8)
+            batches.append(batch)
+            if len(batch) < 8:
+                break
+            after = (batch[-1]["version"], batch[-1]["pkgarch"], batch[-1]["checksum"])
+        self.assertEqual(len(batches), 8)
+        key = lambda row: (row["version"], row["pkgarch"], row["checksum"])
+        self.assertEqual([row for batch in batches for row in batch], sorted(datainfo, key=key))
+
+class PRServerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="bb-prserv")
+        self.addCleanup(self.temp_dir.cleanup)
+        self.dbfile = os.path.join(self.temp_dir.name, "prserv.sqlite3")
+
+    def start_server(self):
+        def cleanup_server(server):
+            if server.process.exitcode is not None:
+                return
+
+            server.process.terminate()
+            server.process.join()
+
+        server = serv.PRServer(self.dbfile)
+        server.start_unix_server(os.path.join(self.temp_dir.name, "sock"))
+        server.serve_as_process()
+        self.addCleanup(cleanup_server, server)
+        self.address = server.address
+        return server
+
+    def start_client(self):
+        client = PRClient()
+        client.connect_unix(self.address.replace("unix://", "", 1))
+        self.addCleanup(client.close)
+        return client
+
+    def test_import_many(self):
+        self.start_server()
+        client = self.start_client()
+        client.importone("1.0", PKGARCH, "a", 5)
+
+        conflicts = client.importmany([("1.0", PKGARCH, "a", 3), ("1.0", PKGARCH, "b", 2)])
+        self.assertEqual(conflicts, [["1.0", PKGARCH, "a", 3, 5]])
+        self.assertEqual(client.test_pr("1.0", PKGARCH, "b"), 2)
+
+    def test_export_batch_roundtrip(self):
+        self.start_server()
+        client = self.start_client()
+        rows = make_version_rows(25) + make_rows(10, version="000003")
+        self.assertEqual(client.importmany(rows), [])
+
+        (_, datainfo) = client.export(None, None, None, False)
+        self.assertEqual(len(datainfo), 25)
+        key = lambda row: (row["version"], row["pkgarch"], row["checksum"])
+        # A batch size which doesn't divide the number of rows
+        self.assertEqual(list(client.export_iter(None, None, None, batch_size=2)), sorted(datainfo, key=key))
+        self.assertEqual(list(client.export_iter("000003", None, None, batch_size=2)),
+                         [row for row in datainfo if row["version"] == "000003"])
+
+    def test_max_batch_rows(self):
+        self.start_server()
+        client = self.start_client()
+        rows = make_version_rows(serv.MAX_BATCH_ROWS + 1)
+
+        with self.assertRaises(InvokeError):
+            client.importmany(rows)
+
+        # The rows have to be sent in chunks
+        self.assertEqual(client.importmany(rows[:serv.MAX_BATCH_ROWS]), [])
+        self.assertEqual(client.importmany(rows[serv.MAX_BATCH_ROWS:]), [])
+
+        # Larger batches are limited to MAX_BATCH_ROWS
+        batch = client.export_batch(None, None, None, None, serv.MAX_BATCH_ROWS + 100)
+        self.assertEqual(len(batch), serv.MAX_BATCH_ROWS)
+        self.assertEqual(len(list(client.export_iter(None, None, None, batch_size=serv.MAX_BATCH_ROWS + 100))),
+                         serv.MAX_BATCH_ROWS + 1)
+
+    def test_compact_during_get_pr(self):
+        # Create a database with free pages
+        prdata = db.PRData(self.dbfile)
+        table = prdata["PRMAIN"]
+        for i in range(0, 20000, 5000):
+            table.importmany([(v, a, c * 8, value) for (v, a, c, value) in make_rows(5000, version="%d" % i)])
+        prdata.connection.execute("DELETE FROM %s WHERE version!='0'" % table.table)
+        prdata.connection.commit()
+        free_pages = prdata.free_pages()
+        self.assertTrue(prdata.incremental_vacuum_enabled())
+        prdata.disconnect()
+        self.assertGreater(free_pages, serv.COMPACT_STEP_PAGES)
+        size = os.path.getsize(self.dbfile)
+
+        self.start_server()
+        client = self.start_client()
+        errors = []
+        stop = threading.Event()
+
+        def get_pr():
+            try:
+                with PRClient() as getpr_client:
+                    getpr_client.connect_unix(self.address.replace("unix://", "", 1))
+                    # Each new checksum gets the next value
+                    i = 0
+                    while not stop.is_set():
+                        value = getpr_client.getPR("1.0", PKGARCH, "new%d" % i)
+                        if value != i:
+                            errors.append("new%d got %s" % (i, value))
+                        i += 1
+            except Exception as e:
+                errors.append(str(e))
+
+        thread = threading.Thread(target=get_pr)
+        thread.start()
+        try:
+            result = client.compact()
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertFalse(result["full"])
+        # The rows added by get-pr may reuse some of the free pages
+        self.assertGreater(result["freed_pages"], free_pages // 2)
+        self.assertLess(os.path.getsize(self.dbfile), size)
+        self.assertEqual(client.test_pr("0", PKGARCH, "%040x" % 1 * 8), 1)
+
+    def test_compact_full(self):
+        # Databases created without incremental vacuum need one full compaction
+        conn = sqlite3.connect(self.dbfile)
+        conn.execute("CREATE TABLE PRMAIN_nohist (version TEXT NOT NULL, pkgarch TEXT NOT NULL, \
+                     checksum TEXT NOT NULL, value INTEGER, PRIMARY KEY (version, pkgarch, checksum));")
+        conn.commit()
+        conn.close()
+
+        self.start_server()
+        client = self.start_client()
+        client.importmany(make_rows(100))
+        with self.assertRaises(InvokeError):
+            client.compact()
+        self.assertTrue(client.compact(full=True)["full"])
+        self.assertFalse(client.compact()["full"])
+        self.assertEqual(client.test_pr("1.0", PKGARCH, "%040x" % 99), 99)
@@ -144,6 +144,108 @@ def copyhardlink(src, dst):
     except OSError:
         shutil.copy(src, dst)
 
+# ioctl cloning a file, from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    Make dst a copy of src sharing its data (FICLONE), on filesystems
+    supporting it such as btrfs and xfs. The permissions and times of src
+    are kept. Raises OSError when the file can't be cloned.
+    """
+    import fcntl
+
+    sstat = os.stat(src)
+    with open(src, "rb") as s:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, s.fileno())
+            os.fchmod(fd, sstat.st_mode & 0o7777)
+            os.utime(fd, ns=(sstat.st_atime_ns, sstat.st_mtime_ns))
+        except OSError:
+            os.close(fd)
+            os.unlink(dst)
+            raise
+        os.close(fd)
+
+def linkfiles(files, threads=1, batchsize=1000):
+    """
+    Install the files of the (src, dst) pairs, e.g. to populate a sysroot.
+    Symlinks are created again, other files are hardlinked, or cloned with
+    reflink() or copied when src and dst are on different filesystems or src
+    has too many links. The destination directories must exist.
+
+    The types of the sources are read from the listings of their directories
+    rather than with a stat call for each file, and the files are linked in
+    batches of batchsize files by threads threads.
+
+    Raises FileExistsError if a destination exists, unless it is a symlink
+    to the same location as the source.
+    """
+    import collections
+    import concurrent.futures
+    import bb.utils
+
+    # Read the types of the sources from their directories
+    bydir = collections.defaultdict(list)
+    for src, dst in files:
+        srcdir, name = os.path.split(src)
+        bydir[srcdir].append((name, src, dst))
+
+    links = []
+    symlinks = []
+    for srcdir, entries in bydir.items():
+        try:
+            with os.scandir(srcdir) as it:
+                islink = {e.name: e.is_symlink() for e in it}
+        except OSError:
+            islink = {}
+        for name, src, dst in entries:
+            if islink.get(name, False):
+                symlinks.append((src, dst))
+            else:
+                links.append((src, dst))
+
+    for src, dst in symlinks:
+        linkto = os.readlink(src)
+        try:
+            os.symlink(linkto, dst)
+        except FileExistsError:
+            if not os.path.islink(dst):
+                raise FileExistsError(errno.EEXIST, "Link %s already exists as a file" % dst, dst)
+            if os.readlink(dst) != linkto:
+                raise FileExistsError(errno.EEXIST, "Link %s already exists to a different location? (%s vs %s)" % (dst, os.readlink(dst), linkto), dst)
+
+    canreflink = True
+    def link(batch):
+        nonlocal canreflink
+        for src, dst in batch:
+            try:
+                os.link(src, dst)
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK):
+                    raise
+            if canreflink:
+                try:
+                    reflink(src, dst)
+                    continue
+                except OSError as e:
+                    if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL):
+                        canreflink = False
+                    elif e.errno == errno.EEXIST:
+                        raise
+            bb.utils.copyfile(src, dst)
+
+    batches = [links[i:i + batchsize] for i in range(0, len(links), batchsize)]
+    if threads > 1 and len(batches) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for f in [executor.submit(link, batch) for batch in batches]:
+                f.result()
+    else:
+        for batch in batches:
+            link(batch)
+
 def remove(path, recurse=True):
     """
     Equivalent to rm -f or rm -rf
@@ -33,7 +33,11 @@ def prserv_dump_db(d):
     opt_pkgarch = d.getVar('PRSERV_DUMPOPT_PKGARCH')
     opt_checksum = d.getVar('PRSERV_DUMPOPT_CHECKSUM')
     opt_col = ("1" == d.getVar('PRSERV_DUMPOPT_COL'))
-    d = conn.export(opt_version, opt_pkgarch, opt_checksum, opt_col)
+    if opt_col:
+        d = conn.export(opt_version, opt_pkgarch, opt_checksum, opt_col)
+    else:
+        # Fetch the rows in batches rather than in a single huge reply
+        d = (None, list(conn.export_iter(opt_version, opt_pkgarch, opt_checksum)))
     conn.close()
     return d
 
@@ -48,6 +52,7 @@ def prserv_import_db(d, filter_version=None, filter_pkgarch=None, filter_checksu
         return None
     #get the entry values
     imported = []
+    rows = []
     prefix = "PRAUTO$"
     for v in d.keys():
         if v.startswith(prefix):
@@ -64,11 +69,21 @@ def prserv_import_db(d, filter_version=None, filter_pkgarch=None, filter_checksu
             except BaseException as exc:
                 bb.debug("Not valid value of %s:%s" % (v,str(exc)))
                 continue
-            ret = conn.importone(version,pkgarch,checksum,value)
-            if ret != value:
-                bb.error("importing(%s,%s,%s,%d) failed. DB may have larger value %d" % (version,pkgarch,checksum,value,ret))
-            else:
-               imported.append((version,pkgarch,checksum,value))
+            rows.append((version,pkgarch,checksum,value))
+
+    # Import in batches, each in a single transaction on the server
+    batch_size = 1000
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        conflicts = conn.importmany(batch)
+        if conflicts is None:
+            bb.error("importing %d values failed. PR service may be read-only" % len(batch))
+            continue
+        failed = set()
+        for (version,pkgarch,checksum,value,ret) in conflicts:
+            bb.error("importing(%s,%s,%s,%d) failed. DB may have larger value %s" % (version,pkgarch,checksum,value,ret))
+            failed.add((version,pkgarch,checksum,value))
+        imported.extend(row for row in batch if row not in failed)
     conn.close()
     return imported
 
@@ -492,6 +492,166 @@ def find_sstate_manifest(taskdata, taskdata2, taskname, d, multilibcache):
             % (taskdata, taskname, variant, d2.expand(", ".join(pkgarchs)),"\n    ".join(searched_manifests)))
     return None, d2
 
+def sstate_index_journal(index):
+    return index + ".new"
+
+def sstate_index_read(index):
+    """
+    Return the set of the sstate objects (paths relative to SSTATE_DIR) in
+    the index, or None if the index doesn't exist. The index is the sorted
+    list of the objects written by "sstate-cache-management.py
+    --refresh-index" and the journal of the objects added since.
+    """
+    try:
+        with open(index) as f:
+            objects = set(f.read().splitlines())
+    except FileNotFoundError:
+        return None
+    try:
+        with open(sstate_index_journal(index)) as f:
+            objects.update(f.read().splitlines())
+    except FileNotFoundError:
+        pass
+    return objects
+
+def sstate_index_add(index, objects):
+    """Add the sstate objects to the journal of the index"""
+    data = "".join(o + "\n" for o in objects).encode("utf-8")
+    if not data:
+        return
+    bb.utils.mkdirhier(os.path.dirname(index))
+    # The tasks adding objects at the same time each append their objects
+    # with a single write, so the lines aren't interleaved
+    fd = os.open(sstate_index_journal(index), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def _sstate_tar_error(cmd, p):
+    return bb.process.ExecutionError(" ".join(cmd), p.returncode, None, p.stderr.decode("utf-8", errors="replace"))
+
+def sstate_archive(builddir, sstatepkg, num_threads, compresslevel):
+    """
+    Write the contents of builddir to the sstate object sstatepkg. tar
+    writes to the compressor directly, which writes the object.
+    """
+    import subprocess
+    import bb.compress.zstd
+
+    # As the shell glob used before, hidden files aren't archived
+    entries = sorted(e for e in os.listdir(builddir) if not e.startswith("."))
+    if entries:
+        cmd = ["tar", "-cS", "-f", "-", "--"] + entries
+    else:
+        cmd = ["tar", "-c", "-f", "-", "--files-from=/dev/null"]
+
+    # tar exits with 1 when files changed while they were archived
+    p = None
+    try:
+        with bb.compress.zstd.open(sstatepkg, "wb", num_threads=num_threads, compresslevel=compresslevel) as f:
+            p = subprocess.run(cmd, cwd=builddir, stdout=f, stderr=subprocess.PIPE)
+            if p.returncode not in (0, 1):
+                raise _sstate_tar_error(cmd, p)
+    except bb.compress._pipecompress.CompressionError as e:
+        # When one side of the pipe fails the other usually does too, keep
+        # the error from tar, which has its messages
+        if p is not None and p.returncode not in (0, 1):
+            raise _sstate_tar_error(cmd, p) from e
+        raise
+
+def sstate_unpack(sstatepkg, installdir, num_threads):
+    """
+    Extract the sstate object sstatepkg to installdir, tar reading the
+    output of the decompressor directly. The extracted files are listed on
+    the standard output.
+    """
+    import subprocess
+    import bb.compress.zstd
+
+    cmd = ["tar", "-xvp", "-f", "-"]
+    p = None
+    try:
+        with bb.compress.zstd.open(sstatepkg, "rb", num_threads=num_threads) as f:
+            p = subprocess.run(cmd, cwd=installdir, stdin=f, stderr=subprocess.PIPE)
+            if p.returncode:
+                raise _sstate_tar_error(cmd, p)
+    except bb.compress._pipecompress.CompressionError as e:
+        # The decompressor dies when tar stops reading a damaged object, keep
+        # the error from tar, which has its messages
+        if p is not None and p.returncode:
+            raise _sstate_tar_error(cmd, p) from e
+        raise
+
+# Files from this size are hashed in parallel by OEOuthashBasic()
+OUTHASH_PARALLEL_SIZE = 64 * 1024
+
+class OuthashDigestCache(object):
+    """
+    Cache of the digests of the contents of the files hashed by
+    OEOuthashBasic(), keyed by the device and inode of the files and checked
+    against their size, mtime and ctime, so files kept or hardlinked between
+    task outputs aren't read again. A file rewritten in place with the same
+    size and timestamps gets the digest of its old contents.
+
+    The day each entry was last used is recorded, and the entries unused for
+    more than max_age days are dropped when the cache is closed.
+    """
+    # A file changed just before it was hashed could change again without
+    # changing its timestamps, depending on the timestamp granularity
+    RACY_NS = 2 * 1000 * 1000 * 1000
+
+    def __init__(self, filename, max_age=30):
+        import sqlite3
+        import time
+
+        bb.utils.mkdirhier(os.path.dirname(filename))
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests_v2 (dev INTEGER, ino INTEGER, size INTEGER, "
+                        "mtime INTEGER, ctime INTEGER, digest TEXT, seen INTEGER, PRIMARY KEY (dev, ino))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS digests_v2_seen ON digests_v2 (seen)")
+        self.db.execute("DROP TABLE IF EXISTS digests")
+        self.start = time.time_ns()
+        self.today = int(time.time() // 86400)
+        self.max_age = max_age
+        self.updates = []
+        self.seen = []
+        self.stats = {"reused": 0, "reused_bytes": 0, "hashed": 0, "hashed_bytes": 0}
+
+    def get(self, s):
+        if s.st_ino >= 1 << 63 or s.st_dev >= 1 << 63:
+            return None
+        row = self.db.execute("SELECT size, mtime, ctime, digest, seen FROM digests_v2 WHERE dev=? AND ino=?",
+                              (s.st_dev, s.st_ino)).fetchone()
+        if row is None or row[:3] != (s.st_size, s.st_mtime_ns, s.st_ctime_ns):
+            return None
+        if row[4] != self.today:
+            self.seen.append((self.today, s.st_dev, s.st_ino))
+        self.stats["reused"] += 1
+        self.stats["reused_bytes"] += s.st_size
+        return row[3]
+
+    def add(self, s, digest):
+        self.stats["hashed"] += 1
+        self.stats["hashed_bytes"] += s.st_size
+        if s.st_ino >= 1 << 63 or s.st_dev >= 1 << 63:
+            return
+        if max(s.st_mtime_ns, s.st_ctime_ns) >= self.start - self.RACY_NS:
+            return
+        self.updates.append((s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns, s.st_ctime_ns, digest, self.today))
+
+    def close(self):
+        try:
+            with self.db:
+                if self.updates:
+                    self.db.executemany("INSERT OR REPLACE INTO digests_v2 VALUES (?, ?, ?, ?, ?, ?, ?)", self.updates)
+                if self.seen:
+                    self.db.executemany("UPDATE digests_v2 SET seen=? WHERE dev=? AND ino=?", self.seen)
+                self.db.execute("DELETE FROM digests_v2 WHERE seen < ?", (self.today - self.max_age,))
+        finally:
+            self.db.close()
+
 def OEOuthashBasic(path, sigfile, task, d):
     """
     Basic output hash function
@@ -505,6 +665,8 @@ def OEOuthashBasic(path, sigfile, task, d):
     import grp
     import re
     import fnmatch
+    import mmap
+    import concurrent.futures
 
     def update_hash(s):
         s = s.encode('utf-8')
@@ -526,6 +688,8 @@ def OEOuthashBasic(path, sigfile, task, d):
         include_root = False
     hash_version = d.getVar('HASHEQUIV_HASH_VERSION')
     extra_sigdata = d.getVar("HASHEQUIV_EXTRA_SIGDATA")
+    threads = int(d.getVar("SSTATE_HASHEQUIV_THREADS") or oe.utils.cpu_count(at_most=8))
+    digestcache = None
 
     filemaps = {}
     for m in (d.getVar('SSTATE_HASHEQUIV_FILEMAP') or '').split():
@@ -536,6 +700,10 @@ def OEOuthashBasic(path, sigfile, task, d):
         filemaps[entry[1]].append(entry[2])
 
     try:
+        if d.getVar("SSTATE_HASHEQUIV_DIGEST_CACHE"):
+            digestcache = OuthashDigestCache(d.getVar("SSTATE_HASHEQUIV_DIGEST_CACHE"),
+                                             int(d.getVar("SSTATE_HASHEQUIV_DIGEST_CACHE_MAX_AGE") or 30))
+
         os.chdir(path)
         basepath = os.path.normpath(path)
 
@@ -553,133 +721,173 @@ def OEOuthashBasic(path, sigfile, task, d):
         update_hash("SSTATE_PKGSPEC=%s\n" % d.getVar('SSTATE_PKGSPEC'))
         update_hash("task=%s\n" % task)
 
-        for root, dirs, files in os.walk('.', topdown=True):
-            # Sort directories to ensure consistent ordering when recursing
-            dirs.sort()
-            files.sort()
+        def is_filterfile(path):
+            for entry in filemaps:
+                if fnmatch.fnmatch(path, entry):
+                    return True
+            return False
 
-            def process(path):
-                s = os.lstat(path)
+        def hash_contents(path, s):
+            fh = hashlib.sha256()
+            with open(path, 'rb') as f:
+                if s.st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        fh.update(m)
+            return fh.hexdigest()
+
+        def process(path, s, filterfile, digest):
+            if stat.S_ISDIR(s.st_mode):
+                update_hash('d')
+            elif stat.S_ISCHR(s.st_mode):
+                update_hash('c')
+            elif stat.S_ISBLK(s.st_mode):
+                update_hash('b')
+            elif stat.S_ISSOCK(s.st_mode):
+                update_hash('s')
+            elif stat.S_ISLNK(s.st_mode):
+                update_hash('l')
+            elif stat.S_ISFIFO(s.st_mode):
+                update_hash('p')
+            else:
+                update_hash('-')
 
-                if stat.S_ISDIR(s.st_mode):
-                    update_hash('d')
-                elif stat.S_ISCHR(s.st_mode):
-                    update_hash('c')
-                elif stat.S_ISBLK(s.st_mode):
-                    update_hash('b')
-                elif stat.S_ISSOCK(s.st_mode):
-                    update_hash('s')
-                elif stat.S_ISLNK(s.st_mode):
-                    update_hash('l')
-                elif stat.S_ISFIFO(s.st_mode):
-                    update_hash('p')
+            def add_perm(mask, on, off='-'):
+                if mask & s.st_mode:
+                    update_hash(on)
                 else:
-                    update_hash('-')
-
-                def add_perm(mask, on, off='-'):
-                    if mask & s.st_mode:
-                        update_hash(on)
-                    else:
-                        update_hash(off)
+                    update_hash(off)
 
-                add_perm(stat.S_IRUSR, 'r')
-                add_perm(stat.S_IWUSR, 'w')
-                if stat.S_ISUID & s.st_mode:
-                    add_perm(stat.S_IXUSR, 's', 'S')
+            add_perm(stat.S_IRUSR, 'r')
+            add_perm(stat.S_IWUSR, 'w')
+            if stat.S_ISUID & s.st_mode:
+                add_perm(stat.S_IXUSR, 's', 'S')
+            else:
+                add_perm(stat.S_IXUSR, 'x')
+
+            if include_owners:
+                # Group/other permissions are only relevant in pseudo context
+                add_perm(stat.S_IRGRP, 'r')
+                add_perm(stat.S_IWGRP, 'w')
+                if stat.S_ISGID & s.st_mode:
+                    add_perm(stat.S_IXGRP, 's', 'S')
                 else:
-                    add_perm(stat.S_IXUSR, 'x')
-
-                if include_owners:
-                    # Group/other permissions are only relevant in pseudo context
-                    add_perm(stat.S_IRGRP, 'r')
-                    add_perm(stat.S_IWGRP, 'w')
-                    if stat.S_ISGID & s.st_mode:
-                        add_perm(stat.S_IXGRP, 's', 'S')
-                    else:
-                        add_perm(stat.S_IXGRP, 'x')
+                    add_perm(stat.S_IXGRP, 'x')
 
-                    add_perm(stat.S_IROTH, 'r')
-                    add_perm(stat.S_IWOTH, 'w')
-                    if stat.S_ISVTX & s.st_mode:
-                        update_hash('t')
-                    else:
-                        add_perm(stat.S_IXOTH, 'x')
-
-                    try:
-                        update_hash(" %10s" % pwd.getpwuid(s.st_uid).pw_name)
-                        update_hash(" %10s" % grp.getgrgid(s.st_gid).gr_name)
-                    except KeyError as e:
-                        msg = ("KeyError: %s\nPath %s is owned by uid %d, gid %d, which doesn't match "
-                            "any user/group on target. This may be due to host contamination." %
-                            (e, os.path.abspath(path), s.st_uid, s.st_gid))
-                        raise Exception(msg).with_traceback(e.__traceback__)
-
-                if include_timestamps:
-                    update_hash(" %10d" % s.st_mtime)
-
-                update_hash(" ")
-                if stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
-                    update_hash("%9s" % ("%d.%d" % (os.major(s.st_rdev), os.minor(s.st_rdev))))
+                add_perm(stat.S_IROTH, 'r')
+                add_perm(stat.S_IWOTH, 'w')
+                if stat.S_ISVTX & s.st_mode:
+                    update_hash('t')
                 else:
-                    update_hash(" " * 9)
-
-                filterfile = False
-                for entry in filemaps:
-                    if fnmatch.fnmatch(path, entry):
-                        filterfile = True
+                    add_perm(stat.S_IXOTH, 'x')
+
+                try:
+                    update_hash(" %10s" % pwd.getpwuid(s.st_uid).pw_name)
+                    update_hash(" %10s" % grp.getgrgid(s.st_gid).gr_name)
+                except KeyError as e:
+                    msg = ("KeyError: %s\nPath %s is owned by uid %d, gid %d, which doesn't match "
+                        "any user/group on target. This may be due to host contamination." %
+                        (e, os.path.abspath(path), s.st_uid, s.st_gid))
+                    raise Exception(msg).with_traceback(e.__traceback__)
+
+            if include_timestamps:
+                update_hash(" %10d" % s.st_mtime)
+
+            update_hash(" ")
+            if stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
+                update_hash("%9s" % ("%d.%d" % (os.major(s.st_rdev), os.minor(s.st_rdev))))
+            else:
+                update_hash(" " * 9)
 
-                update_hash(" ")
-                if stat.S_ISREG(s.st_mode) and not filterfile:
-                    update_hash("%10d" % s.st_size)
-                else:
-                    update_hash(" " * 10)
-
-                update_hash(" ")
-                fh = hashlib.sha256()
-                if stat.S_ISREG(s.st_mode):
-                    # Hash file contents
-                    if filterfile:
-                        # Need to ignore paths in crossscripts and postinst-useradd files.
-                        with open(path, 'rb') as d:
-                            chunk = d.read()
-                            chunk = chunk.replace(bytes(basepath, encoding='utf8'), b'')
-                            for entry in filemaps:
-                                if not fnmatch.fnmatch(path, entry):
-                                    continue
-                                for r in filemaps[entry]:
-                                    if r.startswith("regex-"):
-                                        chunk = re.sub(bytes(r[6:], encoding='utf8'), b'', chunk)
-                                    else:
-                                        chunk = chunk.replace(bytes(r, encoding='utf8'), b'')
-                            fh.update(chunk)
-                    else:
-                        with open(path, 'rb') as d:
-                            for chunk in iter(lambda: d.read(4096), b""):
-                                fh.update(chunk)
+            update_hash(" ")
+            if stat.S_ISREG(s.st_mode) and not filterfile:
+                update_hash("%10d" % s.st_size)
+            else:
+                update_hash(" " * 10)
+
+            update_hash(" ")
+            fh = hashlib.sha256()
+            if stat.S_ISREG(s.st_mode):
+                # Hash file contents
+                if filterfile:
+                    # Need to ignore paths in crossscripts and postinst-useradd files.
+                    with open(path, 'rb') as d:
+                        chunk = d.read()
+                        chunk = chunk.replace(bytes(basepath, encoding='utf8'), b'')
+                        for entry in filemaps:
+                            if not fnmatch.fnmatch(path, entry):
+                                continue
+                            for r in filemaps[entry]:
+                                if r.startswith("regex-"):
+                                    chunk = re.sub(bytes(r[6:], encoding='utf8'), b'', chunk)
+                                else:
+                                    chunk = chunk.replace(bytes(r, encoding='utf8'), b'')
+                        fh.update(chunk)
                     update_hash(fh.hexdigest())
+                elif isinstance(digest, str):
+                    # From the digest cache
+                    update_hash(digest)
                 else:
-                    update_hash(" " * len(fh.hexdigest()))
+                    if digest:
+                        digest = digest.result()
+                    else:
+                        digest = hash_contents(path, s)
+                    if digestcache:
+                        digestcache.add(s, digest)
+                    update_hash(digest)
+            else:
+                update_hash(" " * len(fh.hexdigest()))
 
-                update_hash(" %s" % path)
+            update_hash(" %s" % path)
 
-                if stat.S_ISLNK(s.st_mode):
-                    update_hash(" -> %s" % os.readlink(path))
+            if stat.S_ISLNK(s.st_mode):
+                update_hash(" -> %s" % os.readlink(path))
 
-                update_hash("\n")
+            update_hash("\n")
 
-            # Process this directory and all its child files
-            if include_root or root != ".":
-                process(root)
-            for f in files:
-                if f == 'fixmepath':
-                    continue
-                process(os.path.join(root, f))
+        # The contents of the larger files are hashed by a pool of threads
+        # while walking the output; the digests are added to the hash in
+        # the walk order so the hash doesn't depend on the threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            entries = []
+            def add_entry(path):
+                s = os.lstat(path)
+                filterfile = is_filterfile(path)
+                digest = None
+                if stat.S_ISREG(s.st_mode) and not filterfile:
+                    if digestcache:
+                        digest = digestcache.get(s)
+                    if digest is None and s.st_size >= OUTHASH_PARALLEL_SIZE and threads > 1:
+                        digest = executor.submit(hash_contents, path, s)
+                entries.append((path, s, filterfile, digest))
+
+            for root, dirs, files in os.walk('.', topdown=True):
+                # Sort directories to ensure consistent ordering when recursing
+                dirs.sort()
+                files.sort()
+
+                # Process this directory and all its child files
+                if include_root or root != ".":
+                    add_entry(root)
+                for f in files:
+                    if f == 'fixmepath':
+                        continue
+                    add_entry(os.path.join(root, f))
+
+                for dir in dirs:
+                    if os.path.islink(os.path.join(root, dir)):
+                        add_entry(os.path.join(root, dir))
+
+            for entry in entries:
+                process(*entry)
 
-            for dir in dirs:
-                if os.path.islink(os.path.join(root, dir)):
-                    process(os.path.join(root, dir))
+        if digestcache:
+            bb.note("Output hash: reused the digests of %d files (%d bytes), hashed %d files (%d bytes)" %
+                    (digestcache.stats["reused"], digestcache.stats["reused_bytes"],
+                     digestcache.stats["hashed"], digestcache.stats["hashed_bytes"]))
     finally:
         os.chdir(prev_dir)
+        if digestcache:
+            digestcache.close()
 
     return h.hexdigest()
 
@@ -89,3 +89,65 @@ class TestRealPath(TestCase):
         for e in self.EXCEPTIONS:
             self.assertRaisesRegex(OSError, r'\[Errno %u\]' % e[1],
                                     self.__realpath, e[0], False, False)
+
+class TestLinkFiles(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="oe-test_linkfiles")
+        self.addCleanup(self.tempdir.cleanup)
+        self.src = os.path.join(self.tempdir.name, "src")
+        self.dst = os.path.join(self.tempdir.name, "dst")
+        os.makedirs(os.path.join(self.src, "usr/lib"))
+        os.makedirs(os.path.join(self.dst, "usr/lib"))
+        self.files = []
+        for i in range(10):
+            name = "usr/lib/lib%d.so.1" % i
+            with open(os.path.join(self.src, name), "w") as f:
+                f.write("lib%d" % i)
+            os.symlink("lib%d.so.1" % i, os.path.join(self.src, "usr/lib/lib%d.so" % i))
+            self.files += [name, "usr/lib/lib%d.so" % i]
+
+    def pairs(self, dst=None):
+        return [(os.path.join(self.src, f), os.path.join(dst or self.dst, f)) for f in self.files]
+
+    def check(self, dst=None, hardlinked=True):
+        for src, dst in self.pairs(dst):
+            if src.endswith(".so"):
+                self.assertEqual(os.readlink(dst), os.readlink(src))
+            else:
+                self.assertFalse(os.path.islink(dst))
+                self.assertEqual(os.path.samefile(src, dst), hardlinked)
+                with open(src) as s, open(dst) as d:
+                    self.assertEqual(s.read(), d.read())
+
+    def test_linkfiles(self):
+        oe.path.linkfiles(self.pairs())
+        self.check()
+
+    def test_linkfiles_threads(self):
+        oe.path.linkfiles(self.pairs(), threads=2, batchsize=2)
+        self.check()
+
+    def test_linkfiles_exists(self):
+        # Symlinks already there to the same location are fine
+        os.symlink("lib0.so.1", os.path.join(self.dst, "usr/lib/lib0.so"))
+        oe.path.linkfiles(self.pairs())
+        self.check()
+
+        for name, create in (("usr/lib/lib0.so", lambda dst: os.symlink("other", dst)),
+                             ("usr/lib/lib0.so", lambda dst: open(dst, "w").close()),
+                             ("usr/lib/lib0.so.1", lambda dst: open(dst, "w").close())):
+            shutil.rmtree(self.dst)
+            os.makedirs(os.path.join(self.dst, "usr/lib"))
+            create(os.path.join(self.dst, name))
+            with self.assertRaises(FileExistsError):
+                oe.path.linkfiles(self.pairs())
+
+    def test_linkfiles_exdev(self):
+        # Files on another filesystem are copied
+        shm = "/dev/shm"
+        if not os.path.isdir(shm) or os.stat(shm).st_dev == os.stat(self.src).st_dev:
+            self.skipTest("No other filesystem in %s" % shm)
+        with tempfile.TemporaryDirectory(prefix="oe-test_linkfiles", dir=shm) as dst:
+            os.makedirs(os.path.join(dst, "usr/lib"))
+            oe.path.linkfiles(self.pairs(dst))
+            self.check(dst, hardlinked=False)
@@ -0,0 +1,204 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+
+from unittest.case import TestCase
+import unittest.mock
+import bb.compress._pipecompress
+import bb.data
+import bb.process
+import oe.sstatesig
+import io
+import os
+import re
+import shutil
+import tempfile
+
+class TestOuthash(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="outhash")
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = self.tempdir.name
+
+        for dir in ("usr/bin", "usr/lib", "usr/share/empty"):
+            os.makedirs(os.path.join(self.path, dir))
+        for i in range(20):
+            # Small and large files, the large ones are hashed in parallel
+            size = (i + 1) * oe.sstatesig.OUTHASH_PARALLEL_SIZE // 4
+            with open(os.path.join(self.path, "usr/lib/lib%d.so" % i), "wb") as f:
+                f.write(bytes([i]) * size)
+        with open(os.path.join(self.path, "usr/bin/script"), "w") as f:
+            f.write("#!%s/usr/bin/sh\n" % self.path)
+        os.chmod(os.path.join(self.path, "usr/bin/script"), 0o755)
+        open(os.path.join(self.path, "usr/lib/empty"), "w").close()
+        os.symlink("lib1.so", os.path.join(self.path, "usr/lib/liblink.so"))
+        os.symlink("lib", os.path.join(self.path, "usr/lib64"))
+
+        self.d = bb.data.init()
+        self.d.setVar("SSTATE_PKGSPEC", "sstate:test::1.0:r0::")
+        self.d.setVar("SSTATE_HASHEQUIV_FILEMAP", "populate_sysroot:*/script:%s" % self.path)
+
+    def outhash(self, threads):
+        self.d.setVar("SSTATE_HASHEQUIV_THREADS", str(threads))
+        sigfile = io.BytesIO()
+        outhash = oe.sstatesig.OEOuthashBasic(self.path, sigfile, "populate_sysroot", self.d)
+        return outhash, sigfile.getvalue()
+
+    def test_parallel(self):
+        outhash, sigdata = self.outhash(1)
+        self.assertEqual(self.outhash(4), (outhash, sigdata))
+        self.assertIn(b" ./usr/lib/lib19.so\n", sigdata)
+        self.assertIn(b" ./usr/lib64 -> lib\n", sigdata)
+
+    def test_contents(self):
+        outhash, _ = self.outhash(4)
+        with open(os.path.join(self.path, "usr/lib/lib19.so"), "r+b") as f:
+            f.write(b"\xff")
+        self.assertNotEqual(self.outhash(4)[0], outhash)
+
+    def outhash_cached(self):
+        self.d.setVar("SSTATE_HASHEQUIV_DIGEST_CACHE", os.path.join(self.path + "-cache", "digests.db"))
+        self.addCleanup(shutil.rmtree, self.path + "-cache", True)
+        with self.assertLogs("BitBake", level="INFO") as logs:
+            result = self.outhash(4)
+        self.d.delVar("SSTATE_HASHEQUIV_DIGEST_CACHE")
+        reused = re.search(r"reused the digests of (\d+) files", "".join(logs.output))
+        return result, int(reused.group(1))
+
+    def test_digest_cache(self):
+        uncached = self.outhash(4)
+        with unittest.mock.patch.object(oe.sstatesig.OuthashDigestCache, "RACY_NS", 0):
+            self.assertEqual(self.outhash_cached(), (uncached, 0))
+            # All the files except the filtered script
+            self.assertEqual(self.outhash_cached(), (uncached, 21))
+
+            with open(os.path.join(self.path, "usr/lib/lib19.so"), "r+b") as f:
+                f.write(b"\xff")
+            uncached = self.outhash(4)
+            self.assertEqual(self.outhash_cached(), (uncached, 20))
+
+    def test_digest_cache_racy(self):
+        # The files were just written so their digests aren't kept
+        self.assertEqual(self.outhash_cached()[1], 0)
+        self.assertEqual(self.outhash_cached()[1], 0)
+
+    def test_digest_cache_eviction(self):
+        dbfile = os.path.join(self.path + "-cache", "digests.db")
+        self.addCleanup(shutil.rmtree, self.path + "-cache", True)
+        s1 = os.stat(os.path.join(self.path, "usr/lib/lib1.so"))
+        s2 = os.stat(os.path.join(self.path, "usr/lib/lib2.so"))
+
+        def open_cache(today):
+            cache = oe.sstatesig.OuthashDigestCache(dbfile, max_age=30)
+            cache.today = today
+            return cache
+
+        with unittest.mock.patch.object(oe.sstatesig.OuthashDigestCache, "RACY_NS", 0):
+            cache = open_cache(1000)
+            cache.add(s1, "digest1")
+            cache.add(s2, "digest2")
+            cache.close()
+
+            # Using an entry keeps it
+            cache = open_cache(1020)
+            self.assertEqual(cache.get(s1), "digest1")
+            cache.close()
+
+            # The entries unused for more than 30 days are dropped on close
+            cache = open_cache(1040)
+            cache.close()
+            cache = open_cache(1040)
+            self.assertEqual(cache.get(s1), "digest1")
+            self.assertIsNone(cache.get(s2))
+            cache.close()
+
+class TestSstateIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstateindex")
+        self.addCleanup(self.tempdir.cleanup)
+        self.index = os.path.join(self.tempdir.name, "cache", "sstate-index")
+
+    def write_index(self, objects):
+        os.makedirs(os.path.dirname(self.index), exist_ok=True)
+        with open(self.index, "w") as f:
+            f.writelines(o + "\n" for o in sorted(objects))
+
+    def test_missing(self):
+        self.assertIsNone(oe.sstatesig.sstate_index_read(self.index))
+        # Objects added before the index is created aren't enough
+        oe.sstatesig.sstate_index_add(self.index, ["ab/cd/sstate:a:::::12:abcd_populate_sysroot.tar.zst"])
+        self.assertIsNone(oe.sstatesig.sstate_index_read(self.index))
+
+    def test_journal(self):
+        self.write_index(["ab/cd/sstate:a:::::12:abcd_populate_sysroot.tar.zst"])
+        self.assertEqual(oe.sstatesig.sstate_index_read(self.index), {"ab/cd/sstate:a:::::12:abcd_populate_sysroot.tar.zst"})
+
+        oe.sstatesig.sstate_index_add(self.index, [])
+        self.assertFalse(os.path.exists(self.index + ".new"))
+        oe.sstatesig.sstate_index_add(self.index, ["universal/12/34/sstate:b:::::12:1234_populate_sysroot.tar.zst",
+                                                   "universal/12/34/sstate:b:::::12:1234_populate_sysroot.tar.zst.siginfo"])
+        oe.sstatesig.sstate_index_add(self.index, ["ab/cd/sstate:a:::::12:abcd_populate_sysroot.tar.zst"])
+        self.assertEqual(oe.sstatesig.sstate_index_read(self.index), {
+            "ab/cd/sstate:a:::::12:abcd_populate_sysroot.tar.zst",
+            "universal/12/34/sstate:b:::::12:1234_populate_sysroot.tar.zst",
+            "universal/12/34/sstate:b:::::12:1234_populate_sysroot.tar.zst.siginfo",
+        })
+
+class TestSstateArchive(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstatearchive")
+        self.addCleanup(self.tempdir.cleanup)
+        self.builddir = os.path.join(self.tempdir.name, "build")
+        self.installdir = os.path.join(self.tempdir.name, "install")
+        self.sstatepkg = os.path.join(self.tempdir.name, "sstate:test:::::12:abcd_populate_sysroot.tar.zst")
+        os.makedirs(self.builddir)
+        os.makedirs(self.installdir)
+
+    def roundtrip(self, num_threads):
+        oe.sstatesig.sstate_archive(self.builddir, self.sstatepkg, num_threads, 8)
+        oe.sstatesig.sstate_unpack(self.sstatepkg, self.installdir, num_threads)
+
+    def test_archive(self):
+        os.makedirs(os.path.join(self.builddir, "sysroot-destdir/usr/lib"))
+        os.makedirs(os.path.join(self.builddir, "sysroot-destdir/usr/share/empty"))
+        with open(os.path.join(self.builddir, "sysroot-destdir/usr/lib/libfoo.so.1"), "wb") as f:
+            f.write(os.urandom(100000))
+        os.chmod(os.path.join(self.builddir, "sysroot-destdir/usr/lib/libfoo.so.1"), 0o755)
+        os.symlink("libfoo.so.1", os.path.join(self.builddir, "sysroot-destdir/usr/lib/libfoo.so"))
+        with open(os.path.join(self.builddir, "sysroot-destdir/usr/lib/sparse"), "wb") as f:
+            f.truncate(10 * 1024 * 1024)
+        # Hidden files at the top aren't archived
+        with open(os.path.join(self.builddir, ".hidden"), "w") as f:
+            f.write("hidden")
+
+        for num_threads in (1, 2):
+            with self.subTest(num_threads=num_threads):
+                shutil.rmtree(self.installdir)
+                os.makedirs(self.installdir)
+                self.roundtrip(num_threads)
+
+                lib = os.path.join(self.installdir, "sysroot-destdir/usr/lib")
+                with open(os.path.join(self.builddir, "sysroot-destdir/usr/lib/libfoo.so.1"), "rb") as f, \
+                     open(os.path.join(lib, "libfoo.so.1"), "rb") as g:
+                    self.assertEqual(f.read(), g.read())
+                self.assertEqual(os.stat(os.path.join(lib, "libfoo.so.1")).st_mode & 0o777, 0o755)
+                self.assertEqual(os.readlink(os.path.join(lib, "libfoo.so")), "libfoo.so.1")
+                self.assertEqual(os.path.getsize(os.path.join(lib, "sparse")), 10 * 1024 * 1024)
+                self.assertTrue(os.path.isdir(os.path.join(self.installdir, "sysroot-destdir/usr/share/empty")))
+                self.assertFalse(os.path.exists(os.path.join(self.installdir, ".hidden")))
+
+    def test_archive_empty(self):
+        self.roundtrip(1)
+        self.assertTrue(os.path.getsize(self.sstatepkg))
+        self.assertEqual(os.listdir(self.installdir), [])
+
+    def test_unpack_corrupt(self):
+        with open(self.sstatepkg, "wb") as f:
+            f.write(b"not an sstate object")
+        with self.assertRaises(bb.process.ExecutionError) as cm:
+            oe.sstatesig.sstate_unpack(self.sstatepkg, self.installdir, 1)
+        # The error from tar is raised, not the one from the decompressor
+        self.assertTrue(cm.exception.stderr)
+        self.assertIsInstance(cm.exception.__cause__, bb.compress._pipecompress.CompressionError)
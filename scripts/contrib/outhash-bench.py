@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+# Benchmark the output hash calculation (oe.sstatesig.OEOuthashBasic) of a
+# synthetic task output with different numbers of hashing threads
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+scripts_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lib_path = scripts_path + '/lib'
+sys.path.insert(0, lib_path)
+import scriptpath
+scriptpath.add_bitbake_lib_path()
+scriptpath.add_oe_lib_path()
+import bb.data
+import oe.sstatesig
+
+def create_tree(path, files, seed):
+    """
+    Create a tree of files with sizes roughly following a build output:
+    mostly small files, some libraries and a few large files
+    """
+    rand = random.Random(seed)
+    total = 0
+    for i in range(files):
+        dir = os.path.join(path, "usr", "dir%d" % (i // 500), "sub%d" % (i % 7))
+        os.makedirs(dir, exist_ok=True)
+        r = rand.random()
+        if r < 0.95:
+            size = rand.randint(0, 16 * 1024)
+        elif r < 0.995:
+            size = rand.randint(64 * 1024, 1024 * 1024)
+        else:
+            size = rand.randint(1024 * 1024, 4 * 1024 * 1024)
+        with open(os.path.join(dir, "file%d" % i), "wb") as f:
+            f.write(os.urandom(size))
+        total += size
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Output hash benchmark")
+    parser.add_argument("-f", "--files", type=int, default=50000, help="Number of files (default: %(default)s)")
+    parser.add_argument("-t", "--threads", default="1,2,4,8", help="Thread counts to test (default: %(default)s)")
+    parser.add_argument("-r", "--runs", type=int, default=3, help="Runs for each thread count (default: %(default)s)")
+    parser.add_argument("-d", "--dir", help="Directory to create the tree in (default: a temporary directory)")
+    parser.add_argument("-c", "--digest-cache", action="store_true",
+                        help="Also time the runs with the digest cache (SSTATE_HASHEQUIV_DIGEST_CACHE), "
+                             "the first run fills the cache")
+    args = parser.parse_args()
+
+    d = bb.data.init()
+    d.setVar("SSTATE_PKGSPEC", "sstate:bench::1.0:r0::")
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tempdir:
+        tree = os.path.join(tempdir, "tree")
+        total = create_tree(tree, args.files, 0)
+        print("%d files, %.1f MB" % (args.files, total / 1024 / 1024))
+        # The digests of files changed just before hashing aren't cached
+        time.sleep(oe.sstatesig.OuthashDigestCache.RACY_NS / 1000000000)
+
+        outhashes = set()
+        for threads in args.threads.split(","):
+            d.setVar("SSTATE_HASHEQUIV_THREADS", threads)
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                outhashes.add(oe.sstatesig.OEOuthashBasic(tree, None, "populate_sysroot", d))
+                times.append(time.perf_counter() - start)
+            best = min(times)
+            print("%2s threads: %7.2fs %8.1f MB/s" % (threads, best, total / 1024 / 1024 / best))
+
+            if args.digest_cache:
+                cache = os.path.join(tempdir, "digests-%s.db" % threads)
+                d.setVar("SSTATE_HASHEQUIV_DIGEST_CACHE", cache)
+                for run in ("empty cache", "cached"):
+                    start = time.perf_counter()
+                    outhashes.add(oe.sstatesig.OEOuthashBasic(tree, None, "populate_sysroot", d))
+                    print("%2s threads, %s: %7.2fs" % (threads, run, time.perf_counter() - start))
+                d.delVar("SSTATE_HASHEQUIV_DIGEST_CACHE")
+
+        if len(outhashes) != 1:
+            print("Output hashes differ: %s" % outhashes)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+# Benchmark the creation and extraction of sstate objects
+# (oe.sstatesig.sstate_archive() and oe.sstatesig.sstate_unpack()) of a
+# directory with different numbers of zstd threads
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+scripts_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+lib_path = scripts_path + '/lib'
+sys.path.insert(0, lib_path)
+import scriptpath
+scriptpath.add_bitbake_lib_path()
+scriptpath.add_oe_lib_path()
+import oe.sstatesig
+
+def drop_caches():
+    try:
+        subprocess.run(["sync"], check=True)
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except OSError:
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="sstate object creation and extraction benchmark")
+    parser.add_argument("builddir", help="Directory to archive, as SSTATE_BUILDDIR")
+    parser.add_argument("-t", "--threads", default="1,4,8", help="zstd thread counts to test (default: %(default)s)")
+    parser.add_argument("-l", "--level", type=int, default=8, help="Compression level (default: %(default)s, as SSTATE_ZSTD_CLEVEL)")
+    parser.add_argument("-d", "--dir", help="Directory to write the object and extract it to (default: a temporary directory)")
+    parser.add_argument("-c", "--cold", action="store_true", help="Drop the page cache before each step (needs root)")
+    args = parser.parse_args()
+
+    size = int(subprocess.check_output(["du", "-sb", args.builddir]).split()[0])
+    print("%s: %.1f MB" % (args.builddir, size / 1024 / 1024))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tempdir:
+        sstatepkg = os.path.join(tempdir, "sstate.tar.zst")
+        installdir = os.path.join(tempdir, "install")
+        for threads in args.threads.split(","):
+            threads = int(threads)
+
+            if args.cold and not drop_caches():
+                print("Unable to drop the page cache")
+                return 1
+            start = time.perf_counter()
+            oe.sstatesig.sstate_archive(args.builddir, sstatepkg, threads, args.level)
+            os.sync()
+            archive = time.perf_counter() - start
+
+            os.makedirs(installdir)
+            if args.cold:
+                drop_caches()
+            start = time.perf_counter()
+            with open(os.devnull, "w") as devnull:
+                # Discard the list of files
+                stdout = os.dup(1)
+                os.dup2(devnull.fileno(), 1)
+                try:
+                    oe.sstatesig.sstate_unpack(sstatepkg, installdir, threads)
+                finally:
+                    os.dup2(stdout, 1)
+                    os.close(stdout)
+            os.sync()
+            unpack = time.perf_counter() - start
+
+            print("%2d threads: object %.1f MB, archive %7.2fs %7.1f MB/s, unpack %7.2fs %7.1f MB/s" %
+                  (threads, os.path.getsize(sstatepkg) / 1024 / 1024,
+                   archive, size / 1024 / 1024 / archive, unpack, size / 1024 / 1024 / unpack))
+            os.unlink(sstatepkg)
+            shutil.rmtree(installdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
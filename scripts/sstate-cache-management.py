@@ -256,6 +256,16 @@ def parse_arguments():
             Conflicts with --remove-duplicated.""",
     )
 
+    parser.add_argument(
+        "--refresh-index",
+        nargs="?",
+        const="",
+        metavar="INDEX",
+        help="""Write the index of the sstate cache files used by builds with
+            SSTATE_INDEX set to INDEX, or cache-dir/sstate-index if INDEX isn't
+            specified. The files removed are left out of the index.""",
+    )
+
     parser.add_argument(
         "-j", "--jobs", default=8, type=int, help="Run JOBS jobs in parallel."
     )
@@ -289,17 +299,47 @@ def parse_arguments():
 
     args = parser.parse_args()
     if args.cache_dir is None or (
-        not args.remove_duplicated and not args.stamps_dir and not args.remove_orphans
+        not args.remove_duplicated
+        and not args.stamps_dir
+        and not args.remove_orphans
+        and args.refresh_index is None
     ):
         parser.print_usage()
         sys.exit(1)
 
+    if args.refresh_index == "":
+        args.refresh_index = os.path.join(args.cache_dir, "sstate-index")
+
     return args
 
 
+def write_index(args, paths):
+    # The format is read by oe.sstatesig.sstate_index_read(): the sorted paths
+    # relative to the cache directory, with the paths added by builds since
+    # appended to INDEX.new
+    index = Path(args.refresh_index)
+    names = sorted(str(p.path.relative_to(args.cache_dir)) for p in paths)
+    index.parent.mkdir(parents=True, exist_ok=True)
+    tmp = index.with_name(f"{index.name}.{os.getpid()}")
+    with open(tmp, "w") as f:
+        f.writelines(f"{name}\n" for name in names)
+    tmp.rename(index)
+    print(f"Wrote {len(names)} files to the index {index}")
+
+
 def main():
     args = parse_arguments()
 
+    if args.refresh_index:
+        # Files added by builds while the cache directory is scanned are
+        # added to the new journal
+        journal = Path(args.refresh_index + ".new")
+        old_journal = journal.with_name(f"{journal.name}.{os.getpid()}")
+        try:
+            journal.rename(old_journal)
+        except FileNotFoundError:
+            pass
+
     paths = collect_sstate_paths(args)
     if args.remove_duplicated:
         remove = remove_duplicated(args, paths)
@@ -311,6 +351,11 @@ def main():
     if args.remove_orphans:
         remove = set(remove) | set(remove_orphans(args, paths))
 
+    if args.refresh_index and not remove:
+        write_index(args, paths)
+        old_journal.unlink(missing_ok=True)
+        return
+
     if args.debug >= 1:
         print("\n".join([str(p.path) for p in remove]))
     print(f"{len(remove)} out of {len(paths)} files will be removed!")
@@ -324,6 +369,12 @@ def main():
         for p in remove:
             p.path.unlink()
 
+    if args.refresh_index:
+        if confirm:
+            paths = set(paths) - set(remove)
+        write_index(args, paths)
+        old_journal.unlink(missing_ok=True)
+
 
 if __name__ == "__main__":
     main()